@@ -9,15 +9,29 @@
 #
 # Algorithm:
 #   1. Import gps data from GPS file
-#   2. Move data to the images
+#   2. Match each row to its image through an index of the image file names
+#   3. Move data to the images with a pool of threads, JPEG images have only the GPS IFD of their
+#      EXIF (APP1) segment rewritten, the rest of the EXIF data and the compressed image data are
+#      copied as is
+#   4. Print the throughput of the run
 #
 ###################################################################################################
 import os
-import json
+import csv
+import time
+import shutil
+import struct
 import argparse
 
-from GPSPhoto import gpsphoto
+from tqdm import tqdm
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from pipeline_profiler import profiled, count, enable_profiling, finish_profiling, PROFILE_FILE
+
+try:
+    from GPSPhoto import gpsphoto
+except ImportError:
+    gpsphoto = None # Only needed by the gpsphoto tag mode
 
 ###################################################################################################
 #
@@ -26,12 +40,64 @@ from pathlib import Path
 ###################################################################################################
 JPG = ".JPG"
 PNG = ".PNG"
+GPS_FILE = "GPS_data.csv"
+
+APP1 = "app1"                   # Rewrite only the EXIF segment of JPEG images
+GPSPHOTO = "gpsphoto"           # Rewrite the whole image with GPSPhoto
+TAG_MODES = (APP1, GPSPHOTO)
+TAG_WORKERS = 8                 # Threads tagging images at once, tagging is bound by file reads and writes
+
+# JPEG markers
+SOI_MARKER = 0xD8
+SOS_MARKER = 0xDA
+EOI_MARKER = 0xD9
+APP0_MARKER = 0xE0
+APP1_MARKER = 0xE1
+EXIF_HEADER = b"Exif\x00\x00"
+MAX_SEGMENT_LENGTH = 0xFFFF     # Segment length includes its own two length bytes
+
+# EXIF tags
+GPS_IFD_TAG = 0x8825
+GPS_VERSION_ID = 0
+GPS_LATITUDE_REF = 1
+GPS_LATITUDE = 2
+GPS_LONGITUDE_REF = 3
+GPS_LONGITUDE = 4
+GPS_ALTITUDE_REF = 5
+GPS_ALTITUDE = 6
+
+# TIFF structure of the EXIF data
+TIFF_BYTE_ORDERS = {b"II": "<", b"MM": ">"}
+TIFF_BYTE = 1
+TIFF_ASCII = 2
+TIFF_LONG = 4
+TIFF_RATIONAL = 5
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8}
+EMPTY_TIFF = b"MM\x00\x2a" + struct.pack(">IHI", 8, 0, 0) # Header and an IFD0 with no entries
+
+SECONDS_DENOMINATOR = 10000     # Arc seconds are stored to 1/10000 of a second
+ALTITUDE_DENOMINATOR = 100
+
+BYTES_PER_MB = 2**20
 
 ###################################################################################################
 #
 #                                            CLASSES
 #
 ###################################################################################################
+class Tag_Result(object):
+    ################################
+    #
+    # Outcome of tagging one image
+    #
+    # in_place is True when the EXIF segment was overwritten without rewriting the file
+    #
+    ################################
+    def __init__(self, image_file, bytes_written, in_place=False):
+
+        self.image_file    = image_file
+        self.bytes_written = bytes_written
+        self.in_place      = in_place
 
 
 ###################################################################################################
@@ -39,61 +105,394 @@ PNG = ".PNG"
 #                                            FUNCTIONS
 #
 ###################################################################################################
-def add_GPS_metadata(data_folder):
+def read_GPS_file(gps_file_path):
+    ################################
+    #
+    # Read the GPS file, one row per image
+    # Input: GPS file location
+    # Output: list of (image name, latitude, longitude, altitude)
+    #
+    ################################
+    rows = []
+    with open(gps_file_path, 'r', newline='', encoding='utf-8-sig') as gps_file:
+        for row in csv.reader(gps_file):
+            if len(row) < 4:
+                continue
 
-    gps_file_path = Path(data_folder, "GPS_data.csv")
+            image_name, lat, lon, alt = (field.strip() for field in row[:4])
 
-    assert os.path.exists(data_folder), "Data Folder does not exist."
-    assert os.path.exists(gps_file_path), "GPS data file not found."
+            try:
+                rows.append((image_name, float(lat), float(lon), float(alt)))
+            except ValueError:
+                continue # Header row
+
+    return rows
 
-    # Get names of the exif data files
-    dir_files = os.listdir(data_folder)
 
-    image_files = []
-    for image in dir_files:
-        if JPG in image:
-            image_files = image_files + [image]
+def list_image_files(data_folder):
+    # The JPEG images of a folder, or its PNG images when it has no JPEG images, sorted by name
+    image_files = sorted(path for path in Path(data_folder).iterdir() if path.suffix.upper() == JPG)
 
-    image_format = JPG
+    if not image_files:
+        image_files = sorted(path for path in Path(data_folder).iterdir() if path.suffix.upper() == PNG)
 
-    if image_files is []:
-        image_format = PNG
-        for image in dir_files:
-            if PNG in image:
-                image_files = image_files + [image]
+    return image_files
 
-    if image_files is []:
+
+def index_image_files(data_folder):
+    ################################
+    #
+    # Index of the JPEG (or, when there are none, PNG) images of a folder
+    # Input: Data folder path
+    # Output: dictionary of image file name and of name without extension to the image file
+    #
+    ################################
+    image_files = list_image_files(data_folder)
+
+    if not image_files:
         print("No image files ending with .jpg or .png in folder: " + str(data_folder))
 
-    with open(gps_file_path, 'r') as gps_file:
-        # For each line in the file, read the image name, match it , and add data
-        for line in gps_file.readlines():
+    index = {}
+    for image_file in image_files:
+        index[image_file.name] = image_file
+        index[image_file.stem] = image_file
 
-            image_name, lat, lon, alt = line.split(",")
+    return index
 
-            # Add image end if there
-            if image_name[-5:-1] is not image_format:
-                image_name = image_name + image_format
 
-            alt = alt[0:-1] # Strip \n char
+def degrees_to_rationals(degrees):
+    # Degrees, minutes and seconds of an angle as EXIF rationals (numerator, denominator)
+    degrees = abs(degrees)
+    whole_degrees = int(degrees)
+    minutes = int((degrees - whole_degrees)*60)
+    seconds = round(((degrees - whole_degrees)*60 - minutes)*60*SECONDS_DENOMINATOR)
 
-            # Ensure image is in the image files
-            if not image_name in image_files:
-                print("Image " + image_name + " not found in image files. Cannot move exif data")
-                continue
+    # Rounded seconds can reach a whole minute, carry it so the angle stays a valid DMS value
+    if seconds >= 60*SECONDS_DENOMINATOR:
+        seconds -= 60*SECONDS_DENOMINATOR
+        minutes += 1
+    if minutes >= 60:
+        minutes -= 60
+        whole_degrees += 1
+
+    return ((whole_degrees, 1), (minutes, 1), (seconds, SECONDS_DENOMINATOR))
+
+
+def gps_entries(lat, lon, alt, byte_order):
+    # GPS IFD entries of a position, dictionary of tag to (type, count, value bytes)
+    def rationals(values):
+        return b"".join(struct.pack(byte_order + "II", numerator, denominator) for numerator, denominator in values)
+
+    return {
+        GPS_VERSION_ID:    (TIFF_BYTE, 4, b"\x02\x02\x00\x00"),
+        GPS_LATITUDE_REF:  (TIFF_ASCII, 2, b"N\x00" if lat >= 0 else b"S\x00"),
+        GPS_LATITUDE:      (TIFF_RATIONAL, 3, rationals(degrees_to_rationals(lat))),
+        GPS_LONGITUDE_REF: (TIFF_ASCII, 2, b"E\x00" if lon >= 0 else b"W\x00"),
+        GPS_LONGITUDE:     (TIFF_RATIONAL, 3, rationals(degrees_to_rationals(lon))),
+        GPS_ALTITUDE_REF:  (TIFF_BYTE, 1, b"\x00" if alt >= 0 else b"\x01"),
+        GPS_ALTITUDE:      (TIFF_RATIONAL, 1, rationals([(round(abs(alt)*ALTITUDE_DENOMINATOR), ALTITUDE_DENOMINATOR)])),
+    }
+
+
+def read_ifd_entries(tiff, offset, byte_order):
+    ################################
+    #
+    # Read the entries of a TIFF IFD
+    # Input: TIFF data, offset of the IFD, struct byte order
+    # Output: dictionary of tag to (type, count, value bytes)
+    #
+    ################################
+    num_entries = struct.unpack_from(byte_order + "H", tiff, offset)[0]
+
+    entries = {}
+    for entry in range(num_entries):
+        tag, kind, value_count, value = struct.unpack_from(byte_order + "HHI4s", tiff, offset + 2 + 12*entry)
+        size = TIFF_TYPE_SIZES.get(kind, 1)*value_count
+
+        if size > 4:
+            value_offset = struct.unpack(byte_order + "I", value)[0]
+            value = tiff[value_offset:value_offset + size]
+
+        entries[tag] = (kind, value_count, bytes(value[:size]))
+
+    return entries
+
+
+def pack_ifd(entries, offset, byte_order):
+    ################################
+    #
+    # Pack a TIFF IFD with its values following it
+    # Input: dictionary of tag to (type, count, value bytes), offset the IFD is written at,
+    #        struct byte order
+    # Output: bytes of the IFD and its values
+    #
+    ################################
+    values_offset = offset + 2 + 12*len(entries) + 4
+
+    fields = struct.pack(byte_order + "H", len(entries))
+    values = b""
+    for tag in sorted(entries):
+        kind, value_count, value = entries[tag]
+
+        if len(value) > 4:
+            fields += struct.pack(byte_order + "HHII", tag, kind, value_count, values_offset + len(values))
+            values += value + b"\x00"*(len(value) % 2) # Values start on a word boundary
+        else:
+            fields += struct.pack(byte_order + "HHI", tag, kind, value_count) + value.ljust(4, b"\x00")
+
+    return fields + struct.pack(byte_order + "I", 0) + values
+
+
+def splice_gps_ifd(tiff, lat, lon, alt):
+    #######################################
+    #
+    # TIFF data of an EXIF segment with its GPS IFD replaced
+    #
+    # Every other byte is kept where it was, so the offsets of maker notes and the IFD1
+    # thumbnail stay valid. The new GPS IFD is appended and the GPS pointer of IFD0 moved to it,
+    # a GPS IFD appended by an earlier run is overwritten. When IFD0 has no GPS pointer, IFD0 is
+    # copied to the end with one added. GPS tags other than the position are kept.
+    #
+    # Input: TIFF data (after Exif\0\0), latitude and longitude in degrees, altitude in metres
+    # Returns: new TIFF data
+    #
+    ######################################
+    assert tiff[:2] in TIFF_BYTE_ORDERS, "Unknown EXIF byte order"
+    byte_order = TIFF_BYTE_ORDERS[tiff[:2]]
+
+    tiff = bytearray(tiff)
+    ifd0 = struct.unpack_from(byte_order + "I", tiff, 4)[0]
+    num_entries = struct.unpack_from(byte_order + "H", tiff, ifd0)[0]
+    fields = [bytes(tiff[ifd0 + 2 + 12*entry:ifd0 + 14 + 12*entry]) for entry in range(num_entries)]
+    tags = [struct.unpack_from(byte_order + "H", field)[0] for field in fields]
+
+    entries = gps_entries(lat, lon, alt, byte_order)
+
+    if GPS_IFD_TAG in tags:
+        pointer = ifd0 + 2 + 12*tags.index(GPS_IFD_TAG) + 8
+        old_offset = struct.unpack_from(byte_order + "I", tiff, pointer)[0]
+        old_entries = read_ifd_entries(tiff, old_offset, byte_order)
+        entries = {**old_entries, **entries}
+
+        # A GPS IFD this function appended before is at the end, overwrite it
+        if tiff[old_offset:] == pack_ifd(old_entries, old_offset, byte_order):
+            del tiff[old_offset:]
+
+    else:
+        # Copy IFD0 to the end with a GPS pointer, the pointer is filled in below
+        tags.append(GPS_IFD_TAG)
+        fields.append(struct.pack(byte_order + "HHII", GPS_IFD_TAG, TIFF_LONG, 1, 0))
+        next_ifd = tiff[ifd0 + 2 + 12*num_entries:ifd0 + 6 + 12*num_entries]
+
+        tiff += b"\x00"*(len(tiff) % 2)
+        struct.pack_into(byte_order + "I", tiff, 4, len(tiff))
+        pointer = len(tiff) + 2 + 12*sorted(tags).index(GPS_IFD_TAG) + 8
+
+        tiff += struct.pack(byte_order + "H", len(fields))
+        tiff += b"".join(field for _, field in sorted(zip(tags, fields)))
+        tiff += next_ifd
+
+    tiff += b"\x00"*(len(tiff) % 2)
+    struct.pack_into(byte_order + "I", tiff, pointer, len(tiff))
+    tiff += pack_ifd(entries, len(tiff), byte_order)
+
+    return bytes(tiff)
+
+
+def build_exif_segment(exif_payload, lat, lon, alt):
+    #######################################
+    #
+    # EXIF segment of an image with its GPS data replaced
+    #
+    # Input: current EXIF payload (starting with Exif\0\0, None when the image has none),
+    #        latitude and longitude in degrees, altitude in metres
+    # Returns: new EXIF payload
+    #
+    ######################################
+    tiff = exif_payload[len(EXIF_HEADER):] if exif_payload is not None else EMPTY_TIFF
+
+    payload = EXIF_HEADER + splice_gps_ifd(tiff, lat, lon, alt)
+
+    assert len(payload) + 2 <= MAX_SEGMENT_LENGTH, "EXIF data does not fit in one APP1 segment"
 
-            # Append gps data to file
-            photo = gpsphoto.GPSPhoto(str(Path(data_folder, image_name)))
-            info = gpsphoto.GPSInfo((float(lat), float(lon)), int(alt))
+    return payload
 
-            photo.modGPSData(info, str(Path(data_folder, image_name)))
+
+def read_jpeg_segments(image_handle):
+    ################################
+    #
+    # Read the marker segments of a JPEG file up to its image data
+    # Input: binary file object at the start of the file
+    # Output: list of (marker, start, end, payload) with payload only read for EXIF segments,
+    #         offset of the image data (start of scan marker)
+    #
+    ################################
+    assert image_handle.read(2) == bytes((0xFF, SOI_MARKER)), "Not a JPEG file"
+
+    segments = []
+    while True:
+        start = image_handle.tell()
+        prefix = image_handle.read(2)
+        assert len(prefix) == 2 and prefix[0] == 0xFF, "Corrupt JPEG marker"
+
+        marker = prefix[1]
+        while marker == 0xFF: # Fill bytes
+            marker = image_handle.read(1)[0]
+            start = image_handle.tell() - 2
+
+        if marker in (SOS_MARKER, EOI_MARKER):
+            return segments, start
+
+        length = struct.unpack(">H", image_handle.read(2))[0]
+        payload = None
+
+        if marker == APP1_MARKER:
+            payload = image_handle.read(length - 2)
+            if not payload.startswith(EXIF_HEADER):
+                payload = None
+        else:
+            image_handle.seek(length - 2, os.SEEK_CUR)
+
+        segments.append((marker, start, image_handle.tell(), payload))
+
+
+def tag_jpeg_app1(image_file, lat, lon, alt):
+    #######################################
+    #
+    # Writes GPS data into the EXIF (APP1) segment of a JPEG without decoding the image
+    #
+    # A new segment the same length as the old one is written over it in place, otherwise the
+    # file is rebuilt with the other segments and the compressed image data copied as is.
+    #
+    # Input: JPEG file, latitude and longitude in degrees, altitude in metres
+    # Returns: Tag_Result
+    #
+    ######################################
+    with open(image_file, "rb") as image_handle:
+        segments, _ = read_jpeg_segments(image_handle)
+
+    exif_segments = [segment for segment in segments if segment[3] is not None]
+    old = exif_segments[0] if exif_segments else None
+
+    payload = build_exif_segment(old[3] if old else None, lat, lon, alt)
+    segment = bytes((0xFF, APP1_MARKER)) + struct.pack(">H", len(payload) + 2) + payload
+
+    if old is not None and old[2] - old[1] == len(segment):
+        with open(image_file, "r+b") as image_handle:
+            image_handle.seek(old[1])
+            image_handle.write(segment)
+
+        return Tag_Result(image_file, len(segment), True)
+
+    # The EXIF segment replaces the old one, or follows the JFIF (APP0) segment when there is none
+    if old is not None:
+        insert_start, insert_end = old[1], old[2]
+    elif segments and segments[0][0] == APP0_MARKER:
+        insert_start = insert_end = segments[0][2]
+    else:
+        insert_start = insert_end = 2
+
+    temp_file = Path(image_file).with_name(Path(image_file).name + ".tmp")
+    with open(image_file, "rb") as image_handle, open(temp_file, "wb") as temp_handle:
+        temp_handle.write(image_handle.read(insert_start))
+        temp_handle.write(segment)
+
+        image_handle.seek(insert_end)
+        shutil.copyfileobj(image_handle, temp_handle)
+
+        bytes_written = temp_handle.tell()
+
+    os.replace(temp_file, image_file)
+
+    return Tag_Result(image_file, bytes_written)
+
+
+def tag_gpsphoto(image_file, lat, lon, alt):
+    # Writes GPS data by rewriting the whole image with GPSPhoto
+    assert gpsphoto is not None, "The " + GPSPHOTO + " tag mode needs the GPSPhoto package"
+
+    photo = gpsphoto.GPSPhoto(str(image_file))
+    info = gpsphoto.GPSInfo((lat, lon), int(alt))
+
+    photo.modGPSData(info, str(image_file))
+
+    return Tag_Result(image_file, os.path.getsize(image_file))
+
+
+def tag_image(image_file, lat, lon, alt, mode=APP1):
+    # Tags one image, images other than JPEGs are always tagged with GPSPhoto
+    if mode == APP1 and image_file.suffix.upper() == JPG:
+        return tag_jpeg_app1(image_file, lat, lon, alt)
+
+    return tag_gpsphoto(image_file, lat, lon, alt)
+
+
+@profiled
+def add_GPS_metadata(data_folder, workers=TAG_WORKERS, mode=APP1):
+    #######################################
+    #
+    # Tags every image of a folder listed in its GPS file
+    #
+    # Input: Image & GPS file folder path, number of threads, tag mode (APP1 or GPSPHOTO)
+    # Returns: list of Tag_Result
+    #
+    ######################################
+    gps_file_path = Path(data_folder, GPS_FILE)
+
+    assert os.path.exists(data_folder), "Data Folder does not exist."
+    assert os.path.exists(gps_file_path), "GPS data file not found."
+    assert mode in TAG_MODES, "Unknown tag mode: " + str(mode)
+
+    start = time.perf_counter()
+
+    image_index = index_image_files(data_folder)
+
+    # Match each row to its image, the image extension is optional in the GPS file
+    jobs = []
+    for image_name, lat, lon, alt in read_GPS_file(gps_file_path):
+        if image_name not in image_index:
+            print("Image " + image_name + " not found in image files. Cannot move exif data")
+            continue
+
+        jobs.append((image_index[image_name], lat, lon, alt))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(tag_image, image_file, lat, lon, alt, mode) for image_file, lat, lon, alt in jobs]
+        results = [future.result() for future in tqdm(futures, desc="Tagging images")]
+
+    count("images_tagged", len(results))
+    print_throughput(results, time.perf_counter() - start)
+
+    return results
+
+
+def print_throughput(results, seconds):
+    # Prints the images tagged and the rate they were tagged at
+    num_bytes = sum(result.bytes_written for result in results)
+    in_place = sum(result.in_place for result in results)
+
+    print()
+    print("Tagged " + str(len(results)) + " images (" + str(in_place) + " in place) in " + '{:.2f}'.format(seconds) + " s")
+    if seconds > 0:
+        print('{:.1f} images/s, {:.1f} MB/s written'.format(len(results)/seconds, num_bytes/BYTES_PER_MB/seconds))
+
+    return
 
 
 # Insertion point
 if __name__ == '__main__':
     # Read in arguments
-    parser = argparse.ArgumentParser(description='Find slopes from a ply file')
+    parser = argparse.ArgumentParser(description='Add the GPS data of a GPS file to its images')
     parser.add_argument('--data_folder', metavar='folder', type=str, default=Path('Data', 'Usmans_data', 'inputs'), help='Image & GPS file folder path')
+    parser.add_argument('--workers', metavar='count', type=int, default=TAG_WORKERS, help='Number of images tagged at once')
+    parser.add_argument('--mode', type=str, choices=TAG_MODES, default=APP1, help='app1 rewrites only the EXIF segment of JPEG images, gpsphoto rewrites the whole image')
+    parser.add_argument('--profile', metavar='file', type=str, nargs='?', const=PROFILE_FILE, default=None, help='Record timing spans, counters and memory peaks to a Chrome trace file')
     args = parser.parse_args()
 
-    add_GPS_metadata(args.data_folder)
+    if args.profile:
+        enable_profiling()
+
+    add_GPS_metadata(args.data_folder, args.workers, args.mode)
+
+    if args.profile:
+        finish_profiling(args.profile)
\ No newline at end of file
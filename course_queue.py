@@ -0,0 +1,371 @@
+###################################################################################################
+#
+#                                       COURSE QUEUE
+#
+#
+# Runs the pipeline over many course folders from a persistent job queue, so a batch that is
+# stopped part way resumes where it stopped
+# Authors: Jayden Cole & Ryan Stolys
+# Creation date: 2022-07-10
+#
+# Algorithm:
+#   1. Add one job per course folder to the SQLite queue as a new batch
+#   2. Start a worker process for each pending job, up to the worker count
+#   3. Stop jobs that run past the timeout, return failed jobs to the queue until their retries
+#      are used up
+#   4. On restart, jobs left running by a stopped batch are returned to the queue, finished
+#      stages of a course are not run again (see pipeline_stages.py)
+#
+###################################################################################################
+import sys
+import glob
+import json
+import time
+import sqlite3
+import argparse
+import traceback
+import multiprocessing
+
+from tqdm import tqdm
+from queue import Empty
+from pathlib import Path
+from main import run_pipeline
+from metashape_project import find_project_file
+from slope_model_generation import Grid_Spec, FIT_METHODS, FIT_METHOD, GRID_SIZE_X, GRID_SIZE_Y, PLY_FILE
+
+###################################################################################################
+#
+#                                            CONSTANTS
+#
+###################################################################################################
+QUEUE_FILE = "course_queue.sqlite"
+LOG_FOLDER = "course_logs"      # Output of each job attempt, <job id>_<attempt>.log
+
+JOB_TIMEOUT = 3600              # Seconds a job may run before it is stopped
+JOB_RETRIES = 1                 # Times a failed or stopped job is run again
+POLL_SECONDS = 0.5
+RESULT_WAIT = 5                 # Seconds to wait for the result of a worker that exited cleanly
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS batches (
+    id          INTEGER PRIMARY KEY,
+    created     TEXT NOT NULL,
+    settings    TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id          INTEGER PRIMARY KEY,
+    batch_id    INTEGER NOT NULL REFERENCES batches(id),
+    data_folder TEXT NOT NULL,
+    status      TEXT NOT NULL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    seconds     REAL,
+    error       TEXT,
+    updated     TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status);
+"""
+
+###################################################################################################
+#
+#                                            CLASSES
+#
+###################################################################################################
+class Course_Job(object):
+    ################################
+    #
+    # One course folder of a batch, as stored in the queue
+    #
+    ################################
+    def __init__(self, job_id, batch_id, data_folder, status, attempts, settings):
+
+        self.job_id      = job_id
+        self.batch_id    = batch_id
+        self.data_folder = data_folder
+        self.status      = status
+        self.attempts    = attempts
+        self.settings    = settings # Pipeline settings of the batch (grid_size, cell_size, fit_method)
+
+
+class Course_Queue(object):
+    ################################
+    #
+    # SQLite queue of course jobs
+    #
+    # Only the scheduling process opens the queue, worker processes report back through it.
+    # Every change is committed straight away so the queue survives the process being stopped.
+    #
+    ################################
+    def __init__(self, queue_file=QUEUE_FILE):
+
+        self.connection = sqlite3.connect(str(queue_file))
+        self.connection.executescript(QUEUE_SCHEMA)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def add_batch(self, data_folders, settings):
+        # Adds a batch of pending jobs, returns its id
+        now = time.strftime("%Y-%m-%d %H:%M:%S")
+
+        with self.connection:
+            batch_id = self.connection.execute("INSERT INTO batches (created, settings) VALUES (?, ?)",
+                                               (now, json.dumps(settings, sort_keys=True))).lastrowid
+            self.connection.executemany("INSERT INTO jobs (batch_id, data_folder, status, updated) VALUES (?, ?, ?, ?)",
+                                        [(batch_id, str(data_folder), PENDING, now) for data_folder in data_folders])
+
+        return batch_id
+
+    def requeue_running(self):
+        # Returns jobs left running by a stopped run to the queue, their attempt still counts
+        with self.connection:
+            return self.connection.execute("UPDATE jobs SET status = ?, updated = ? WHERE status = ?",
+                                           (PENDING, time.strftime("%Y-%m-%d %H:%M:%S"), RUNNING)).rowcount
+
+    def next_pending(self):
+        # Oldest pending job, None when the queue is empty
+        row = self.connection.execute("SELECT jobs.id, batch_id, data_folder, status, attempts, settings FROM jobs "
+                                      "JOIN batches ON batches.id = jobs.batch_id WHERE status = ? ORDER BY jobs.id LIMIT 1",
+                                      (PENDING,)).fetchone()
+
+        if row is None:
+            return None
+
+        return Course_Job(row[0], row[1], row[2], row[3], row[4], json.loads(row[5]))
+
+    def count(self, status):
+        return self.connection.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+    def update(self, job, status, seconds=None, error=None, attempted=False):
+        # Stores the new status of a job, attempted counts a new run of it
+        job.status = status
+        job.attempts += 1 if attempted else 0
+
+        with self.connection:
+            self.connection.execute("UPDATE jobs SET status = ?, attempts = ?, seconds = ?, error = ?, updated = ? WHERE id = ?",
+                                    (status, job.attempts, seconds, error, time.strftime("%Y-%m-%d %H:%M:%S"), job.job_id))
+
+    def summary(self):
+        # (data folder, status, attempts, seconds, error) of every job, newest batch first
+        return self.connection.execute("SELECT data_folder, status, attempts, seconds, error FROM jobs "
+                                       "ORDER BY batch_id DESC, id").fetchall()
+
+
+###################################################################################################
+#
+#                                            FUNCTIONS
+#
+###################################################################################################
+def is_course_folder(data_folder):
+    # Whether a folder holds an exported ply file or a Metashape project to run the pipeline on
+    return Path(data_folder, "output", PLY_FILE).exists() or (Path(data_folder).is_dir() and find_project_file(data_folder) is not None)
+
+
+def expand_course_folders(patterns):
+    #######################################
+    #
+    # Course folders matching a list of folders and glob patterns, in the order given
+    #
+    ######################################
+    data_folders = []
+    for pattern in patterns:
+        for data_folder in sorted(glob.glob(pattern)) or [pattern]:
+            if not is_course_folder(data_folder):
+                print("Skipping " + data_folder + ", it has no exported ply file or Metashape project")
+                continue
+
+            if data_folder not in data_folders:
+                data_folders.append(data_folder)
+
+    return data_folders
+
+
+def run_job(job_id, data_folder, settings, log_file, results):
+    #######################################
+    #
+    # Worker process of one job, runs the pipeline of a course
+    #
+    # Input: job id, course folder, batch settings, file for the job output, queue the error (or
+    #        None) is reported on
+    #
+    ######################################
+    with open(log_file, "w") as log:
+        sys.stdout = sys.stderr = log
+
+        try:
+            grid_size_x, grid_size_y = settings["grid_size"]
+            grid_spec = Grid_Spec(grid_size_x, grid_size_y, settings["cell_size"])
+
+            run_pipeline(Path(data_folder, "inputs"), Path(data_folder, "output"), grid_spec, settings["fit_method"])
+            results.put((job_id, None))
+
+        except Exception:
+            traceback.print_exc()
+            results.put((job_id, traceback.format_exc(limit=-1).strip().splitlines()[-1]))
+
+    return
+
+
+def collect_results(results, errors, job_id=None, wait=0):
+    # Moves the results posted by workers into errors (job id -> error or None), waiting up to
+    # wait seconds for the result of job_id
+    deadline = time.perf_counter() + wait
+
+    while True:
+        try:
+            posted_id, error = results.get_nowait()
+            errors[posted_id] = error
+            continue
+        except Empty:
+            pass
+
+        remaining = deadline - time.perf_counter()
+        if job_id is None or job_id in errors or remaining <= 0:
+            return
+
+        try:
+            posted_id, error = results.get(timeout=remaining)
+            errors[posted_id] = error
+        except Empty:
+            return
+
+
+def finish_job(queue, job, seconds, error, retries):
+    # Marks a finished job done, or failed and back in the queue while it has retries left
+    if error is None:
+        queue.update(job, DONE, seconds)
+    elif job.attempts <= retries:
+        queue.update(job, PENDING, seconds, error)
+    else:
+        queue.update(job, FAILED, seconds, error)
+
+    return job.status
+
+
+def run_queue(queue, workers=1, timeout=JOB_TIMEOUT, retries=JOB_RETRIES, log_folder=LOG_FOLDER):
+    #######################################
+    #
+    # Runs every pending job of the queue with a bounded pool of worker processes
+    #
+    # Each job runs in its own process so a job past its timeout can be stopped without
+    # stopping the other jobs.
+    #
+    # Input: Course_Queue, number of worker processes, seconds a job may run, times a failed
+    #        job is run again, folder of the job output
+    # Returns: None
+    #
+    ######################################
+    Path(log_folder).mkdir(parents=True, exist_ok=True)
+
+    requeued = queue.requeue_running()
+    if requeued:
+        print("Resuming " + str(requeued) + " jobs left running by a stopped run\n")
+
+    results = multiprocessing.Queue()
+    errors = {}
+    running = {} # job id -> (Course_Job, process, start time)
+
+    progress = tqdm(total=queue.count(PENDING), desc="Courses")
+
+    while True:
+        # Start pending jobs while workers are free
+        while len(running) < workers:
+            job = queue.next_pending()
+            if job is None:
+                break
+
+            queue.update(job, RUNNING, attempted=True)
+
+            log_file = Path(log_folder, str(job.job_id) + "_" + str(job.attempts) + ".log")
+            process = multiprocessing.Process(target=run_job, args=(job.job_id, job.data_folder, job.settings, log_file, results))
+            process.start()
+            running[job.job_id] = (job, process, time.perf_counter())
+
+        if not running:
+            break
+
+        time.sleep(POLL_SECONDS)
+
+        collect_results(results, errors)
+
+        for job_id, (job, process, start) in list(running.items()):
+            seconds = time.perf_counter() - start
+
+            if process.is_alive():
+                if seconds <= timeout:
+                    continue
+
+                process.terminate()
+                process.join()
+                error = "Timed out after " + str(timeout) + " seconds"
+
+            else:
+                process.join()
+
+                # The worker may post its result after the results were collected above
+                collect_results(results, errors, job_id, RESULT_WAIT if process.exitcode == 0 else 0)
+
+                if job_id in errors:
+                    error = errors.pop(job_id)
+                elif process.exitcode == 0:
+                    progress.write("Finished " + job.data_folder + " without reporting a result")
+                    error = None
+                else:
+                    error = "Worker exited with code " + str(process.exitcode)
+
+            del running[job_id]
+
+            if finish_job(queue, job, seconds, error, retries) == PENDING:
+                progress.write("Retrying " + job.data_folder + ": " + error)
+            else:
+                progress.update()
+
+    progress.close()
+
+    return
+
+
+def print_queue(queue):
+    # Prints the status of every job in the queue
+    print('{:<48}{:>10}{:>10}{:>12}  {}'.format("Course", "Status", "Attempts", "Time (s)", "Error"))
+    for data_folder, status, attempts, seconds, error in queue.summary():
+        print('{:<48}{:>10}{:>10}{:>12}  {}'.format(data_folder, status, attempts,
+                                                     '{:.1f}'.format(seconds) if seconds is not None else "-", error or ""))
+
+    return
+
+
+# Insertion point
+if __name__ == '__main__':
+    # Read in arguments
+    parser = argparse.ArgumentParser(description='Run the pipeline over many course folders from a persistent job queue')
+    parser.add_argument('data_folders', metavar='folder', type=str, nargs='*', help='Course folders or glob patterns (Eg. "Data/*"), leave out to resume the queue')
+    parser.add_argument('--queue_file', metavar='file', type=str, default=QUEUE_FILE, help='SQLite job queue')
+    parser.add_argument('--workers', metavar='count', type=int, default=1, help='Number of courses run at once')
+    parser.add_argument('--timeout', metavar='seconds', type=float, default=JOB_TIMEOUT, help='Seconds a course may run before it is stopped')
+    parser.add_argument('--retries', metavar='count', type=int, default=JOB_RETRIES, help='Times a failed course is run again')
+    parser.add_argument('--grid_size', metavar='count', type=int, nargs=2, default=[GRID_SIZE_X, GRID_SIZE_Y], help='Number of grid areas along x and y')
+    parser.add_argument('--cell_size', metavar='metres', type=float, default=None, help='Grid area size in metres, overrides --grid_size')
+    parser.add_argument('--fit_method', type=str, choices=sorted(FIT_METHODS), default=FIT_METHOD, help='Plane of best fit method')
+
+    args = parser.parse_args()
+
+    queue = Course_Queue(args.queue_file)
+
+    try:
+        if args.data_folders:
+            settings = {"grid_size": args.grid_size, "cell_size": args.cell_size, "fit_method": args.fit_method}
+            queue.add_batch(expand_course_folders(args.data_folders), settings)
+
+        run_queue(queue, args.workers, args.timeout, args.retries)
+
+        print()
+        print_queue(queue)
+
+    finally:
+        queue.close()
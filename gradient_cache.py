@@ -0,0 +1,160 @@
+###################################################################################################
+#
+#                                       GRADIENT CACHE
+#
+#
+# Stores calculated gradient grids on disk so re-rendering an unchanged green skips the slope fit
+# Authors: Jayden Cole & Ryan Stolys
+# Creation date: 2022-06-30
+#
+# Algorithm:
+#   1. Fingerprint the ply file and the settings used to fit it
+#   2. Load the gradient grid stored under that fingerprint, if there is one
+#   3. Otherwise store the newly calculated grid, evicting the least recently used grids
+#
+###################################################################################################
+import os
+import json
+import time
+import hashlib
+import numpy as np
+
+from pathlib import Path
+
+###################################################################################################
+#
+#                                            CONSTANTS
+#
+###################################################################################################
+GRADIENT_CACHE_FOLDER = "gradient_cache"
+GRADIENT_CACHE_ENTRIES = 32     # Grids kept before the least recently used are evicted
+
+GRADIENT_EXTENSION = ".npy"
+METADATA_EXTENSION = ".json"
+
+HASH_BLOCK_SIZE = 2**20
+
+###################################################################################################
+#
+#                                            CLASSES
+#
+###################################################################################################
+class Gradient_Cache(object):
+    ################################
+    #
+    # Folder of gradient grids keyed on the ply file and fit settings that produced them
+    #
+    # Each entry is a <key>.npy gradient grid and a <key>.json description of its source.
+    # A changed ply file or grid size gives a new key, so a stale grid is never read. Old
+    # entries are evicted in least recently used order.
+    #
+    ################################
+    def __init__(self, cache_folder, max_entries=GRADIENT_CACHE_ENTRIES, hash_contents=False):
+
+        self.cache_folder  = Path(cache_folder)
+        self.max_entries   = max_entries
+        self.hash_contents = hash_contents # Hash the whole ply file instead of its path, size and modified time
+
+    def key(self, ply_file, grid, fit_method):
+        # Fingerprint of the ply file and fit settings
+        metadata = self.describe(ply_file, grid, fit_method)
+
+        return hashlib.sha256(json.dumps(metadata, sort_keys=True).encode()).hexdigest()
+
+    def describe(self, ply_file, grid, fit_method):
+        # Everything that determines the gradient grid of a ply file
+        return {
+            "source":      fingerprint_file(ply_file, self.hash_contents),
+            "grid":        grid,
+            "fit_method":  fit_method,
+        }
+
+    def load(self, ply_file, grid, fit_method):
+        # Memory maps the cached gradient grid, returns None when there is no valid entry
+        key = self.key(ply_file, grid, fit_method)
+        gradient_file = Path(self.cache_folder, key + GRADIENT_EXTENSION)
+        metadata_file = Path(self.cache_folder, key + METADATA_EXTENSION)
+
+        if not (gradient_file.exists() and metadata_file.exists()):
+            return None
+
+        with open(metadata_file, "r") as file_handle:
+            metadata = json.load(file_handle)
+
+        if metadata.get("key") != self.describe(ply_file, grid, fit_method):
+            return None
+
+        gradients = np.load(gradient_file, mmap_mode='r')
+
+        if gradients.ndim != 3 or gradients.shape[-1] != 3:
+            return None
+
+        # Mark the entry as recently used
+        os.utime(gradient_file)
+
+        return gradients
+
+    def store(self, ply_file, grid, fit_method, gradients):
+        # Writes the gradient grid under its key, then evicts the least recently used entries
+        self.cache_folder.mkdir(parents=True, exist_ok=True)
+
+        key = self.key(ply_file, grid, fit_method)
+        gradient_file = Path(self.cache_folder, key + GRADIENT_EXTENSION)
+        metadata_file = Path(self.cache_folder, key + METADATA_EXTENSION)
+
+        metadata = {
+            "key":     self.describe(ply_file, grid, fit_method),
+            "ply_file": str(ply_file),
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+        # Write to temporary files first so a partly written entry is never loaded
+        temp_gradient_file = Path(self.cache_folder, key + ".tmp" + GRADIENT_EXTENSION)
+        np.save(temp_gradient_file, np.asarray(gradients, dtype=np.float64))
+        with open(Path(self.cache_folder, key + ".tmp" + METADATA_EXTENSION), "w") as file_handle:
+            json.dump(metadata, file_handle, indent=4)
+
+        os.replace(temp_gradient_file, gradient_file)
+        os.replace(Path(self.cache_folder, key + ".tmp" + METADATA_EXTENSION), metadata_file)
+
+        self.evict()
+
+        return gradient_file
+
+    def evict(self):
+        # Removes the least recently used entries beyond max_entries
+        entries = sorted(self.cache_folder.glob("*" + GRADIENT_EXTENSION), key=lambda entry: entry.stat().st_mtime, reverse=True)
+
+        for gradient_file in entries[self.max_entries:]:
+            gradient_file.unlink()
+            metadata_file = gradient_file.with_suffix(METADATA_EXTENSION)
+            if metadata_file.exists():
+                metadata_file.unlink()
+
+        return
+
+
+###################################################################################################
+#
+#                                            FUNCTIONS
+#
+###################################################################################################
+def fingerprint_file(file_path, hash_contents=False):
+    ################################
+    #
+    # Identifies a version of a file
+    # Input: File location, whether to hash the file contents
+    # Output: sha256 of the contents, or the resolved path, size and modified time
+    #
+    ################################
+    if hash_contents:
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as file_handle:
+            for block in iter(lambda: file_handle.read(HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+
+        return "sha256:" + digest.hexdigest()
+
+    stats = os.stat(file_path)
+
+    return str(Path(file_path).resolve()) + ":" + str(stats.st_size) + ":" + str(stats.st_mtime_ns)
@@ -0,0 +1,226 @@
+###################################################################################################
+#
+#                                       GREEN RENDERER
+#
+#
+# Draws green slope maps (heat map of slope magnitude with a quiver plot of slope direction)
+# without a display, so slope maps can be rendered on a server
+# Authors: Jayden Cole & Ryan Stolys
+# Creation date: 2022-07-04
+#
+# Algorithm:
+#   1. Create one Agg figure and canvas
+#   2. For each green, clear the axes and draw its heat map and quiver plot
+#   3. Save the figure as a PNG or SVG, chosen by the file extension
+#
+###################################################################################################
+import argparse
+import numpy as np
+
+from tqdm import tqdm
+from pathlib import Path
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+###################################################################################################
+#
+#                                            CONSTANTS
+#
+###################################################################################################
+X = 0
+Y = 1
+Z = 2
+
+IMAGE_FORMATS = (".png", ".svg")
+IMAGE_DPI = 100
+FIGURE_SIZE = (6.4, 4.8)        # Inches, matches the pyplot default
+
+HEAT_MAP_CMAP = "jet"
+HEAT_MAP_INTERPOLATION = "hanning"
+HEAT_MAP_LIMITS = (0.0, 5.0)
+
+# Interpolcation methods = [None, 'none', 'nearest', 'bilinear', 'bicubic',
+# 'spline16', 'spline36', 'hanning', 'hamming', 'hermite', 'kaiser', 'quadric',
+# 'catrom', 'gaussian', 'bessel', 'mitchell', 'sinc', 'lanczos']
+
+# Quiver settings of the calculated slope maps and the ground truth maps
+GRADIENT_QUIVER = {"scale": 2, "scale_units": "xy", "pivot": "mid"}
+GROUND_TRUTH_QUIVER = {"scale": 5, "scale_units": "inches"}
+
+###################################################################################################
+#
+#                                            CLASSES
+#
+###################################################################################################
+class Green_Layers(object):
+    ################################
+    #
+    # Arrays drawn for one green, every array is indexed [row, column] in image order
+    #
+    # mag is the heat map, u and v the arrow components. x and y are the arrow positions, when
+    # None the arrows are placed at the grid area indices.
+    #
+    ################################
+    def __init__(self, mag, u, v, x=None, y=None, quiver=GRADIENT_QUIVER):
+
+        self.mag    = np.asarray(mag, dtype=float)
+        self.u      = np.asarray(u, dtype=float)
+        self.v      = np.asarray(v, dtype=float)
+        self.x      = x
+        self.y      = y
+        self.quiver = quiver
+
+
+class Green_Renderer(object):
+    ################################
+    #
+    # One Agg figure reused for every green it renders
+    #
+    # Only the axes contents are redrawn for each green, the figure, canvas and colour bar axes
+    # are created once. No pyplot state is touched, so no display is needed.
+    #
+    ################################
+    def __init__(self, figure_size=FIGURE_SIZE, dpi=IMAGE_DPI):
+
+        self.figure        = Figure(figsize=figure_size, dpi=dpi)
+        self.canvas        = FigureCanvasAgg(self.figure)
+        self.axes          = self.figure.add_subplot(1, 1, 1)
+        self.colorbar_axes = None
+
+    def draw(self, layers):
+        # Replaces the axes contents with the heat map and quiver plot of a green
+        self.axes.clear()
+
+        image = draw_green(self.axes, layers)
+
+        if self.colorbar_axes is None:
+            self.colorbar_axes = self.figure.colorbar(image, ax=self.axes).ax
+        else:
+            self.colorbar_axes.clear()
+            self.figure.colorbar(image, cax=self.colorbar_axes)
+
+        return
+
+    def render(self, layers, image_file):
+        # Draws a green and saves it, the image format is taken from the file extension
+        image_file = Path(image_file)
+        assert image_file.suffix.lower() in IMAGE_FORMATS, "Images are rendered as " + " or ".join(IMAGE_FORMATS)
+
+        self.draw(layers)
+        self.figure.savefig(image_file)
+
+        return image_file
+
+    def render_batch(self, greens):
+        # Renders (layers, image_file) pairs with the one figure
+        image_files = []
+        for layers, image_file in tqdm(greens, desc="Rendering greens"):
+            image_files.append(self.render(layers, image_file))
+
+        return image_files
+
+
+###################################################################################################
+#
+#                                            FUNCTIONS
+#
+###################################################################################################
+def draw_green(axes, layers):
+    #######################################
+    #
+    # Draws the heat map and quiver plot of a green onto a set of axes
+    #
+    # Input: matplotlib axes, Green_Layers of the green
+    # Returns: the heat map image, for the colour bar
+    #
+    ######################################
+    if layers.x is None:
+        axes.quiver(layers.u, layers.v, **layers.quiver)
+    else:
+        axes.quiver(layers.x, layers.y, layers.u, layers.v, **layers.quiver)
+
+    image = axes.imshow(layers.mag, cmap=HEAT_MAP_CMAP, interpolation=HEAT_MAP_INTERPOLATION)
+    image.set_clim(*HEAT_MAP_LIMITS)
+
+    return image
+
+
+def gradient_layers(gradients):
+    #######################################
+    #
+    # Heat map and arrows of a calculated gradient grid
+    #
+    # Input: gradient grid of shape (GRID_SIZE_Y, GRID_SIZE_X, 3)
+    # Returns: Green_Layers, rows flipped so north is at the top of the image
+    #
+    ######################################
+    gradients = np.asarray(gradients)[::-1]
+
+    mag = np.abs(gradients[:, :, Z]) * 100 # Convert rise/run to degrees (Eg. 0.01 rise/1 run = 1 degree)
+    u   = gradients[:, :, X]
+    v   = -gradients[:, :, Y] # Y positive axis is downward, flip to get arrows in correct direction
+
+    return Green_Layers(mag, u, v, quiver=GRADIENT_QUIVER)
+
+
+def unit_arrows(u, v):
+    #######################################
+    #
+    # Scales arrows to unit length, zero length arrows are left as zero
+    #
+    ######################################
+    u = np.asarray(u, dtype=float)
+    v = np.asarray(v, dtype=float)
+    length = np.hypot(u, v)
+
+    scale = np.divide(1.0, length, out=np.zeros_like(length), where=length > 0)
+
+    return u*scale, v*scale
+
+
+def ground_truth_layers(mag, EW_vect, NS_vect):
+    #######################################
+    #
+    # Heat map and unit arrows of a ground truth green
+    #
+    # Input: slope magnitude, EW vector (west positive) and NS vector (south positive) grids
+    # Returns: Green_Layers with arrows at the grid area indices
+    #
+    ######################################
+    mag = np.asarray(mag, dtype=float)
+    grid_size_y, grid_size_x = mag.shape
+
+    u, v = unit_arrows(EW_vect, NS_vect)
+
+    return Green_Layers(mag, u, v, np.arange(grid_size_x), np.arange(grid_size_y), GROUND_TRUTH_QUIVER)
+
+
+def render_gradient_files(gradient_files, output_folder, image_format=".png"):
+    #######################################
+    #
+    # Renders stored gradient grids (.npy) to images with one reused figure
+    #
+    # Input: gradient grid files, folder for the images, image file extension
+    # Returns: list of image files
+    #
+    ######################################
+    Path(output_folder).mkdir(parents=True, exist_ok=True)
+
+    greens = ((gradient_layers(np.load(gradient_file, mmap_mode='r')),
+               Path(output_folder, Path(gradient_file).stem + image_format))
+              for gradient_file in gradient_files)
+
+    return Green_Renderer().render_batch(list(greens))
+
+
+# Insertion point
+if __name__ == '__main__':
+    # Read in arguments
+    parser = argparse.ArgumentParser(description='Render stored gradient grids to slope map images')
+    parser.add_argument('gradient_files', metavar='file', type=str, nargs='+', help='Gradient grid .npy files')
+    parser.add_argument('--output_folder', metavar='folder', type=str, default='.', help='Folder to write the images to')
+    parser.add_argument('--format', type=str, choices=IMAGE_FORMATS, default=IMAGE_FORMATS[0], help='Image format')
+
+    args = parser.parse_args()
+
+    render_gradient_files(args.gradient_files, args.output_folder, args.format)
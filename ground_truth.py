@@ -0,0 +1,308 @@
+###################################################################################################
+#
+#                                  GROUND TRUTH MODULE
+#
+#
+# Reads in a CSV file containing ground truth slope data and creates green map
+# The position of each measurement on the green grid comes from a layout file, so a new course
+# only needs its CSV file and layout file.
+# Authors: Jayden Cole & Ryan Stolys
+# Creation date: 2022-07-05
+#
+# Algorithm:
+#   1. Read the grid layout of the green
+#   2. Read the measurements from the CSV file into arrays
+#   3. Place every measurement in its grid area and compute its slope magnitude and direction
+#   4. Output graphical interpretation of the slopes on the green
+#
+###################################################################################################
+import csv
+import json
+import argparse
+import numpy as np
+import matplotlib.pyplot as plt
+
+from green_renderer import Green_Renderer, draw_green, ground_truth_layers
+
+###################################################################################################
+#
+#                                            CONSTANTS
+#
+###################################################################################################
+# CSV file format: Measurement Number,EW Slope,Down/Up,NS Slope,Down/Up,Column Number
+MEASUREMENT_COLUMN = 0
+EW_MAG_COLUMN = 1
+EW_DIR_COLUMN = 2
+NS_MAG_COLUMN = 3
+NS_DIR_COLUMN = 4
+GRID_COLUMN_COLUMN = 5
+
+# Record of one measurement, directions are +1 or -1
+SURVEY_DTYPE = np.dtype([
+    ("measurement", np.int32),
+    ("EW_mag", np.float64), ("EW_dir", np.int8),
+    ("NS_mag", np.float64), ("NS_dir", np.int8),
+    ("column", np.int16),
+])
+
+###################################################################################################
+#
+#                                            CLASSES
+#
+###################################################################################################
+class Green_Layout(object):
+    ################################
+    #
+    # Where the measurements of a green sit on its grid, read from a layout file
+    #
+    # Measurements are taken up each grid column in turn. Column c starts at row start_rows[c]
+    # and continues down the column, passing over any (column, row) in skipped_cells.
+    #
+    # Layout file format (json):
+    #   grid_size:          [GRID_SIZE_X, GRID_SIZE_Y]
+    #   first_column:       Column Number the CSV file uses for grid column 0
+    #   positive_direction: Down/Up value of a positive slope
+    #   start_rows:         First row of each grid column
+    #   skipped_cells:      [column, row] grid areas passed over inside a column
+    #   print_grids:        Print the magnitude and direction grids after loading (optional)
+    #   origin:             [x, y] of the north west corner of the grid, in the point cloud
+    #                       coordinates (optional)
+    #   cell_size:          Grid area size in point cloud units (optional)
+    #
+    ################################
+    def __init__(self, layout_file):
+
+        with open(layout_file, "r") as file_handle:
+            layout = json.load(file_handle)
+
+        self.grid_size_x, self.grid_size_y = layout["grid_size"]
+        self.first_column       = layout["first_column"]
+        self.positive_direction = layout["positive_direction"]
+        self.start_rows         = np.asarray(layout["start_rows"], dtype=int)
+        self.skipped_cells      = sorted(tuple(cell) for cell in layout.get("skipped_cells", []))
+        self.print_grids        = layout.get("print_grids", False)
+        self.origin             = layout.get("origin")
+        self.cell_size          = layout.get("cell_size")
+
+        assert len(self.start_rows) == self.grid_size_x, "Layout needs a start row for every grid column"
+
+
+class Survey_Data(object):
+    ################################
+    #
+    # Ground truth measurements, one record per CSV row
+    #
+    # The measurements are held in one record array (SURVEY_DTYPE), the attributes are views of
+    # its fields. EW_dir is 1 for a west slope, NS_dir is 1 for a south slope.
+    #
+    ################################
+    def __init__(self, num_points):
+
+        self.num_points  = num_points
+        self.points      = np.zeros(num_points, dtype=SURVEY_DTYPE)
+        self.measurement = self.points['measurement']
+        self.EW_mag      = self.points['EW_mag']
+        self.EW_dir      = self.points['EW_dir']
+        self.NS_mag      = self.points['NS_mag']
+        self.NS_dir      = self.points['NS_dir']
+        self.column      = self.points['column']
+
+    def EW_vect(self):
+        # Returns the EW vectors where west is positive
+        return self.EW_mag * self.EW_dir
+
+    def NS_vect(self):
+        # Returns the NS vectors where south is positive
+        return self.NS_mag * self.NS_dir
+
+    def magnitude(self):
+        # Returns the slope magnitude of every measurement
+        return np.hypot(self.EW_mag, self.NS_mag)
+
+    def direction(self):
+        # Returns theta of every measurement where theta = 0 is directly west and theta = 90 is directly south
+        return np.arctan2(self.NS_vect(), self.EW_vect())
+
+
+class Green_Grid(object):
+    ################################
+    #
+    # Ground truth slopes of a green, indexed [row, column]
+    #
+    # Grids are column-major, matching the order the measurements are taken in. valid marks the
+    # grid areas with a measurement, the other grid areas are left as 0.
+    #
+    ################################
+    def __init__(self, grid_size_x, grid_size_y):
+
+        self.grid_size_x = grid_size_x
+        self.grid_size_y = grid_size_y
+        self.valid       = np.zeros((grid_size_y, grid_size_x), dtype=bool, order='F')
+        self.mag         = np.zeros((grid_size_y, grid_size_x), order='F')
+        self.direction   = np.zeros((grid_size_y, grid_size_x), order='F') # theta = 0 is directly west, theta = 90 is directly south
+        self.EW_vect     = np.zeros((grid_size_y, grid_size_x), order='F')
+        self.NS_vect     = np.zeros((grid_size_y, grid_size_x), order='F')
+
+
+###################################################################################################
+#
+#                                            FUNCTIONS
+#
+###################################################################################################
+def read_csv_file(csv_file, layout):
+    ################################
+    #
+    # Read in a csv file of ground truth measurements, store that data into memory
+    # Input: Absolute File location (str), Green_Layout of the green
+    # Output: Survey_Data of the measurements
+    #
+    ################################
+    print('Reading file: ', csv_file)
+
+    with open(csv_file, newline='') as csvFile:
+        # skip the first line (it is a header), later fields are notes
+        rows = [row[:GRID_COLUMN_COLUMN + 1] for row in list(csv.reader(csvFile))[1:] if row]
+
+    fields = np.array(rows, dtype=str).reshape(-1, GRID_COLUMN_COLUMN + 1)
+
+    data = Survey_Data(len(fields))
+    data.measurement[:] = fields[:, MEASUREMENT_COLUMN].astype(int)
+    data.EW_mag[:]      = fields[:, EW_MAG_COLUMN].astype(float)
+    data.NS_mag[:]      = fields[:, NS_MAG_COLUMN].astype(float)
+    data.column[:]      = fields[:, GRID_COLUMN_COLUMN].astype(int) - layout.first_column
+
+    # Down/Up gives the sign of each slope, west and south are positive
+    data.EW_dir[:] = np.where(np.char.strip(fields[:, EW_DIR_COLUMN]) == layout.positive_direction, -1, 1)
+    data.NS_dir[:] = np.where(np.char.strip(fields[:, NS_DIR_COLUMN]) == layout.positive_direction, 1, -1)
+
+    print('Finished reading file\n')
+    return data
+
+
+def grid_rows(data, layout):
+    #######################################
+    #
+    # Row of every measurement on the green grid
+    #
+    # Measurements are in column order, each one is placed below the previous measurement of its
+    # column, passing over skipped grid areas.
+    #
+    ######################################
+    assert np.all(np.diff(data.column) >= 0), "Measurements must be listed column by column"
+    assert np.all((data.column >= 0) & (data.column < layout.grid_size_x)), "Measurement column outside of the grid"
+
+    # Position of each measurement within its column
+    column_starts = np.searchsorted(data.column, data.column, side='left')
+    rows = layout.start_rows[data.column] + np.arange(data.num_points) - column_starts
+
+    for column, row in layout.skipped_cells:
+        rows[(data.column == column) & (rows >= row)] += 1
+
+    assert np.all(rows < layout.grid_size_y), "Measurement row outside of the grid"
+
+    return rows
+
+
+def create_green_grid(data, layout):
+    #######################################
+    #
+    # Places every measurement on the green grid and computes its slope
+    #
+    # Input: Survey_Data of the measurements, Green_Layout of the green
+    # Returns: Green_Grid of the green
+    #
+    ######################################
+    rows = grid_rows(data, layout)
+
+    green = Green_Grid(layout.grid_size_x, layout.grid_size_y)
+
+    green.valid[rows, data.column]     = True
+    green.EW_vect[rows, data.column]   = data.EW_vect()
+    green.NS_vect[rows, data.column]   = data.NS_vect()
+    green.mag[rows, data.column]       = data.magnitude()
+    green.direction[rows, data.column] = data.direction()
+
+    if layout.print_grids:
+        print_grid(green.mag, '{:6.2f}')
+        print()
+        print()
+        print_grid(green.direction, '{:5.2f}  ')
+
+    return green
+
+
+def print_grid(array_2d, formatting):
+    #######################################
+    #
+    # Prints a 2D array as a grid
+    #
+    ######################################
+    for row in array_2d:
+        print_row = "";
+        for val in row:
+            print_row += formatting.format(val)
+        print(print_row)
+
+    return
+
+
+def plot_green(green, image_file=None):
+    #######################################
+    #
+    # Plots the green slopes in a quiver plot
+    #
+    # Input: Green_Grid of the green, image file (optional)
+    # Returns: None
+    # Output: Heat map and quiver plot, saved to image_file (.png or .svg) without a display
+    #         when given, otherwise shown in a window
+    #
+    ######################################
+
+    # Arrows are normalized for the quiver plot
+    layers = ground_truth_layers(green.mag, green.EW_vect, green.NS_vect)
+
+    if image_file is not None:
+        Green_Renderer().render(layers, image_file)
+        return
+
+    # Plot
+    figure, axes = plt.subplots()
+    image = draw_green(axes, layers)
+    figure.colorbar(image, ax=axes)
+
+    plt.show()
+
+    return
+
+
+def load_green_grid(csv_file, layout_file):
+    #######################################
+    #
+    # Reads a ground truth CSV file onto the grid given by its layout file
+    #
+    ######################################
+    layout = Green_Layout(layout_file)
+
+    data = read_csv_file(csv_file, layout)
+
+    return create_green_grid(data, layout)
+
+
+def generate_slope_map(csv_file, layout_file, image_file=None):
+
+    green = load_green_grid(csv_file, layout_file)
+
+    plot_green(green, image_file)
+
+
+# Insertion point
+if __name__ == '__main__':
+    # Read in arguments
+    parser = argparse.ArgumentParser(description='Find green map from ground truth data, formatted in csv file')
+    parser.add_argument('csv_file', metavar='file', type=str, help='Path to csv file')
+    parser.add_argument('layout_file', metavar='layout', type=str, help='Path to the layout file of the green')
+    parser.add_argument('--image_file', metavar='file', type=str, default=None, help='Save the green map to a .png or .svg instead of showing it')
+
+    args = parser.parse_args()
+
+    generate_slope_map(args.csv_file, args.layout_file, args.image_file)
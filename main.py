@@ -8,37 +8,61 @@
 # Creation date: 2022-03-29
 #
 # Algorithm:
-#   1. Run Metashape pipeline
-#   2. Run the slope model generation script
+#   1. Tag the images with their GPS data
+#   2. Find the Metashape reconstruction and read its point cloud
+#   3. Bin and fit the slope grid
+#   4. Score the slope map against ground truth, when given, and render it
+#
+# Each step is a stage of pipeline_stages.py, re-running a course only runs the stages whose
+# inputs changed.
 #
 ###################################################################################################
 import argparse
 
 from pathlib import Path
-from slope_model_generation import generate_slope_map
-
-STORE_GRADIENTS = True
-READ_GRADIENTS = True
+from pipeline_stages import Course_Config, run_course
+from pipeline_profiler import enable_profiling, finish_profiling, PROFILE_FILE
+from slope_model_generation import Grid_Spec, Decimation_Spec, FIT_METHODS, FIT_METHOD, GRID_SIZE_X, GRID_SIZE_Y, DECIMATION_METHODS, \
+                                   DECIMATION_VOXEL, DECIMATION_SEED
 
-def run_pipeline(input_folder, output_folder):
+def run_pipeline(input_folder, output_folder, grid_spec=None, fit_method=FIT_METHOD, csv_file=None, layout_file=None, force=False,
+                 decimation=None):
     ########################################
     #
     # Run the pipeline
     #
     ########################################
-    # 1. Run Metashape Pipeline
+    config = Course_Config(input_folder, output_folder, grid_spec, fit_method, csv_file, layout_file, decimation)
 
-    # 2. Run the slope model generation script
-    generate_slope_map(output_folder, STORE_GRADIENTS, not READ_GRADIENTS)
+    return run_course(config, force)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Run the full image processing pipeline')
     parser.add_argument('data_folder', metavar='folder', type=str, default=Path('Data', 'EagleQuest_hole0'), help='Path to input folder')
+    parser.add_argument('--grid_size', metavar='count', type=int, nargs=2, default=[GRID_SIZE_X, GRID_SIZE_Y], help='Number of grid areas along x and y')
+    parser.add_argument('--cell_size', metavar='metres', type=float, default=None, help='Grid area size in metres, overrides --grid_size')
+    parser.add_argument('--fit_method', type=str, choices=sorted(FIT_METHODS), default=FIT_METHOD, help='Plane of best fit method')
+    parser.add_argument('--csv_file', metavar='file', type=str, default=None, help='Ground truth csv file, the slope map is scored when given with --layout_file')
+    parser.add_argument('--layout_file', metavar='layout', type=str, default=None, help='Layout file of the ground truth green')
+    parser.add_argument('--force', action='store_true', help='Run every stage, even when its inputs are unchanged')
+    parser.add_argument('--density', metavar='count', type=float, default=None, help='Decimate the cloud to this many verticies per square metre before fitting')
+    parser.add_argument('--decimation', type=str, choices=DECIMATION_METHODS, default=DECIMATION_VOXEL, help='Decimation method')
+    parser.add_argument('--seed', metavar='seed', type=int, default=DECIMATION_SEED, help='Random seed of the decimation')
+    parser.add_argument('--profile', metavar='file', type=str, nargs='?', const=PROFILE_FILE, default=None, help='Record timing spans, counters and memory peaks to a Chrome trace file')
 
     args = parser.parse_args()
 
     input_folder = Path(args.data_folder, "inputs")
     output_folder = Path(args.data_folder, "output")
 
-    run_pipeline(input_folder, output_folder)
+    grid_spec = Grid_Spec(args.grid_size[0], args.grid_size[1], args.cell_size)
+    decimation = Decimation_Spec(args.density, args.decimation, args.seed) if args.density else None
+
+    if args.profile:
+        enable_profiling()
+
+    run_pipeline(input_folder, output_folder, grid_spec, args.fit_method, args.csv_file, args.layout_file, args.force, decimation)
+
+    if args.profile:
+        finish_profiling(args.profile)
\ No newline at end of file
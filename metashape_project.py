@@ -0,0 +1,366 @@
+###################################################################################################
+#
+#                                       METASHAPE PROJECT
+#
+#
+# Reads the point cloud of a Metashape project (.psx and its .files archives) straight into the
+# slope pipeline, so no ply file has to be exported and copied by hand
+# Authors: Jayden Cole & Ryan Stolys
+# Creation date: 2022-07-08
+#
+# Algorithm:
+#   1. Follow the project, chunk and frame documents to the archive holding the point cloud,
+#      using the dense cloud when it is stored as ply files and the tie point cloud otherwise
+#   2. Stream the ply members out of the archive, without extracting them to disk
+#   3. Move the verticies into the chunk coordinates, and onto a local east, north, up frame
+#      when the chunk is georeferenced
+#   4. Cache the decoded arrays beside the project so later runs skip steps 1 - 3
+#   5. Fit and plot the slope map
+#
+###################################################################################################
+import json
+import hashlib
+import zipfile
+import argparse
+import numpy as np
+import xml.etree.ElementTree as ET
+
+from pathlib import Path
+from gradient_cache import fingerprint_file, GRADIENT_CACHE_FOLDER
+from point_cloud_cache import write_cloud_file, COORDINATE_COLUMNS, NORMAL_COLUMNS, POINT_CLOUD_EXTENSION
+from slope_model_generation import Surface_Data, Grid_Spec, read_ply_stream, read_cloud_data, create_gradient_grid, plot_green, \
+                                   FIT_METHODS, FIT_METHOD, NORMAL_FIT_METHODS, GRID_SIZE_X, GRID_SIZE_Y, X
+
+###################################################################################################
+#
+#                                            CONSTANTS
+#
+###################################################################################################
+PROJECT_EXTENSION = ".psx"
+PROJECT_FOLDER_EXTENSION = ".files"
+PROJECT_ARCHIVE = "project.zip"
+DOCUMENT_MEMBER = "doc.xml"
+PLY_EXTENSION = ".ply"
+
+DENSE_CLOUD = "dense_cloud"
+POINT_CLOUD = "point_cloud"
+
+CLOUD_CACHE_FOLDER = "cloud_cache"
+
+LOCAL_REFERENCE = "LOCAL_CS"    # Chunk coordinates already in local metres, every other reference is geocentric
+
+# WGS 84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1/298.257223563
+
+###################################################################################################
+#
+#                                            CLASSES
+#
+###################################################################################################
+class Project_Cloud(object):
+    ################################
+    #
+    # Where the point cloud of a Metashape project is stored
+    #
+    # members are the ply files of the cloud inside archive. transform is the 4 x 4 matrix from
+    # the internal coordinates of the cloud to the chunk coordinates, None when the chunk has no
+    # transform. geocentric marks chunk coordinates that are earth centred rather than local.
+    #
+    ################################
+    def __init__(self, kind, archive, members, chunk_archive, transform=None, geocentric=False):
+
+        self.kind          = kind
+        self.archive       = Path(archive)
+        self.members       = members
+        self.chunk_archive = Path(chunk_archive) # Holds the transform, part of the cache key
+        self.transform     = transform
+        self.geocentric    = geocentric
+
+
+###################################################################################################
+#
+#                                            FUNCTIONS
+#
+###################################################################################################
+def read_archive_document(archive_file):
+    # Parses the doc.xml describing a Metashape archive
+    with zipfile.ZipFile(archive_file) as archive:
+        return ET.fromstring(archive.read(DOCUMENT_MEMBER))
+
+
+def find_project_file(data_folder):
+    ################################
+    #
+    # Finds the Metashape project of a data folder
+    # Input: Data folder path
+    # Output: .psx file, None when the folder has no project
+    #
+    ################################
+    project_files = sorted(Path(data_folder).glob("*" + PROJECT_EXTENSION))
+
+    assert len(project_files) <= 1, "Data folder has more than one Metashape project: " + str(data_folder)
+
+    return project_files[0] if project_files else None
+
+
+def chunk_transform(chunk):
+    ################################
+    #
+    # Transform from the internal coordinates of a chunk to its reference coordinates
+    # Input: chunk document element
+    # Output: 4 x 4 matrix, None when the chunk has no transform
+    #
+    ################################
+    element = chunk.find("transform")
+
+    if element is None or element.find("rotation") is None:
+        return None
+
+    rotation    = np.array(element.find("rotation").text.split(), dtype=np.float64).reshape(3, 3)
+    translation = np.array(element.find("translation").text.split(), dtype=np.float64)
+    scale       = float(element.find("scale").text) if element.find("scale") is not None else 1.0
+
+    transform = np.eye(4)
+    transform[:3, :3] = scale*rotation
+    transform[:3, 3]  = translation
+
+    return transform
+
+
+def local_frame_transform(origin):
+    ################################
+    #
+    # Transform from earth centred coordinates to east, north, up metres about an origin
+    # Input: earth centred origin (x, y, z)
+    # Output: 4 x 4 matrix
+    #
+    ################################
+    x, y, z = origin
+    b = WGS84_A*(1 - WGS84_F)
+    e2 = WGS84_F*(2 - WGS84_F)
+    ep2 = (WGS84_A**2 - b**2)/b**2
+
+    # Geodetic latitude (Bowring), so up is normal to the ellipsoid rather than the earth centre
+    p = np.hypot(x, y)
+    theta = np.arctan2(z*WGS84_A, p*b)
+    lat = np.arctan2(z + ep2*b*np.sin(theta)**3, p - e2*WGS84_A*np.cos(theta)**3)
+    lon = np.arctan2(y, x)
+
+    rotation = np.array([
+        [-np.sin(lon),              np.cos(lon),             0          ],
+        [-np.sin(lat)*np.cos(lon), -np.sin(lat)*np.sin(lon), np.cos(lat)],
+        [ np.cos(lat)*np.cos(lon),  np.cos(lat)*np.sin(lon), np.sin(lat)],
+    ])
+
+    transform = np.eye(4)
+    transform[:3, :3] = rotation
+    transform[:3, 3]  = -rotation @ np.asarray(origin)
+
+    return transform
+
+
+def locate_project_cloud(project_file):
+    ################################
+    #
+    # Follows the documents of a Metashape project to its point cloud
+    #
+    # The dense cloud is used when it is stored as ply files. Newer Metashape versions store it
+    # as an octree (.oc3) that cannot be decoded here, the tie point cloud is used instead.
+    #
+    # Input: .psx file
+    # Output: Project_Cloud of the active chunk
+    #
+    ################################
+    project_folder = Path(project_file).with_suffix(PROJECT_FOLDER_EXTENSION)
+
+    # Project -> active chunk -> first frame
+    project = read_archive_document(Path(project_folder, PROJECT_ARCHIVE))
+    chunks = project.find("chunks")
+    chunk_element = next(element for element in chunks.findall("chunk") if element.get("id") == chunks.get("active_id"))
+
+    chunk_archive = Path(project_folder, chunk_element.get("path"))
+    chunk = read_archive_document(chunk_archive)
+
+    frame_element = chunk.find("frames").find("frame")
+    frame_archive = Path(chunk_archive.parent, frame_element.get("path"))
+    frame = read_archive_document(frame_archive)
+
+    reference = chunk.find("reference")
+    transform = chunk_transform(chunk)
+    geocentric = transform is not None and not (reference is not None and reference.text.strip().startswith(LOCAL_REFERENCE))
+
+    dense_element = frame.find(DENSE_CLOUD)
+    if dense_element is not None:
+        archive = Path(frame_archive.parent, dense_element.get("path"))
+        tiles = [tile.get("path") for tile in read_archive_document(archive).iter("tile")]
+        members = [tile for tile in tiles if tile.endswith(PLY_EXTENSION)]
+
+        if members:
+            return Project_Cloud(DENSE_CLOUD, archive, members, chunk_archive, transform, geocentric)
+
+        print("Dense cloud is stored as " + ", ".join(tiles) + ", which cannot be decoded. Using the tie point cloud\n")
+
+    point_element = frame.find(POINT_CLOUD)
+    assert point_element is not None, "Metashape project has no point cloud: " + str(project_file)
+
+    archive = Path(frame_archive.parent, point_element.get("path"))
+    members = [points.get("path") for points in read_archive_document(archive).findall("points")]
+    assert members, "Metashape point cloud has no points: " + str(archive)
+
+    return Project_Cloud(POINT_CLOUD, archive, members, chunk_archive, transform, geocentric)
+
+
+def transform_cloud(s_data, transform):
+    #######################################
+    #
+    # Applies a 4 x 4 transform to the verticies (and the normals) of a cloud in place
+    #
+    ######################################
+    linear = transform[:3, :3]
+    xyz = np.stack(s_data.coordinates())
+
+    s_data.set_coordinates(*(linear @ xyz + transform[:3, 3:]))
+
+    if s_data.nx is not None:
+        # Normals only turn with the cloud, the scale is removed so they stay unit length
+        rotation = linear/np.cbrt(np.linalg.det(linear))
+        normals = np.stack((s_data.nx, s_data.ny, s_data.nz))
+        s_data.nx, s_data.ny, s_data.nz = (rotation @ normals).astype(s_data.nx.dtype)
+
+    return s_data
+
+
+def decode_project_cloud(cloud, normals=False):
+    #######################################
+    #
+    # Streams the ply members of a project cloud out of their archive
+    #
+    # Input: Project_Cloud, whether to read the vertex normals
+    # Returns: Surface_Data in chunk coordinates, or east, north, up metres when the chunk is
+    #          georeferenced
+    #
+    ######################################
+    print('Reading archive: ', cloud.archive)
+
+    parts = []
+    with zipfile.ZipFile(cloud.archive) as archive:
+        for member in cloud.members:
+            with archive.open(member) as plyFile:
+                parts.append(read_ply_stream(plyFile, normals))
+
+    s_data = Surface_Data(0, normals=normals)
+    s_data.set_coordinates(np.concatenate([part.x for part in parts]), np.concatenate([part.y for part in parts]),
+                           np.concatenate([part.z for part in parts]))
+
+    if normals:
+        s_data.nx = np.concatenate([part.nx for part in parts])
+        s_data.ny = np.concatenate([part.ny for part in parts])
+        s_data.nz = np.concatenate([part.nz for part in parts])
+
+    if cloud.transform is not None:
+        transform = cloud.transform
+
+        if cloud.geocentric and len(s_data.stored[X]):
+            # Centre the local frame on the cloud, composed into one transform so the earth
+            # centred coordinates (millions of metres) are never formed
+            centre = transform @ np.append(s_data.mean(), 1)
+            transform = local_frame_transform(centre[:3]) @ transform
+
+        transform_cloud(s_data, transform)
+
+    print('Finished reading archive: ' + str(len(s_data.stored[X])) + ' verticies from ' + str(len(cloud.members)) + ' ' + cloud.kind + ' files\n')
+    return s_data
+
+
+def cloud_cache_key(cloud, normals):
+    # Fingerprint of the archives and members a decoded cloud came from
+    description = {
+        "archive":       fingerprint_file(cloud.archive),
+        "chunk_archive": fingerprint_file(cloud.chunk_archive),
+        "members":       cloud.members,
+        "normals":       normals,
+    }
+
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def load_project_cloud(project_file, normals=False, cache_folder=None):
+    #######################################
+    #
+    # Reads the point cloud of a Metashape project, through the decoded cloud cache
+    #
+    # Input: .psx file, whether to read the vertex normals, folder of decoded clouds (None
+    #        to always decode the archive)
+    # Returns: Project_Cloud, Surface_Data of the cloud
+    #
+    ######################################
+    cloud = locate_project_cloud(project_file)
+
+    if cache_folder is None:
+        return cloud, decode_project_cloud(cloud, normals)
+
+    cloud_file = Path(cache_folder, cloud_cache_key(cloud, normals) + POINT_CLOUD_EXTENSION)
+    names = COORDINATE_COLUMNS + (NORMAL_COLUMNS if normals else ())
+
+    s_data = read_cloud_data(cloud_file, names)
+
+    if s_data is not None:
+        print("Reading decoded cloud from cache: " + str(cloud_file) + "\n")
+        return cloud, s_data
+
+    s_data = decode_project_cloud(cloud, normals)
+
+    Path(cache_folder).mkdir(parents=True, exist_ok=True)
+    write_cloud_file(cloud_file, {name: getattr(s_data, name) for name in names})
+
+    print("Stored decoded cloud in cache: " + str(cloud_file) + "\n")
+
+    # Load what was stored so every run fits exactly the same verticies
+    return cloud, read_cloud_data(cloud_file, names)
+
+
+def generate_project_slope_map(project_file, store_gradients, read_gradients, workers=1, grid_spec=None, image_file=None,
+                               fit_method=FIT_METHOD):
+    #######################################
+    #
+    # Calls all the functions needed to create the green map of a Metashape project
+    #
+    ######################################
+    project_folder = Path(project_file).parent
+
+    cloud, data = load_project_cloud(project_file, fit_method in NORMAL_FIT_METHODS, Path(project_folder, CLOUD_CACHE_FOLDER))
+
+    # Gradients are cached on the archive the cloud was read from
+    gradient_grid = create_gradient_grid(cloud.archive, store_gradients, read_gradients, workers, None,
+                                         Path(project_folder, GRADIENT_CACHE_FOLDER), grid_spec, fit_method, data)
+
+    plot_green(gradient_grid, image_file)
+
+    return
+
+
+# Insertion point
+if __name__ == '__main__':
+    # Read in arguments
+    parser = argparse.ArgumentParser(description='Find slopes from the point cloud of a Metashape project')
+    parser.add_argument('project_file', metavar='file', type=str, help='Metashape project (.psx) or the data folder holding it')
+    parser.add_argument('--store_gradients', action='store_true', help='Store calculated gradients in the gradient cache')
+    parser.add_argument('--read_gradients', action='store_true', help='Get gradients from the gradient cache when this cloud and grid were already fit')
+    parser.add_argument('--workers', metavar='count', type=int, default=1, help='Number of worker processes used to fit the grid')
+    parser.add_argument('--grid_size', metavar='count', type=int, nargs=2, default=[GRID_SIZE_X, GRID_SIZE_Y], help='Number of grid areas along x and y')
+    parser.add_argument('--cell_size', metavar='metres', type=float, default=None, help='Grid area size in metres, overrides --grid_size')
+    parser.add_argument('--image_file', metavar='file', type=str, default=None, help='Save the slope map to a .png or .svg instead of showing it')
+    parser.add_argument('--fit_method', type=str, choices=sorted(FIT_METHODS), default=FIT_METHOD, help='Plane of best fit method')
+
+    args = parser.parse_args()
+
+    project_file = Path(args.project_file)
+    if project_file.suffix != PROJECT_EXTENSION:
+        project_file = find_project_file(project_file)
+        assert project_file is not None, "No Metashape project in: " + args.project_file
+
+    grid_spec = Grid_Spec(args.grid_size[0], args.grid_size[1], args.cell_size)
+
+    generate_project_slope_map(project_file, args.store_gradients, args.read_gradients, args.workers, grid_spec, args.image_file,
+                               args.fit_method)
@@ -0,0 +1,281 @@
+###################################################################################################
+#
+#                                       PIPELINE PROFILER
+#
+#
+# Timing spans, counters and memory high water marks for the pipeline, exported as a Chrome trace
+# (chrome://tracing or https://ui.perfetto.dev)
+# Authors: Jayden Cole & Ryan Stolys
+# Creation date: 2022-07-11
+#
+# Algorithm:
+#   1. Profiled functions check one module global, when profiling is off they are called as is
+#   2. When profiling is on each call is a span, recording its wall time, the counters added
+#      within it and the peak memory allocated within it
+#   3. Spans and counter totals are written to a Chrome trace JSON file and printed as a table
+#
+# Spans are recorded from the main thread, the worker processes of tiled fits are not traced.
+#
+###################################################################################################
+import os
+import json
+import time
+import functools
+import threading
+import contextlib
+import tracemalloc
+
+from pathlib import Path
+
+###################################################################################################
+#
+#                                            CONSTANTS
+#
+###################################################################################################
+PROFILE_FILE = "profile_trace.json"
+
+MICROSECONDS = 1e6              # Chrome trace timestamps are in microseconds
+BYTES_PER_MB = 2**20
+
+###################################################################################################
+#
+#                                            CLASSES
+#
+###################################################################################################
+class Memory_Tracker(object):
+    ################################
+    #
+    # Peak memory allocated within nested sections, measured with tracemalloc
+    #
+    # tracemalloc holds one peak, so the peak is folded into every open section and reset
+    # whenever a section begins or ends. Each section keeps the memory in use when it began and
+    # the highest peak seen while it was open.
+    #
+    ################################
+    def __init__(self):
+
+        self.sections = []      # [memory in use at the start, peak] of each open section
+        self.started  = False   # Whether tracing was started here, and so is stopped here
+
+    def fold_peak(self):
+        _, peak = tracemalloc.get_traced_memory()
+
+        for section in self.sections:
+            section[1] = max(section[1], peak)
+
+        tracemalloc.reset_peak()
+
+    def begin(self):
+        if not self.sections and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started = True
+
+        self.fold_peak()
+
+        current, _ = tracemalloc.get_traced_memory()
+        self.sections.append([current, current])
+
+    def end(self):
+        # Returns the peak bytes allocated within the section that is ending
+        self.fold_peak()
+
+        start, peak = self.sections.pop()
+
+        if not self.sections and self.started:
+            tracemalloc.stop()
+            self.started = False
+
+        return peak - start
+
+
+class Profiler(object):
+    ################################
+    #
+    # Spans and counters of one profiled run
+    #
+    # Spans are stored as Chrome trace complete events ("X"), the counter totals at the end of
+    # each span as counter events ("C").
+    #
+    ################################
+    def __init__(self):
+
+        self.events   = []
+        self.counters = {}
+        self.open     = []      # (name, start time, counters at the start) of each open span
+        self.start    = time.perf_counter()
+        self.pid      = os.getpid()
+        self.memory   = memory_tracker()
+
+    def timestamp(self):
+        return (time.perf_counter() - self.start)*MICROSECONDS
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def begin(self, name):
+        self.memory.begin()
+        self.open.append((name, self.timestamp(), dict(self.counters)))
+
+    def end(self):
+        name, start, counters = self.open.pop()
+        end = self.timestamp()
+        peak_memory = self.memory.end()
+
+        # Counters added within the span
+        args = {counter: value - counters.get(counter, 0) for counter, value in self.counters.items() if value != counters.get(counter, 0)}
+        args["peak_memory_mb"] = peak_memory/BYTES_PER_MB
+
+        tid = threading.get_ident()
+        self.events.append({"name": name, "ph": "X", "ts": start, "dur": end - start, "pid": self.pid, "tid": tid, "args": args})
+
+        if self.counters:
+            self.events.append({"name": "counters", "ph": "C", "ts": end, "pid": self.pid, "tid": tid, "args": dict(self.counters)})
+
+    @contextlib.contextmanager
+    def span(self, name):
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end()
+
+
+###################################################################################################
+#
+#                                            FUNCTIONS
+#
+###################################################################################################
+_profiler = None # Profiler of the current run, None when profiling is off
+_memory = None   # Memory_Tracker shared by every measurement, tracemalloc holds a single peak
+
+
+def memory_tracker():
+    # The shared Memory_Tracker, sections measured with it nest with the profiled spans
+    global _memory
+    if _memory is None:
+        _memory = Memory_Tracker()
+
+    return _memory
+
+
+def enable_profiling():
+    # Starts recording spans and counters, returns the Profiler
+    global _profiler
+    _profiler = Profiler()
+
+    return _profiler
+
+
+def disable_profiling():
+    # Stops recording, returns the Profiler of the run (None if profiling was off)
+    global _profiler
+    profiler, _profiler = _profiler, None
+
+    return profiler
+
+
+def profiling_enabled():
+    return _profiler is not None
+
+
+def count(name, value=1):
+    # Adds to a counter, does nothing when profiling is off
+    if _profiler is not None:
+        _profiler.count(name, value)
+
+
+def span(name):
+    # Context manager timing a block of code as a span
+    if _profiler is None:
+        return contextlib.nullcontext()
+
+    return _profiler.span(name)
+
+
+def profiled(function):
+    ################################
+    #
+    # Decorator recording each call of a function as a span named after it
+    #
+    # When profiling is off the only cost is a check of the module global.
+    #
+    ################################
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _profiler is None:
+            return function(*args, **kwargs)
+
+        with _profiler.span(function.__name__):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def summarize_spans(profiler):
+    ################################
+    #
+    # Totals of every span name of a run
+    # Input: Profiler
+    # Output: dictionary of span name to calls, total seconds and highest peak memory (MB), in
+    #         order of first call
+    #
+    ################################
+    summary = {}
+    for event in profiler.events:
+        if event["ph"] != "X":
+            continue
+
+        totals = summary.setdefault(event["name"], {"calls": 0, "seconds": 0.0, "peak_memory_mb": 0.0})
+        totals["calls"] += 1
+        totals["seconds"] += event["dur"]/MICROSECONDS
+        totals["peak_memory_mb"] = max(totals["peak_memory_mb"], event["args"]["peak_memory_mb"])
+
+    return summary
+
+
+def print_profile(profiler):
+    # Prints the span totals and counters of a run
+    print('{:<28}{:>8}{:>12}{:>16}'.format("Span", "Calls", "Time (s)", "Peak mem (MB)"))
+    for name, totals in summarize_spans(profiler).items():
+        print('{:<28}{:>8}{:>12.3f}{:>16.1f}'.format(name, totals["calls"], totals["seconds"], totals["peak_memory_mb"]))
+
+    if profiler.counters:
+        print()
+        for name, value in profiler.counters.items():
+            print('{:<28}{:>12}'.format(name, value))
+
+    return
+
+
+def export_trace(profiler, trace_file=PROFILE_FILE):
+    # Writes the spans and counters of a run as a Chrome trace JSON file
+    trace = {
+        "traceEvents":     profiler.events,
+        "displayTimeUnit": "ms",
+        "otherData":       {"counters": profiler.counters, "spans": summarize_spans(profiler)},
+    }
+
+    with open(trace_file, "w") as file_handle:
+        json.dump(trace, file_handle)
+
+    return Path(trace_file)
+
+
+def finish_profiling(trace_file=PROFILE_FILE):
+    #######################################
+    #
+    # Stops profiling, prints the profile and exports its trace
+    #
+    ######################################
+    profiler = disable_profiling()
+
+    if profiler is None:
+        return None
+
+    print()
+    print_profile(profiler)
+
+    trace_file = export_trace(profiler, trace_file)
+    print("\nStored profile trace: " + str(trace_file))
+
+    return trace_file
@@ -0,0 +1,474 @@
+###################################################################################################
+#
+#                                       PIPELINE STAGES
+#
+#
+# Runs the course pipeline as a graph of stages with on-disk artifacts, so re-running a course only
+# executes the stages whose inputs changed
+# Authors: Jayden Cole & Ryan Stolys
+# Creation date: 2022-07-09
+#
+# Algorithm:
+#   1. Fingerprint each stage from its settings, the source files it reads and the fingerprints
+#      of the stages producing its input artifacts
+#   2. Skip a stage whose fingerprint matches the manifest and whose artifacts are all on disk
+#   3. Otherwise run it, recording its wall time and peak memory
+#   4. Store the fingerprints and measurements in the manifest of the work folder
+#
+###################################################################################################
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+
+from pathlib import Path
+from gradient_cache import fingerprint_file
+from point_cloud_cache import write_cloud_file, COORDINATE_COLUMNS, NORMAL_COLUMNS, POINT_CLOUD_EXTENSION
+from pipeline_profiler import span, memory_tracker
+from add_GPS_to_images import add_GPS_metadata, list_image_files, GPS_FILE
+from green_renderer import Green_Renderer, gradient_layers
+from slope_scoring import score_slope_map, print_report
+from metashape_project import find_project_file, locate_project_cloud, load_project_cloud
+from slope_model_generation import Grid_Spec, Grid_Index, read_ply_file, read_cloud_data, calculate_bounds, bin_surface, \
+                                   decimate_surface, count_fits, FIT_METHODS, FIT_METHOD, NORMAL_FIT_METHODS, PLY_FILE, STORAGE_FLOAT32
+
+###################################################################################################
+#
+#                                            CONSTANTS
+#
+###################################################################################################
+PIPELINE_FOLDER = "pipeline"
+MANIFEST_FILE = "pipeline_manifest.json"
+
+# Artifact file types, every artifact is stored as <name><extension> in the work folder
+ARTIFACT_TYPES = {
+    "gps_tags":       ".json",  # Images tagged with GPS data
+    "reconstruction": ".json",  # Where the reconstructed point cloud is stored
+    "cloud":          POINT_CLOUD_EXTENSION, # Vertex coordinates (and normals) as float32 columns
+    "sample":         POINT_CLOUD_EXTENSION, # The cloud after decimation, the cloud itself without it
+    "grid_index":     ".npz",   # Grid_Index of the verticies
+    "gradients":      ".npz",   # Gradient grid, valid fit mask and grid area edges
+    "score":          ".json",  # Score report against ground truth
+    "slope_map":      ".png",   # Rendered slope map
+}
+
+RAN = "ran"
+CACHED = "cached"
+SKIPPED = "skipped"
+
+BYTES_PER_MB = 2**20
+
+###################################################################################################
+#
+#                                            CLASSES
+#
+###################################################################################################
+class Course_Config(object):
+    ################################
+    #
+    # Settings of one course run through the pipeline
+    #
+    # csv_file and layout_file are the ground truth of the green, scoring is skipped without them.
+    # decimation is the Decimation_Spec the cloud is thinned with before binning, None to fit
+    # every vertex.
+    #
+    ################################
+    def __init__(self, input_folder, output_folder, grid_spec=None, fit_method=FIT_METHOD, csv_file=None, layout_file=None,
+                 decimation=None):
+
+        self.input_folder  = Path(input_folder)
+        self.output_folder = Path(output_folder)
+        self.grid_spec     = grid_spec if grid_spec is not None else Grid_Spec()
+        self.fit_method    = fit_method
+        self.csv_file      = csv_file
+        self.layout_file   = layout_file
+        self.decimation    = decimation
+
+    def normals(self):
+        # Whether the fit method needs the vertex normals
+        return self.fit_method in NORMAL_FIT_METHODS
+
+
+class Stage(object):
+    ################################
+    #
+    # One step of the pipeline
+    #
+    # function(config, inputs, outputs) is called with the files of its input and output
+    # artifacts. params(config) are the settings that change its result, sources(config) the
+    # files outside the pipeline it reads and enabled(config) whether it runs for a course.
+    # A stage that rewrites_sources is fingerprinted again after it runs, so the files it
+    # changed are not mistaken for new ones on the next run.
+    #
+    ################################
+    def __init__(self, name, function, inputs=(), outputs=(), params=None, sources=None, enabled=None, rewrites_sources=False):
+
+        self.name     = name
+        self.function = function
+        self.inputs   = list(inputs)
+        self.outputs  = list(outputs)
+        self.params   = params if params is not None else (lambda config: {})
+        self.sources  = sources if sources is not None else (lambda config: [])
+        self.enabled  = enabled if enabled is not None else (lambda config: True)
+        self.rewrites_sources = rewrites_sources
+
+        for artifact in self.inputs + self.outputs:
+            assert artifact in ARTIFACT_TYPES, "Unknown artifact: " + artifact
+
+
+class Stage_Record(object):
+    ################################
+    #
+    # Outcome of one stage in a pipeline run
+    #
+    ################################
+    def __init__(self, name, status, fingerprint=None, seconds=0.0, peak_memory=0):
+
+        self.name        = name
+        self.status      = status
+        self.fingerprint = fingerprint
+        self.seconds     = seconds
+        self.peak_memory = peak_memory # Bytes allocated at the peak of the stage
+
+    def describe(self):
+        return {"status": self.status, "fingerprint": self.fingerprint, "seconds": self.seconds,
+                "peak_memory_mb": self.peak_memory/BYTES_PER_MB}
+
+
+class Pipeline_Runner(object):
+    ################################
+    #
+    # Runs stages in order, skipping the stages whose inputs are unchanged since the last run
+    #
+    # The manifest of the work folder holds the fingerprint each stage last ran with. Artifact
+    # fingerprints are the fingerprint of the stage producing them, so a changed setting or
+    # source file re-runs its stage and every stage downstream of it.
+    #
+    ################################
+    def __init__(self, stages, work_folder, force=False):
+
+        self.stages      = stages
+        self.work_folder = Path(work_folder)
+        self.force       = force # Run every stage, ignoring the manifest
+
+        produced = set()
+        for stage in stages:
+            for artifact in stage.inputs:
+                assert artifact in produced, "Stage " + stage.name + " reads " + artifact + " before it is produced"
+            produced.update(stage.outputs)
+
+    def artifact_file(self, artifact):
+        return Path(self.work_folder, artifact + ARTIFACT_TYPES[artifact])
+
+    def read_manifest(self):
+        manifest_file = Path(self.work_folder, MANIFEST_FILE)
+
+        if not manifest_file.exists():
+            return {}
+
+        with open(manifest_file, "r") as file_handle:
+            return json.load(file_handle)
+
+    def write_manifest(self, manifest):
+        with open(Path(self.work_folder, MANIFEST_FILE), "w") as file_handle:
+            json.dump(manifest, file_handle, indent=4)
+
+    def fingerprint(self, stage, config, artifact_fingerprints):
+        # Fingerprint of everything that determines the outputs of a stage
+        description = {
+            "stage":   stage.name,
+            "params":  stage.params(config),
+            "sources": [fingerprint_file(source) for source in stage.sources(config)],
+            "inputs":  {artifact: artifact_fingerprints[artifact] for artifact in stage.inputs},
+        }
+
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def run(self, config):
+        #######################################
+        #
+        # Runs the pipeline for one course
+        #
+        # Input: Course_Config of the course
+        # Returns: list of Stage_Record
+        #
+        ######################################
+        self.work_folder.mkdir(parents=True, exist_ok=True)
+        manifest = self.read_manifest()
+
+        records = []
+        artifact_fingerprints = {}
+        for stage in self.stages:
+            if not stage.enabled(config):
+                records.append(Stage_Record(stage.name, SKIPPED))
+                continue
+
+            for artifact in stage.inputs:
+                assert artifact in artifact_fingerprints, "Stage " + stage.name + " needs " + artifact + " from a skipped stage"
+
+            fingerprint = self.fingerprint(stage, config, artifact_fingerprints)
+            inputs  = {artifact: self.artifact_file(artifact) for artifact in stage.inputs}
+            outputs = {artifact: self.artifact_file(artifact) for artifact in stage.outputs}
+
+            previous = manifest.get(stage.name, {})
+            up_to_date = previous.get("fingerprint") == fingerprint and all(output.exists() for output in outputs.values())
+
+            if up_to_date and not self.force:
+                record = Stage_Record(stage.name, CACHED, fingerprint)
+            else:
+                print("Running stage: " + stage.name + "\n")
+
+                memory = memory_tracker()
+                memory.begin()
+                start = time.perf_counter()
+                try:
+                    with span(stage.name):
+                        stage.function(config, inputs, outputs)
+                    seconds = time.perf_counter() - start
+                finally:
+                    peak_memory = memory.end()
+
+                if stage.rewrites_sources:
+                    fingerprint = self.fingerprint(stage, config, artifact_fingerprints)
+
+                for artifact, output in outputs.items():
+                    assert output.exists(), "Stage " + stage.name + " did not write " + artifact
+
+                record = Stage_Record(stage.name, RAN, fingerprint, seconds, peak_memory)
+
+                # Store after every stage so a failed run keeps the stages that finished
+                manifest[stage.name] = record.describe()
+                manifest[stage.name]["finished"] = time.strftime("%Y-%m-%d %H:%M:%S")
+                self.write_manifest(manifest)
+
+            for artifact in stage.outputs:
+                artifact_fingerprints[artifact] = fingerprint
+
+            records.append(record)
+
+        return records
+
+
+###################################################################################################
+#
+#                                            FUNCTIONS
+#
+###################################################################################################
+def print_records(records):
+    # Prints the status, wall time and peak memory of every stage of a run
+    print('{:<16}{:>10}{:>12}{:>14}'.format("Stage", "Status", "Time (s)", "Peak mem (MB)"))
+    for record in records:
+        if record.status == RAN:
+            print('{:<16}{:>10}{:>12.3f}{:>14.1f}'.format(record.name, record.status, record.seconds, record.peak_memory/BYTES_PER_MB))
+        else:
+            print('{:<16}{:>10}{:>12}{:>14}'.format(record.name, record.status, "-", "-"))
+
+    return
+
+
+def write_json(json_file, contents):
+    with open(json_file, "w") as file_handle:
+        json.dump(contents, file_handle, indent=4)
+
+
+def read_json(json_file):
+    with open(json_file, "r") as file_handle:
+        return json.load(file_handle)
+
+
+def save_cloud(cloud_file, s_data):
+    # Stores the vertex coordinates (and the normals when loaded) of a cloud
+    columns = {name: getattr(s_data, name) for name in COORDINATE_COLUMNS + NORMAL_COLUMNS if getattr(s_data, name) is not None}
+
+    write_cloud_file(cloud_file, columns)
+
+
+def load_cloud(cloud_file):
+    # Memory maps a stored cloud as compact float32 coordinates, with its bounding box from the file header
+    s_data = read_cloud_data(cloud_file, storage=STORAGE_FLOAT32)
+    assert s_data is not None, "Unreadable cloud artifact: " + str(cloud_file)
+
+    return s_data
+
+
+def save_grid_index(index_file, index):
+    with open(index_file, "wb") as file_handle:
+        np.savez(file_handle, x_edges=index.x_edges, y_edges=index.y_edges, cells=index.cells, points=index.points)
+
+
+def load_grid_index(index_file):
+    with np.load(index_file) as arrays:
+        return Grid_Index(arrays["x_edges"], arrays["y_edges"], arrays["cells"], arrays["points"])
+
+
+def save_gradients(gradient_file, gradients, valid, x_edges, y_edges):
+    with open(gradient_file, "wb") as file_handle:
+        np.savez(file_handle, gradients=gradients, valid=valid, x_edges=x_edges, y_edges=y_edges)
+
+
+def load_gradients(gradient_file):
+    # Returns the gradient grid, valid fit mask and grid area edges
+    with np.load(gradient_file) as arrays:
+        return arrays["gradients"], arrays["valid"], arrays["x_edges"], arrays["y_edges"]
+
+
+def locate_reconstruction(config):
+    ################################
+    #
+    # Finds the reconstructed point cloud of a course
+    # Input: Course_Config of the course
+    # Output: (kind, file), an exported ply file or the Metashape project
+    #
+    ################################
+    ply_file = Path(config.output_folder, PLY_FILE)
+    if ply_file.exists():
+        return "ply", ply_file
+
+    project_file = find_project_file(config.output_folder.parent)
+    assert project_file is not None, "Course has no exported ply file or Metashape project: " + str(config.output_folder.parent)
+
+    return "project", project_file
+
+
+def reconstruction_sources(config):
+    # The files the point cloud of a course is read from
+    kind, source = locate_reconstruction(config)
+
+    if kind == "ply":
+        return [source]
+
+    cloud = locate_project_cloud(source)
+
+    return [source, cloud.chunk_archive, cloud.archive]
+
+
+def tag_images(config, inputs, outputs):
+    # GPS tagging stage, writes the GPS file into the EXIF data of the images
+    add_GPS_metadata(config.input_folder)
+
+    write_json(outputs["gps_tags"], {"gps_file": str(Path(config.input_folder, GPS_FILE)),
+                                     "images": [image_file.name for image_file in list_image_files(config.input_folder)]})
+
+
+def find_reconstruction(config, inputs, outputs):
+    # Reconstruction stage, Metashape is run by hand so this records where its point cloud is
+    kind, source = locate_reconstruction(config)
+
+    write_json(outputs["reconstruction"], {"kind": kind, "file": str(source)})
+
+
+def ingest_cloud(config, inputs, outputs):
+    # Cloud ingest stage, decodes the point cloud into arrays
+    reconstruction = read_json(inputs["reconstruction"])
+
+    if reconstruction["kind"] == "ply":
+        s_data = read_ply_file(reconstruction["file"], config.normals())
+    else:
+        _, s_data = load_project_cloud(reconstruction["file"], config.normals())
+
+    save_cloud(outputs["cloud"], s_data)
+
+
+def decimate_cloud(config, inputs, outputs):
+    # Decimation stage, thins the cloud to the target density
+    if config.decimation is None:
+        # Share the cloud file, the ingest stage replaces rather than rewrites its artifact
+        if outputs["sample"].exists():
+            outputs["sample"].unlink()
+
+        try:
+            os.link(inputs["cloud"], outputs["sample"])
+        except OSError:
+            shutil.copyfile(inputs["cloud"], outputs["sample"])
+
+        return
+
+    save_cloud(outputs["sample"], decimate_surface(load_cloud(inputs["cloud"]), config.decimation))
+
+
+def bin_cloud(config, inputs, outputs):
+    # Binning stage, indexes the verticies of every grid area
+    s_data = load_cloud(inputs["sample"])
+
+    x_edges, y_edges = config.grid_spec.edges(calculate_bounds(s_data))
+
+    save_grid_index(outputs["grid_index"], bin_surface(s_data, x_edges, y_edges))
+
+
+def fit_grid(config, inputs, outputs):
+    # Fitting stage, fits the plane of every grid area
+    s_data = load_cloud(inputs["sample"])
+    index = load_grid_index(inputs["grid_index"])
+
+    assert config.fit_method in FIT_METHODS, "Unknown fit method: " + config.fit_method
+    gradients, valid = FIT_METHODS[config.fit_method](index, s_data, config.grid_spec)
+    count_fits(valid, index.cell_counts())
+
+    if not valid.all():
+        print(str(np.count_nonzero(~valid)) + " grid areas have too few points to fit a slope\n")
+
+    save_gradients(outputs["gradients"], gradients, valid, index.x_edges, index.y_edges)
+
+
+def score_grid(config, inputs, outputs):
+    # Scoring stage, compares the slope map with the ground truth of the green
+    gradients, valid, x_edges, y_edges = load_gradients(inputs["gradients"])
+
+    report = score_slope_map(gradients, valid, x_edges, y_edges, config.csv_file, config.layout_file, outputs["score"])
+
+    print_report(report)
+
+
+def render_grid(config, inputs, outputs):
+    # Rendering stage, draws the slope map
+    gradients, _, _, _ = load_gradients(inputs["gradients"])
+
+    Green_Renderer().render(gradient_layers(gradients), outputs["slope_map"])
+
+
+def course_stages():
+    #######################################
+    #
+    # The stage graph of a course, from images to a scored and rendered slope map
+    #
+    ######################################
+    return [
+        Stage("gps_tagging", tag_images, outputs=["gps_tags"],
+              sources=lambda config: [Path(config.input_folder, GPS_FILE)] + list_image_files(config.input_folder),
+              enabled=lambda config: Path(config.input_folder, GPS_FILE).exists(), rewrites_sources=True),
+        Stage("reconstruction", find_reconstruction, outputs=["reconstruction"],
+              sources=reconstruction_sources),
+        Stage("cloud_ingest", ingest_cloud, inputs=["reconstruction"], outputs=["cloud"],
+              params=lambda config: {"normals": config.normals()}),
+        Stage("decimation", decimate_cloud, inputs=["cloud"], outputs=["sample"],
+              params=lambda config: {"decimation": config.decimation.describe() if config.decimation is not None else None}),
+        Stage("binning", bin_cloud, inputs=["sample"], outputs=["grid_index"],
+              params=lambda config: {"grid": config.grid_spec.describe()}),
+        Stage("fitting", fit_grid, inputs=["sample", "grid_index"], outputs=["gradients"],
+              params=lambda config: {"grid": config.grid_spec.describe(), "fit_method": config.fit_method}),
+        Stage("scoring", score_grid, inputs=["gradients"], outputs=["score"],
+              sources=lambda config: [config.csv_file, config.layout_file],
+              enabled=lambda config: config.csv_file is not None and config.layout_file is not None),
+        Stage("rendering", render_grid, inputs=["gradients"], outputs=["slope_map"]),
+    ]
+
+
+def run_course(config, force=False):
+    #######################################
+    #
+    # Runs the stage graph of a course, artifacts are kept in <output folder>/pipeline
+    #
+    # Input: Course_Config of the course, whether to re-run unchanged stages
+    # Returns: list of Stage_Record
+    #
+    ######################################
+    runner = Pipeline_Runner(course_stages(), Path(config.output_folder, PIPELINE_FOLDER), force)
+
+    records = runner.run(config)
+
+    print()
+    print_records(records)
+
+    return records
@@ -0,0 +1,235 @@
+###################################################################################################
+#
+#                                       POINT CLOUD CACHE
+#
+#
+# Stores a decoded point cloud as contiguous float32 columns in a versioned binary file, so later
+# runs memory map the columns instead of parsing the ply file again
+# Authors: Jayden Cole & Ryan Stolys
+# Creation date: 2022-07-12
+#
+# Algorithm:
+#   1. Centre the coordinates on the middle of the cloud and store each column as float32
+#   2. Write a header with the format version, vertex count, bounding box, column layout and the
+#      fingerprint of the source file, followed by the columns
+#   3. On load, check the header against the source file and memory map the columns
+#
+# File layout:
+#   magic (8 bytes), version (uint32), header length (uint32), JSON header, padding, columns
+#   Every column starts on a CLOUD_ALIGNMENT byte boundary.
+#
+###################################################################################################
+import os
+import json
+import struct
+import numpy as np
+
+from pathlib import Path
+from gradient_cache import fingerprint_file
+
+###################################################################################################
+#
+#                                            CONSTANTS
+#
+###################################################################################################
+POINT_CLOUD_EXTENSION = ".cloud"
+
+CLOUD_MAGIC = b"SLOPECLD"
+CLOUD_VERSION = 1               # Files of any other version are rebuilt
+CLOUD_ALIGNMENT = 64            # Byte boundary every column starts on
+CLOUD_PREAMBLE = struct.Struct("<8sII") # Magic, version, header length
+OFFSET_DIGITS = 20              # Header room left for each column offset
+
+COORDINATE_COLUMNS = ("x", "y", "z")    # Stored relative to the origin of the header
+NORMAL_COLUMNS = ("nx", "ny", "nz")
+COLUMN_DTYPE = "<f4"
+
+###################################################################################################
+#
+#                                            CLASSES
+#
+###################################################################################################
+class Cloud_Header(object):
+    ################################
+    #
+    # Header of a point cloud file
+    #
+    # Coordinates are stored as float32 offsets from the origin, a green spans tens of metres
+    # so the offsets keep micrometre precision even when the origin is far from zero.
+    # bounds is (min x, max x, min y, max y, min z, max z) of the coordinates as they are loaded,
+    # source_bounds the same box of the coordinates before they were rounded to float32.
+    #
+    ################################
+    def __init__(self, num_verticies, origin, bounds, source_bounds, columns, source=None, data_offset=None):
+
+        self.num_verticies = num_verticies
+        self.origin        = tuple(origin)
+        self.bounds        = tuple(bounds)
+        self.source_bounds = tuple(source_bounds)
+        self.columns       = columns        # Column name -> (dtype, byte offset from the start of the file)
+        self.source        = source         # Fingerprint of the file the cloud was decoded from
+        self.data_offset   = data_offset    # Byte offset of the first column
+
+    def describe(self):
+        return {
+            "num_verticies": self.num_verticies,
+            "origin":        list(self.origin),
+            "bounds":        list(self.bounds),
+            "source_bounds": list(self.source_bounds),
+            "columns":       [{"name": name, "dtype": dtype, "offset": offset} for name, (dtype, offset) in self.columns.items()],
+            "source":        self.source,
+        }
+
+
+###################################################################################################
+#
+#                                            FUNCTIONS
+#
+###################################################################################################
+def cloud_file_for(source_file):
+    # Point cloud file kept next to the file it was decoded from
+    return Path(source_file).with_suffix(POINT_CLOUD_EXTENSION)
+
+
+def align(offset):
+    return -(-offset//CLOUD_ALIGNMENT)*CLOUD_ALIGNMENT
+
+
+def write_cloud_file(cloud_file, columns, source_file=None):
+    #######################################
+    #
+    # Writes columns of a point cloud to a point cloud file
+    #
+    # Input: file to write, dictionary of column name to array (x, y and z are required),
+    #        file the cloud was decoded from (optional, loads are checked against it)
+    # Returns: Cloud_Header of the file
+    #
+    ######################################
+    for name in COORDINATE_COLUMNS:
+        assert name in columns, "Point cloud has no " + name + " column"
+
+    num_verticies = len(columns["x"])
+    assert all(len(values) == num_verticies for values in columns.values()), "Point cloud columns differ in length"
+
+    # Centre the coordinates so float32 keeps their precision
+    stored = {}
+    origin = []
+    bounds = []
+    source_bounds = []
+    for name, values in columns.items():
+        values = np.asarray(values)
+
+        if name in COORDINATE_COLUMNS:
+            low, high = (float(np.min(values)), float(np.max(values))) if num_verticies else (0.0, 0.0)
+            centre = (low + high)/2
+            origin.append(centre)
+            source_bounds.extend([low, high])
+            values = np.subtract(values, centre, dtype=np.float64)
+
+        stored[name] = values.astype(COLUMN_DTYPE)
+
+    # Bounds of the coordinates exactly as they will be loaded, so every vertex falls inside the grid
+    for name, centre in zip(COORDINATE_COLUMNS, origin):
+        restored = stored[name].astype(np.float64) + centre
+        bounds.extend([float(np.min(restored)), float(np.max(restored))] if num_verticies else [0.0, 0.0])
+
+    source = fingerprint_file(source_file) if source_file is not None else None
+
+    # The header holds the column offsets, so lay the columns out after a header with room for them
+    layout = {name: (COLUMN_DTYPE, 0) for name in stored}
+    header = Cloud_Header(num_verticies, origin, bounds, source_bounds, layout, source)
+    data_offset = align(CLOUD_PREAMBLE.size + len(json.dumps(header.describe()).encode()) + OFFSET_DIGITS*len(stored))
+
+    offset = data_offset
+    for name, values in stored.items():
+        layout[name] = (COLUMN_DTYPE, offset)
+        offset = align(offset + values.nbytes)
+
+    header = Cloud_Header(num_verticies, origin, bounds, source_bounds, layout, source, data_offset)
+    header_bytes = json.dumps(header.describe()).encode()
+    assert CLOUD_PREAMBLE.size + len(header_bytes) <= data_offset, "Point cloud header overflows its space"
+
+    # Write to a temporary file first so a partly written file is never loaded
+    cloud_file = Path(cloud_file)
+    temp_file = cloud_file.with_name(cloud_file.name + ".tmp")
+
+    with open(temp_file, "wb") as file_handle:
+        file_handle.write(CLOUD_PREAMBLE.pack(CLOUD_MAGIC, CLOUD_VERSION, len(header_bytes)))
+        file_handle.write(header_bytes)
+
+        for name, values in stored.items():
+            file_handle.seek(layout[name][1])
+            file_handle.write(values.tobytes())
+
+        file_handle.truncate(offset)
+
+    os.replace(temp_file, cloud_file)
+
+    return header
+
+
+def read_cloud_header(cloud_file, source_file=None):
+    #######################################
+    #
+    # Reads the header of a point cloud file
+    #
+    # Input: point cloud file, file the cloud should have been decoded from (optional)
+    # Returns: Cloud_Header, None when the file is missing, of another version, truncated or
+    #          decoded from a different version of the source file
+    #
+    ######################################
+    cloud_file = Path(cloud_file)
+
+    if not cloud_file.exists():
+        return None
+
+    with open(cloud_file, "rb") as file_handle:
+        preamble = file_handle.read(CLOUD_PREAMBLE.size)
+        if len(preamble) != CLOUD_PREAMBLE.size:
+            return None
+
+        magic, version, header_length = CLOUD_PREAMBLE.unpack(preamble)
+        if magic != CLOUD_MAGIC or version != CLOUD_VERSION:
+            return None
+
+        description = json.loads(file_handle.read(header_length).decode())
+
+    if source_file is not None and description["source"] != fingerprint_file(source_file):
+        return None
+
+    columns = {column["name"]: (column["dtype"], column["offset"]) for column in description["columns"]}
+
+    # Every column must be on disk in full
+    file_size = cloud_file.stat().st_size
+    for dtype, offset in columns.values():
+        if offset + np.dtype(dtype).itemsize*description["num_verticies"] > file_size:
+            return None
+
+    data_offset = min((offset for _, offset in columns.values()), default=None)
+
+    return Cloud_Header(description["num_verticies"], description["origin"], description["bounds"], description["source_bounds"],
+                        columns, description["source"], data_offset)
+
+
+def map_cloud_columns(cloud_file, header, names):
+    #######################################
+    #
+    # Memory maps columns of a point cloud file
+    #
+    # Input: point cloud file, its Cloud_Header, names of the columns to map
+    # Returns: dictionary of column name to read only float32 array, coordinates are relative
+    #          to header.origin
+    #
+    ######################################
+    columns = {}
+    for name in names:
+        assert name in header.columns, "Point cloud file has no " + name + " column"
+        dtype, offset = header.columns[name]
+
+        if header.num_verticies == 0:
+            columns[name] = np.zeros(0, dtype=dtype)
+        else:
+            columns[name] = np.memmap(cloud_file, dtype=dtype, mode='r', offset=offset, shape=(header.num_verticies,))
+
+    return columns
+
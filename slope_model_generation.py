@@ -14,13 +14,17 @@
 #   4. Output graphical interpretation of the slopes on the green
 #
 ###################################################################################################
-import copy
 import argparse
 import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 from pathlib import Path
-from sklearn import linear_model
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from gradient_cache import Gradient_Cache, GRADIENT_CACHE_FOLDER
+from point_cloud_cache import cloud_file_for, write_cloud_file, read_cloud_header, map_cloud_columns, COORDINATE_COLUMNS, NORMAL_COLUMNS
+from green_renderer import Green_Renderer, draw_green, gradient_layers
+from pipeline_profiler import profiled, count, profiling_enabled, enable_profiling, finish_profiling, PROFILE_FILE
 
 ###################################################################################################
 #
@@ -34,12 +38,73 @@ Z = 2
 GRID_SIZE_X = 4
 GRID_SIZE_Y = 4
 
-GRADIENT_FILE = "grid_vector.txt"
+FIT_METHOD = "ols"
+PLY_ASCII = "ascii"
+PLY_BINARY_BYTE_ORDERS = {"binary_little_endian": "<", "binary_big_endian": ">"}
+PLY_CHUNK_SIZE = 100000 # Verticies parsed per bulk read
 PLY_FILE = "steady_x_increasing.ply"
+PYRAMID_FILE = "slope_pyramid.npz"
+
+# Coordinate storage of Surface_Data
+STORAGE_FLOAT64 = "float64"     # Coordinates as read
+STORAGE_FLOAT32 = "float32"     # float32 offsets from the origin of the cloud
+STORAGE_INT32 = "int32"         # int32 steps of QUANTIZE_RESOLUTION from the origin of the cloud
+STORAGE_TYPES = (STORAGE_FLOAT64, STORAGE_FLOAT32, STORAGE_INT32)
+QUANTIZE_RESOLUTION = 1e-6      # Metres per int32 step, spans +/- 2 km of the origin (near the first verticies read)
+
+# Decimation of dense clouds before they are fit
+DECIMATION_VOXEL = "voxel"          # Keep one random vertex in each cube sized to the target density
+DECIMATION_RESERVOIR = "reservoir"  # Keep a random sample of each RESERVOIR_CELL_SIZE square, sized to the target density
+DECIMATION_METHODS = (DECIMATION_VOXEL, DECIMATION_RESERVOIR)
+DECIMATION_SEED = 0
+DECIMATION_STREAM = 0x5EED          # Mixed into the seed so decimation draws differ from data drawn with the same seed
+RESERVOIR_CELL_SIZE = 0.5           # Side (m) of the squares reservoir samples are drawn from
 
 X_UNIT_VECTOR = np.array([1, 0, 0])
 Y_UNIT_VECTOR = np.array([0, 1, 0])
 
+# Per grid area sums of the plane of best fit normal equations
+MOMENT_N  = 0
+MOMENT_X  = 1
+MOMENT_Y  = 2
+MOMENT_Z  = 3
+MOMENT_XX = 4
+MOMENT_XY = 5
+MOMENT_YY = 6
+MOMENT_XZ = 7
+MOMENT_YZ = 8
+MOMENT_ZZ = 9
+NUM_MOMENTS = 10
+
+MIN_FIT_POINTS = 3              # Fewest verticies a plane can be fit through
+DEGENERATE_FIT_TOLERANCE = 1e-12 # Relative spread below which the verticies of a grid area are colinear
+FLAT_SLOPE_TOLERANCE = 1e-9     # Rise over run treated as flat, hides rounding noise in level grid areas
+
+ROBUST_ITERATIONS = 5           # Reweighting passes of the robust fit
+HUBER_THRESHOLD = 1.345         # Residual, in robust standard deviations, beyond which verticies are down weighted
+INLIER_THRESHOLD = 3.0          # Residual, in robust standard deviations, within which a vertex is an inlier
+MAD_TO_SIGMA = 1.4826           # Median absolute deviation to standard deviation of normally distributed noise
+MIN_ROBUST_SCALE = 0.001        # Smallest robust standard deviation (m), keeps exactly planar grid areas stable
+
+ADAPTIVE_MAX_DEPTH = 3          # Times an adaptive grid area may be split into quarters
+ADAPTIVE_MIN_POINTS = 10        # Fewest verticies each quarter needs before a grid area is split
+ADAPTIVE_RESIDUAL = 0.005       # RMS distance (m) from the plane of best fit above which a grid area is split
+
+TILES_PER_WORKER = 4    # Tiles queued per worker process so faster workers pick up more of the grid
+TILE_HALO = 0.01        # Margin around each tile, as a fraction of a grid area, so edge verticies are kept
+
+# Ply property types and their numpy equivalents
+PLY_PROPERTY_TYPES = {
+    "char":  "i1", "int8":    "i1",
+    "uchar": "u1", "uint8":   "u1",
+    "short": "i2", "int16":   "i2",
+    "ushort":"u2", "uint16":  "u2",
+    "int":   "i4", "int32":   "i4",
+    "uint":  "u4", "uint32":  "u4",
+    "float": "f4", "float32": "f4",
+    "double":"f8", "float64": "f8",
+}
+
 ###################################################################################################
 #
 #                                            CLASSES
@@ -48,271 +113,1893 @@ Y_UNIT_VECTOR = np.array([0, 1, 0])
 class Surface_Data(object):
     ################################
     #
-    # Surface data storage object
+    # Surface data storage object
+    #
+    # nx, ny and nz are the vertex normals, None when they were not loaded. bounds is the
+    # (min x, max x, min y, max y) bounding box when it is already known, Eg. from the header of a
+    # point cloud file, None otherwise.
+    #
+    # With compact storage (STORAGE_FLOAT32 or STORAGE_INT32) the coordinates are kept as offsets
+    # from origin, halving the memory of the cloud. x, y and z then decode a float64 copy on
+    # every access, fits read only the verticies they need through coordinates().
+    #
+    # x, y and z are read only, so writing through them fails instead of changing a decoded
+    # copy. Coordinates are replaced with set_coordinates() or filled with store().
+    #
+    ################################
+    def __init__(self, num_verticies, vertex_data=None, normals=False, storage=STORAGE_FLOAT64, origin=(0, 0, 0),
+                 resolution=QUANTIZE_RESOLUTION):
+
+        assert storage in STORAGE_TYPES, "Unknown coordinate storage: " + str(storage)
+
+        self.nx = self.ny = self.nz = None
+        self.bounds = None
+
+        self.storage    = storage
+        self.origin     = np.asarray(origin, dtype=np.float64)  # Only used by compact storage
+        self.resolution = resolution if storage == STORAGE_INT32 else 1.0
+
+        if vertex_data is None:
+            # Allocate memory for vertex data, normals of compact data are float32
+            dtype = np.float64 if storage == STORAGE_FLOAT64 else np.float32
+
+            self.stored = [np.zeros(num_verticies, dtype=storage) for _ in range(3)]
+
+            if normals:
+                self.nx  = np.zeros(num_verticies, dtype=dtype)
+                self.ny  = np.zeros(num_verticies, dtype=dtype)
+                self.nz  = np.zeros(num_verticies, dtype=dtype)
+        else:
+            # Use views of an existing structured vertex array, coordinates are only copied when
+            # their type differs from the storage (Eg. big-endian)
+            assert storage != STORAGE_INT32, "Vertex array views are not quantized"
+            self.stored = [np.asarray(vertex_data[name], dtype=storage) for name in ("x", "y", "z")]
+
+            if normals:
+                self.nx  = vertex_data["nx"]
+                self.ny  = vertex_data["ny"]
+                self.nz  = vertex_data["nz"]
+
+    def compact(self):
+        return self.storage != STORAGE_FLOAT64
+
+    def decode(self, axis, values):
+        # Coordinates of stored values along an axis, in float64. float32 values around a zero
+        # origin (Eg. mapped from a binary ply file) are already coordinates and are not copied
+        if not self.compact() or (self.storage == STORAGE_FLOAT32 and not np.any(self.origin)):
+            return values
+
+        return np.asarray(values, dtype=np.float64)*self.resolution + self.origin[axis]
+
+    def encode(self, axis, values):
+        # Stored values of coordinates along an axis
+        if not self.compact():
+            return values
+
+        offsets = (np.asarray(values, dtype=np.float64) - self.origin[axis])/self.resolution
+
+        if self.storage == STORAGE_INT32:
+            assert len(offsets) == 0 or np.max(np.abs(offsets)) < np.iinfo(np.int32).max, "Verticies too far from the origin to quantize, use " + STORAGE_FLOAT32 + " storage"
+            offsets = np.rint(offsets)
+
+        return offsets.astype(self.storage)
+
+    def decoded(self, axis):
+        # Read only float64 coordinates along an axis
+        values = self.decode(axis, self.stored[axis]).view()
+        values.flags.writeable = False
+
+        return values
+
+    @property
+    def x(self):
+        return self.decoded(X)
+
+    @property
+    def y(self):
+        return self.decoded(Y)
+
+    @property
+    def z(self):
+        return self.decoded(Z)
+
+    def set_coordinates(self, x, y, z):
+        #######################################
+        #
+        # Replaces the coordinates of every vertex
+        #
+        # Compact coordinates are encoded again around an origin near the new verticies, as
+        # they may have moved far from the old one. The known bounding box is dropped.
+        #
+        # Input: x, y and z arrays
+        #
+        ######################################
+        coordinates = [np.asarray(values, dtype=np.float64) for values in (x, y, z)]
+
+        if self.compact() and len(coordinates[X]):
+            self.origin = np.round([np.mean(values) for values in coordinates])
+
+        self.stored = [self.encode(axis, values) for axis, values in enumerate(coordinates)]
+        self.bounds = None
+
+    def store(self, start, chunk):
+        # Copies a chunk of verticies (a Surface_Data) into this object from vertex start on
+        end = start + len(chunk.stored[X])
+
+        for axis, values in enumerate((chunk.x, chunk.y, chunk.z)):
+            self.stored[axis][start:end] = self.encode(axis, values)
+
+        for name in ("nx", "ny", "nz"):
+            if getattr(self, name) is not None:
+                getattr(self, name)[start:end] = getattr(chunk, name)
+
+        return end
+
+    def coordinates(self, points=None, origin=(0, 0, 0)):
+        #######################################
+        #
+        # Coordinates of some verticies relative to an origin, in float64
+        #
+        # Only the selected verticies are decoded, and compact offsets are moved to the new
+        # origin without first being made absolute, so no precision is lost far from zero.
+        #
+        # Input: indices or slice of the verticies (None for all of them), origin as (x, y, z)
+        # Returns: dx, dy, dz arrays
+        #
+        ######################################
+        shift = np.asarray(origin, dtype=np.float64) - (self.origin if self.compact() else 0)
+
+        offsets = []
+        for axis in (X, Y, Z):
+            values = self.stored[axis] if points is None else self.stored[axis][points]
+            offsets.append(np.asarray(values, dtype=np.float64)*self.resolution - shift[axis])
+
+        return offsets
+
+    def mean_z(self):
+        # Mean height of the verticies, 0 when there are none
+        if len(self.stored[Z]) == 0:
+            return 0
+
+        return float(np.mean(self.stored[Z], dtype=np.float64))*self.resolution + (self.origin[Z] if self.compact() else 0)
+
+    def mean(self):
+        # Mean vertex as an (x, y, z) array, zeros when there are none
+        if len(self.stored[X]) == 0:
+            return np.zeros(3)
+
+        return np.array([np.mean(values, dtype=np.float64) for values in self.stored])*self.resolution + (self.origin if self.compact() else 0)
+
+    def nbytes(self):
+        # Memory held by the coordinates and normals
+        return sum(values.nbytes for values in self.stored + [self.nx, self.ny, self.nz] if values is not None)
+
+
+class Ply_Header(object):
+    ################################
+    #
+    # Ply file header information
+    #
+    ################################
+    def __init__(self):
+
+        self.format         = None
+        self.num_verticies  = None
+        self.properties     = []    # Vertex property names in file order
+        self.property_types = []    # Vertex property types in file order
+        self.data_offset    = None  # Byte offset of the first vertex
+
+    def has_normals(self):
+        # Whether every vertex carries a normal
+        return all(name in self.properties for name in ("nx", "ny", "nz"))
+
+    def vertex_dtype(self):
+        # Structured dtype of one binary vertex record, built from the typed property lines
+        byte_order = PLY_BINARY_BYTE_ORDERS[self.format]
+        return np.dtype([(name, byte_order + PLY_PROPERTY_TYPES[prop_type])
+                         for name, prop_type in zip(self.properties, self.property_types)])
+
+
+class Grid_Index(object):
+    ################################
+    #
+    # Spatial index of the verticies within each grid area
+    #
+    # Verticies are sorted by grid area so the verticies of one area are a contiguous
+    # slice of self.points. Grid areas are closed intervals, a vertex lying exactly on a
+    # shared edge is listed in every grid area it touches.
+    #
+    ################################
+    def __init__(self, x_edges, y_edges, cells, points):
+
+        self.x_edges     = x_edges
+        self.y_edges     = y_edges
+        self.grid_size_x = len(x_edges) - 1
+        self.grid_size_y = len(y_edges) - 1
+
+        # Grid area (row major, i*grid_size_x + j) and vertex index of each entry, sorted by area
+        self.cells       = cells
+        self.points      = points
+
+        # Entries of grid area k are self.points[self.offsets[k]:self.offsets[k+1]]
+        counts = np.bincount(cells, minlength=self.grid_size_x*self.grid_size_y)
+        self.offsets     = np.concatenate(([0], np.cumsum(counts)))
+
+    def cell_points(self, i, j):
+        # Vertex indicies within the grid area at row i (y) and column j (x)
+        cell = i*self.grid_size_x + j
+        return self.points[self.offsets[cell]:self.offsets[cell + 1]]
+
+    def cell_counts(self):
+        # Number of verticies within each grid area as a (grid_size_y, grid_size_x) array
+        return np.diff(self.offsets).reshape(self.grid_size_y, self.grid_size_x)
+
+
+class Cell_Moments(object):
+    ################################
+    #
+    # Sums of the vertex coordinates within each grid area, enough to fit a plane of best fit
+    #
+    # Coordinates are summed relative to self.origin so the normal equations stay well
+    # conditioned for georeferenced data.
+    #
+    ################################
+    def __init__(self, grid_size_x, grid_size_y, origin, x_edges=None, y_edges=None):
+
+        self.grid_size_x = grid_size_x
+        self.grid_size_y = grid_size_y
+        self.origin      = np.asarray(origin, dtype=float)
+        self.sums        = np.zeros((grid_size_y, grid_size_x, NUM_MOMENTS))
+
+        # Grid area edges the sums were binned with
+        self.x_edges     = x_edges
+        self.y_edges     = y_edges
+
+    def add_points(self, cells, xs, ys, zs, weights=None):
+        # Accumulate verticies into the sums of the grid areas (row major) they belong to,
+        # each vertex counts weights[i] times when weights are given
+        # Binary ply files store float32 coordinates, sum in float64
+        dx = np.asarray(xs, dtype=np.float64) - self.origin[X]
+        dy = np.asarray(ys, dtype=np.float64) - self.origin[Y]
+        dz = np.asarray(zs, dtype=np.float64) - self.origin[Z]
+
+        self.add_offsets(cells, dx, dy, dz, weights)
+
+    def add_offsets(self, cells, dx, dy, dz, weights=None):
+        # Accumulate verticies given as float64 offsets from self.origin
+        num_cells = self.grid_size_x*self.grid_size_y
+        sums = self.sums.reshape(num_cells, NUM_MOMENTS)
+
+        if weights is None:
+            sums[:, MOMENT_N] += np.bincount(cells, minlength=num_cells)
+            wx, wy, wz = dx, dy, dz
+        else:
+            sums[:, MOMENT_N] += np.bincount(cells, weights=weights, minlength=num_cells)
+            wx, wy, wz = weights*dx, weights*dy, weights*dz
+
+        for moment, values in ((MOMENT_X, wx), (MOMENT_Y, wy), (MOMENT_Z, wz),
+                               (MOMENT_XX, wx*dx), (MOMENT_XY, wx*dy), (MOMENT_YY, wy*dy),
+                               (MOMENT_XZ, wx*dz), (MOMENT_YZ, wy*dz), (MOMENT_ZZ, wz*dz)):
+            sums[:, moment] += np.bincount(cells, weights=values, minlength=num_cells)
+
+        return
+
+
+class Fit_Quality(object):
+    ################################
+    #
+    # How well the robust plane of best fit of each grid area describes its verticies
+    #
+    # inlier_ratio is the fraction of verticies within INLIER_THRESHOLD robust standard
+    # deviations of the plane, residual the RMS vertical distance (m) of those inliers.
+    #
+    ################################
+    def __init__(self, inlier_ratio, residual):
+
+        self.inlier_ratio = inlier_ratio
+        self.residual     = residual
+
+
+class Grid_Spec(object):
+    ################################
+    #
+    # Layout of the slope grid
+    #
+    # The grid is either a fixed number of grid areas spanning the data or grid areas of a
+    # fixed size in metres. An adaptive grid is fit as a quadtree, each grid area is split into
+    # quarters (up to max_depth times) where the quarters hold enough verticies and the plane of
+    # best fit does not follow the verticies closely. Sparse quarters stay merged in their parent.
+    #
+    ################################
+    def __init__(self, grid_size_x=GRID_SIZE_X, grid_size_y=GRID_SIZE_Y, cell_size=None, adaptive=False,
+                 max_depth=ADAPTIVE_MAX_DEPTH, min_points=ADAPTIVE_MIN_POINTS, max_residual=ADAPTIVE_RESIDUAL):
+
+        self.grid_size_x  = grid_size_x
+        self.grid_size_y  = grid_size_y
+        self.cell_size    = cell_size       # Grid area size in metres, overrides the grid sizes when set
+        self.adaptive     = adaptive
+        self.max_depth    = max_depth if adaptive else 0
+        self.min_points   = min_points
+        self.max_residual = max_residual
+
+    def edges(self, bounds):
+        # Edges of the grid areas verticies are binned into, the finest quadtree level of an adaptive grid
+        min_x, max_x, min_y, max_y = [float(bound) for bound in bounds]
+
+        if self.cell_size:
+            step_x = step_y = float(self.cell_size)
+            grid_size_x = max(1, int(np.ceil((max_x - min_x)/step_x)))
+            grid_size_y = max(1, int(np.ceil((max_y - min_y)/step_y)))
+        else:
+            grid_size_x = self.grid_size_x
+            grid_size_y = self.grid_size_y
+            step_x = (max_x - min_x)/grid_size_x
+            step_y = (max_y - min_y)/grid_size_y
+
+        subdivisions = 2**self.max_depth
+
+        x_edges = min_x + (step_x/subdivisions)*np.arange(grid_size_x*subdivisions + 1)
+        y_edges = min_y + (step_y/subdivisions)*np.arange(grid_size_y*subdivisions + 1)
+
+        return x_edges, y_edges
+
+    def describe(self):
+        # Settings that determine the grid, used to key cached gradients
+        description = {"adaptive": self.adaptive}
+
+        if self.cell_size:
+            description["cell_size"] = float(self.cell_size)
+        else:
+            description["grid_size_x"] = int(self.grid_size_x)
+            description["grid_size_y"] = int(self.grid_size_y)
+
+        if self.adaptive:
+            description["max_depth"]    = int(self.max_depth)
+            description["min_points"]   = int(self.min_points)
+            description["max_residual"] = float(self.max_residual)
+
+        return description
+
+
+class Decimation_Spec(object):
+    ################################
+    #
+    # How a dense cloud is thinned before it is fit
+    #
+    # density is the target number of verticies per square metre of the green. The same seed
+    # always keeps the same verticies.
+    #
+    ################################
+    def __init__(self, density, method=DECIMATION_VOXEL, seed=DECIMATION_SEED):
+
+        assert density > 0, "Decimation density must be positive"
+        assert method in DECIMATION_METHODS, "Unknown decimation method: " + str(method)
+
+        self.density = density
+        self.method  = method
+        self.seed    = seed
+
+    def describe(self):
+        # Settings that determine the decimated cloud, used to key cached gradients
+        return {"density": float(self.density), "method": self.method, "seed": int(self.seed)}
+
+
+###################################################################################################
+#
+#                                            FUNCTIONS
+#
+###################################################################################################
+def read_ply_header(ply_file):
+    ################################
+    # 
+    # Read in the header of a ply file, determining the vertex count and property ordering
+    # Input: Absolute File location (str)
+    # Output: Ply_Header object
+    # 
+    ################################
+    with open(ply_file, 'rb') as plyFile:
+        return parse_ply_header(plyFile)
+
+
+def parse_ply_header(plyFile):
+    ################################
+    # 
+    # Read the header of a ply file from an open binary file, leaving it at the first vertex
+    # Input: binary file object (a file on disk or a member of a zip archive)
+    # Output: Ply_Header object
+    # 
+    ################################
+    header = Ply_Header()
+    in_vertex_element = False
+
+    # Iterate through each line of the header until the vertex data begins
+    for raw_line in iter(plyFile.readline, b''):
+        line = raw_line.decode('ascii', errors='replace').split()
+
+        if len(line) == 0:
+            continue
+
+        elif line[0] == 'end_header':
+            header.data_offset = plyFile.tell()
+            break
+
+        elif line[0] == 'format':
+            header.format = line[1]
+
+        elif line[0] == 'element':
+            in_vertex_element = line[1] == 'vertex'
+            if in_vertex_element:
+                header.num_verticies = int(line[2])
+            else:
+                # Vertex data must come first so the body can be read in one block
+                assert header.num_verticies is not None, "Ply file elements before vertex element are not supported"
+
+        elif line[0] == 'property' and in_vertex_element:
+            # Determine ply property ordering
+            assert line[1] in PLY_PROPERTY_TYPES, "Unsupported vertex property type: " + line[1]
+            header.properties.append(line[2])
+            header.property_types.append(line[1])
+
+    assert header.data_offset is not None, "Ply file header has no end_header line"
+    assert header.num_verticies is not None, "Ply file has no vertex element"
+
+    for axis in ("x", "y", "z"):
+        assert axis in header.properties, "Ply file vertex element has no " + axis + " property"
+
+    return header
+
+
+@profiled
+def read_ply_file(ply_file, normals=False, storage=STORAGE_FLOAT64):
+    ################################
+    # 
+    # Read in a ply file of a surface mesh, store that data into memory
+    # Input: Absolute File location (str), whether to also read the vertex normals, coordinate
+    #        storage (STORAGE_TYPES, the default keeps binary columns mapped as read)
+    # Output: Structure of ply file data
+    # 
+    ################################
+    print('Reading file: ', ply_file)
+    header = read_ply_header(ply_file)
+
+    if normals:
+        assert header.has_normals(), "Ply file has no nx, ny, nz vertex normals"
+
+    if header.format in PLY_BINARY_BYTE_ORDERS:
+        s_data = read_binary_ply_body(ply_file, header, normals)
+        if storage != STORAGE_FLOAT64:
+            s_data = convert_storage(s_data, storage)
+    else:
+        assert header.format == PLY_ASCII, "Unsupported ply format: " + str(header.format)
+        s_data = read_ascii_ply_body(ply_file, header, normals, storage)
+
+    count("points_read", header.num_verticies)
+
+    print('Finished reading file\n')
+    return s_data
+
+
+@profiled
+def read_ply_cached(ply_file, normals=False, storage=STORAGE_FLOAT64):
+    ################################
+    # 
+    # Read in a ply file through the point cloud file kept next to it, the ply file is only parsed
+    # when the point cloud file is missing or older than the ply file
+    # Input: Absolute File location (str), whether to also read the vertex normals, coordinate
+    #        storage (float32 storage maps the point cloud file without a copy)
+    # Output: Structure of ply file data, with its bounding box from the point cloud file header
+    # 
+    ################################
+    cloud_file = cloud_file_for(ply_file)
+    names = COORDINATE_COLUMNS + (NORMAL_COLUMNS if normals else ())
+
+    s_data = read_cloud_data(cloud_file, names, ply_file, storage)
+
+    if s_data is None:
+        # Keep the normals whenever the file has them, so a later normals fit is cached too
+        s_data = read_ply_file(ply_file, normals or read_ply_header(ply_file).has_normals())
+
+        columns = {name: getattr(s_data, name) for name in COORDINATE_COLUMNS + NORMAL_COLUMNS if getattr(s_data, name) is not None}
+
+        try:
+            write_cloud_file(cloud_file, columns, ply_file)
+        except OSError as error:
+            print("Could not store point cloud file " + str(cloud_file) + ": " + str(error) + "\n")
+            return s_data
+
+        print("Stored point cloud file: " + str(cloud_file) + "\n")
+
+        # Load what was stored so every run fits exactly the same verticies
+        s_data = read_cloud_data(cloud_file, names, ply_file, storage)
+        assert s_data is not None, "Point cloud file could not be read back: " + str(cloud_file)
+
+    else:
+        print("Reading point cloud file: " + str(cloud_file) + "\n")
+
+    return s_data
+
+
+def read_cloud_data(cloud_file, names=None, source_file=None, storage=STORAGE_FLOAT64):
+    ################################
+    # 
+    # Load a point cloud file into a vertex data object
+    # Input: point cloud file, columns to load (None for all of them), file the cloud should have
+    #        been decoded from (optional), coordinate storage
+    # Output: Structure of vertex data with its bounding box, None when the file is missing, stale
+    #         or lacks one of the columns
+    # 
+    ################################
+    header = read_cloud_header(cloud_file, source_file)
+    if header is None:
+        return None
+
+    if names is None:
+        names = [name for name in COORDINATE_COLUMNS + NORMAL_COLUMNS if name in header.columns]
+
+    if not all(name in header.columns for name in names):
+        return None
+
+    # The float32 columns are already compact coordinates, map them without a copy
+    columns = map_cloud_columns(cloud_file, header, names)
+
+    s_data = Surface_Data(0, storage=STORAGE_FLOAT32, origin=header.origin)
+    s_data.stored = [columns[name] for name in COORDINATE_COLUMNS]
+
+    for name in NORMAL_COLUMNS:
+        if name in columns:
+            setattr(s_data, name, columns[name])
+
+    s_data.bounds = header.bounds[:4]
+
+    return convert_storage(s_data, storage)
+
+
+def read_ascii_ply_body(ply_file, header, normals=False, storage=STORAGE_FLOAT64):
+    ################################
+    # 
+    # Read the vertex body of an ascii ply file in large blocks
+    # Input: Absolute File location (str), Ply_Header of the file, whether to read the normals,
+    #        coordinate storage
+    # Output: Structure of ply file data
+    # 
+    ################################
+    s_data = Surface_Data(header.num_verticies, normals=normals, storage=storage)
+
+    start = 0
+    for chunk in read_ascii_ply_chunks(ply_file, header, PLY_CHUNK_SIZE, normals):
+        # Compact storage is relative to an origin near the first verticies read
+        if start == 0 and s_data.compact():
+            s_data.origin = choose_origin(chunk)
+
+        start = s_data.store(start, chunk)
+
+    return s_data
+
+
+def choose_origin(s_data):
+    # Origin of compact coordinates, the mean of the verticies rounded to the metre
+    return np.round(s_data.mean())
+
+
+def convert_storage(s_data, storage, chunk_size=PLY_CHUNK_SIZE):
+    ################################
+    # 
+    # Copy vertex data into another coordinate storage, a chunk at a time so the cloud is never
+    # decoded in full
+    # Input: Structure of vertex data, coordinate storage (STORAGE_TYPES), verticies per chunk
+    # Output: Structure of vertex data in the new storage
+    # 
+    ################################
+    if s_data.storage == storage:
+        return s_data
+
+    num_verticies = len(s_data.stored[X])
+    normals = s_data.nx is not None
+
+    converted = Surface_Data(num_verticies, normals=normals, storage=storage)
+    converted.bounds = s_data.bounds
+
+    for start in range(0, num_verticies, chunk_size):
+        points = np.arange(start, min(start + chunk_size, num_verticies))
+
+        chunk = Surface_Data(0)
+        chunk.set_coordinates(*s_data.coordinates(points))
+
+        if normals:
+            chunk.nx, chunk.ny, chunk.nz = s_data.nx[points], s_data.ny[points], s_data.nz[points]
+
+        if start == 0:
+            converted.origin = choose_origin(chunk)
+
+        converted.store(start, chunk)
+
+    return converted
+
+
+def read_ascii_ply_chunks(ply_file, header, chunk_size, normals=False):
+    ################################
+    # 
+    # Generator over the vertex body of an ascii ply file, each block is a single bulk numpy read
+    # Input: Absolute File location (str), Ply_Header of the file, verticies per chunk,
+    #        whether to read the normals
+    # Output: Surface_Data of each chunk of verticies
+    # 
+    ################################
+
+    # Column of each coordinate within a vertex line
+    x_col = header.properties.index("x")
+    y_col = header.properties.index("y")
+    z_col = header.properties.index("z")
+    num_properties = len(header.properties)
+
+    with open(ply_file, 'rb') as plyFile:
+        plyFile.seek(header.data_offset)
+
+        for start in range(0, header.num_verticies, chunk_size):
+            num_rows = min(chunk_size, header.num_verticies - start)
+
+            block = np.fromfile(plyFile, dtype=np.float64, sep=' ', count=num_rows*num_properties)
+            assert len(block) == num_rows*num_properties, "Ply file ended before all verticies were read"
+
+            block = block.reshape(num_rows, num_properties)
+
+            chunk = Surface_Data(0)
+            chunk.set_coordinates(np.ascontiguousarray(block[:, x_col]), np.ascontiguousarray(block[:, y_col]),
+                                  np.ascontiguousarray(block[:, z_col]))
+
+            if normals:
+                chunk.nx = np.ascontiguousarray(block[:, header.properties.index("nx")])
+                chunk.ny = np.ascontiguousarray(block[:, header.properties.index("ny")])
+                chunk.nz = np.ascontiguousarray(block[:, header.properties.index("nz")])
+
+            yield chunk
+
+
+def read_ply_chunks(ply_file, chunk_size=PLY_CHUNK_SIZE):
+    ################################
+    # 
+    # Generator over a ply file in fixed size chunks of verticies, only one chunk is held in memory
+    # Input: Absolute File location (str), verticies per chunk
+    # Output: Surface_Data of each chunk of verticies
+    # 
+    ################################
+    header = read_ply_header(ply_file)
+
+    if header.format in PLY_BINARY_BYTE_ORDERS:
+        # Copy each chunk out of the mapping so its pages can be dropped once the chunk is processed
+        mapped = read_binary_ply_body(ply_file, header)
+        for start in range(0, header.num_verticies, chunk_size):
+            chunk = Surface_Data(0)
+            chunk.set_coordinates(*mapped.coordinates(slice(start, start + chunk_size)))
+
+            count("points_read", len(chunk.stored[X]))
+            yield chunk
+
+    else:
+        assert header.format == PLY_ASCII, "Unsupported ply format: " + str(header.format)
+        for chunk in read_ascii_ply_chunks(ply_file, header, chunk_size):
+            count("points_read", len(chunk.stored[X]))
+            yield chunk
+
+
+def read_binary_ply_body(ply_file, header, normals=False):
+    ################################
+    # 
+    # Memory map the vertex body of a binary ply file, pages are only read from disk when accessed
+    # Input: Absolute File location (str), Ply_Header of the file, whether to read the normals
+    # Output: Structure of ply file data, x, y and z (and the normals) are views into the mapped file,
+    #         stored as float32 when the file holds float32 coordinates
+    # 
+    ################################
+    dtype = header.vertex_dtype()
+
+    assert header.data_offset + dtype.itemsize*header.num_verticies <= Path(ply_file).stat().st_size, \
+        "Ply file ended before all verticies were read"
+
+    # float32 coordinates are mapped as float32 storage around a zero origin, others as float64
+    single = all(dtype[name].kind == 'f' and dtype[name].itemsize == 4 for name in ("x", "y", "z"))
+    storage = STORAGE_FLOAT32 if single else STORAGE_FLOAT64
+
+    if header.num_verticies == 0:
+        return Surface_Data(0, normals=normals, storage=storage)
+
+    vertex_data = np.memmap(ply_file, dtype=dtype, mode='r', offset=header.data_offset, shape=(header.num_verticies,))
+
+    return Surface_Data(header.num_verticies, vertex_data, normals, storage)
+
+
+@profiled
+def read_ply_stream(plyFile, normals=False):
+    ################################
+    # 
+    # Read a ply file from an open binary stream that cannot be memory mapped, such as a zip
+    # archive member, without writing it to disk
+    # Input: binary file object at the start of the ply file, whether to read the normals
+    # Output: Structure of ply file data
+    # 
+    ################################
+    header = parse_ply_header(plyFile)
+
+    if normals:
+        assert header.has_normals(), "Ply file has no nx, ny, nz vertex normals"
+
+    if header.format == PLY_ASCII:
+        block = np.array(plyFile.read().split(), dtype=np.float64)
+        assert len(block) >= header.num_verticies*len(header.properties), "Ply file ended before all verticies were read"
+
+        vertex_data = block[:header.num_verticies*len(header.properties)].reshape(header.num_verticies, len(header.properties))
+        vertex_data = {name: vertex_data[:, column] for column, name in enumerate(header.properties)}
+
+    else:
+        assert header.format in PLY_BINARY_BYTE_ORDERS, "Unsupported ply format: " + str(header.format)
+
+        # Decompress straight into the vertex records, the stream is never held twice
+        vertex_data = np.empty(header.num_verticies, dtype=header.vertex_dtype())
+        buffer = memoryview(vertex_data).cast('B')
+
+        filled = 0
+        while filled < len(buffer):
+            num_bytes = plyFile.readinto(buffer[filled:])
+            assert num_bytes, "Ply file ended before all verticies were read"
+            filled += num_bytes
+
+    s_data = Surface_Data(header.num_verticies, normals=normals)
+    s_data.set_coordinates(np.array(vertex_data["x"]), np.array(vertex_data["y"]), np.array(vertex_data["z"]))
+
+    if normals:
+        s_data.nx[:] = vertex_data["nx"]
+        s_data.ny[:] = vertex_data["ny"]
+        s_data.nz[:] = vertex_data["nz"]
+
+    count("points_read", header.num_verticies)
+
+    return s_data
+
+
+def calculate_cell_moments(index, s_data, origin=None):
+    #######################################
+    #
+    # Sums the vertex coordinates of every grid area in one grouped pass
+    #
+    # Input: Grid_Index of the data, the vertex data object, origin of the sums (optional)
+    # Returns: Cell_Moments of the grid
+    #
+    ######################################
+    if origin is None:
+        origin = (index.x_edges[0], index.y_edges[0], s_data.mean_z())
+
+    moments = Cell_Moments(index.grid_size_x, index.grid_size_y, origin, index.x_edges, index.y_edges)
+
+    # Sum in coordinates local to the grid, compact data is never made absolute
+    moments.add_offsets(index.cells, *s_data.coordinates(index.points, moments.origin))
+
+    return moments
+
+
+def fit_planes(moments):
+    #######################################
+    #
+    # Solves the plane of best fit Ax + By + C = z of every grid area in a single stacked solve
+    #
+    # Input: Cell_Moments of the grid
+    # Returns: (grid_size_y, grid_size_x, 3) array of (A, B, C),
+    #          mask of grid areas with a valid fit (at least MIN_FIT_POINTS non colinear verticies)
+    #
+    ######################################
+    sums = moments.sums
+    n = sums[..., MOMENT_N]
+
+    # Spread of the verticies about their mean, a zero determinant means the verticies are colinear
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cxx = sums[..., MOMENT_XX] - sums[..., MOMENT_X]**2/n
+        cyy = sums[..., MOMENT_YY] - sums[..., MOMENT_Y]**2/n
+        cxy = sums[..., MOMENT_XY] - sums[..., MOMENT_X]*sums[..., MOMENT_Y]/n
+
+        valid = (n >= MIN_FIT_POINTS) & (cxx*cyy - cxy**2 > DEGENERATE_FIT_TOLERANCE*(cxx + cyy)**2)
+
+    # Normal equations of the least squares fit
+    normal = np.empty(sums.shape[:-1] + (3, 3))
+    normal[..., 0, 0] = sums[..., MOMENT_XX]
+    normal[..., 0, 1] = sums[..., MOMENT_XY]
+    normal[..., 0, 2] = sums[..., MOMENT_X]
+    normal[..., 1, 0] = sums[..., MOMENT_XY]
+    normal[..., 1, 1] = sums[..., MOMENT_YY]
+    normal[..., 1, 2] = sums[..., MOMENT_Y]
+    normal[..., 2, 0] = sums[..., MOMENT_X]
+    normal[..., 2, 1] = sums[..., MOMENT_Y]
+    normal[..., 2, 2] = n
+
+    rhs = np.stack((sums[..., MOMENT_XZ], sums[..., MOMENT_YZ], sums[..., MOMENT_Z]), axis=-1)
+
+    # Replace the systems that cannot be solved so the stacked solve does not fail
+    normal[~valid] = np.eye(3)
+    rhs[~valid] = 0
+
+    planes = np.linalg.solve(normal, rhs[..., np.newaxis])[..., 0]
+
+    # Move the intercept from the moments origin back to the data coordinates
+    planes[..., 2] += moments.origin[Z] - planes[..., 0]*moments.origin[X] - planes[..., 1]*moments.origin[Y]
+    planes[~valid] = 0
+
+    return planes, valid
+
+
+def planes_to_gradients(planes, valid):
+    #######################################
+    #
+    # Converts planes of best fit into downhill gradients
+    #
+    # Input: (rows, cols, 3) array of planes (A, B, C), mask of valid planes
+    # Returns: (rows, cols, 3) array of gradients, x and y are the unit downhill direction
+    #          and z is the negative rise over run. Invalid planes give a zero gradient
+    #
+    ######################################
+    gradients = np.zeros(planes.shape)
+
+    rise = np.hypot(planes[..., 0], planes[..., 1])
+    sloped = valid & (rise > FLAT_SLOPE_TOLERANCE)
+
+    gradients[sloped, X] = -planes[sloped, 0]/rise[sloped]
+    gradients[sloped, Y] = -planes[sloped, 1]/rise[sloped]
+    gradients[sloped, Z] = -rise[sloped]
+
+    return gradients
+
+
+def count_fits(valid, counts):
+    # Profiling counters of a fitted grid, grid areas without a fit either had too few verticies or colinear verticies
+    if not profiling_enabled():
+        return
+
+    count("grid_areas_fitted", int(np.count_nonzero(valid)))
+    count("grid_areas_skipped", int(np.count_nonzero(~valid & (counts < MIN_FIT_POINTS))))
+    count("degenerate_fits", int(np.count_nonzero(~valid & (counts >= MIN_FIT_POINTS))))
+
+    return
+
+
+def fit_cell_planes(index, s_data):
+    #######################################
+    #
+    # Fits a plane of best fit to the verticies of every grid area
+    #
+    # Input: Grid_Index of the data, the vertex data object
+    # Returns: (grid_size_y, grid_size_x, 3) array of planes (A, B, C), mask of valid fits
+    #
+    ######################################
+    return fit_planes(calculate_cell_moments(index, s_data))
+
+
+def calculate_fit_residual(moments, planes, valid):
+    #######################################
+    #
+    # RMS vertical distance of each grid area's verticies from its plane of best fit
+    #
+    # Input: Cell_Moments of the grid, planes of best fit (A, B, C), mask of valid planes
+    # Returns: (grid_size_y, grid_size_x) array of residuals, zero where the plane is not valid
+    #
+    ######################################
+    sums = moments.sums
+    n = np.where(valid, sums[..., MOMENT_N], 1)
+
+    # Spread about the mean, the residual sum of squares only depends on the slope of the plane
+    czz = sums[..., MOMENT_ZZ] - sums[..., MOMENT_Z]**2/n
+    cxz = sums[..., MOMENT_XZ] - sums[..., MOMENT_X]*sums[..., MOMENT_Z]/n
+    cyz = sums[..., MOMENT_YZ] - sums[..., MOMENT_Y]*sums[..., MOMENT_Z]/n
+
+    residual_sum = np.maximum(czz - planes[..., 0]*cxz - planes[..., 1]*cyz, 0)
+
+    return np.where(valid, np.sqrt(residual_sum/n), 0)
+
+
+def coarsen_moments(moments):
+    #######################################
+    #
+    # Merges each 2 x 2 block of grid areas into one by adding their sums
+    #
+    # A grid with an odd number of grid areas is first padded with empty grid areas along its
+    # far edge. A vertex lying exactly on an edge inside a block is counted once per grid area
+    # it touched.
+    #
+    # Input: Cell_Moments of the grid
+    # Returns: Cell_Moments of half the resolution
+    #
+    ######################################
+    grid_size_y, grid_size_x = moments.sums.shape[:2]
+    pad_y = grid_size_y % 2
+    pad_x = grid_size_x % 2
+
+    sums = np.pad(moments.sums, ((0, pad_y), (0, pad_x), (0, 0)))
+    coarse_size_y = (grid_size_y + pad_y)//2
+    coarse_size_x = (grid_size_x + pad_x)//2
+
+    x_edges = y_edges = None
+    if moments.x_edges is not None:
+        x_edges = pad_edges(moments.x_edges, pad_x)[::2]
+        y_edges = pad_edges(moments.y_edges, pad_y)[::2]
+
+    coarse = Cell_Moments(coarse_size_x, coarse_size_y, moments.origin, x_edges, y_edges)
+    coarse.sums = sums.reshape(coarse_size_y, 2, coarse_size_x, 2, NUM_MOMENTS).sum(axis=(1, 3))
+
+    return coarse
+
+
+def pad_edges(edges, pad):
+    # Extends grid area edges by pad more grid areas of the same size
+    return np.concatenate((edges, edges[-1] + (edges[-1] - edges[-2])*np.arange(1, pad + 1)))
+
+
+def expand_grid(values, scale):
+    # Repeats each grid area value over a scale x scale block of finer grid areas
+    return np.repeat(np.repeat(values, scale, axis=0), scale, axis=1)
+
+
+def fit_quadtree(moments, grid_spec):
+    #######################################
+    #
+    # Fits an adaptive grid, splitting grid areas where the plane of best fit is poor
+    #
+    # Starting from the coarsest level, a grid area is split into its four quarters when every
+    # quarter has at least grid_spec.min_points verticies and the area's fit residual exceeds
+    # grid_spec.max_residual. Grid areas that are not split are leaves of the quadtree.
+    #
+    # Input: Cell_Moments at the finest quadtree level, Grid_Spec of the grid
+    # Returns: gradients at the finest level, mask of valid fits, quadtree depth of each leaf
+    #
+    ######################################
+
+    # Moments of every level, coarsest first
+    levels = [moments]
+    for _ in range(grid_spec.max_depth):
+        levels.append(coarsen_moments(levels[-1]))
+    levels.reverse()
+
+    fine_shape = moments.sums.shape[:2]
+    gradients = np.zeros(fine_shape + (3,))
+    valid = np.zeros(fine_shape, dtype=bool)
+    leaf_depth = np.zeros(fine_shape, dtype=int)
+
+    active = np.ones(levels[0].sums.shape[:2], dtype=bool)
+
+    for depth, level in enumerate(levels):
+        planes, level_valid = fit_planes(level)
+
+        if depth < grid_spec.max_depth:
+            # Fewest verticies in any quarter of each grid area
+            child_counts = levels[depth + 1].sums[..., MOMENT_N]
+            child_rows, child_cols = child_counts.shape
+            min_child_count = child_counts.reshape(child_rows//2, 2, child_cols//2, 2).min(axis=(1, 3))
+
+            residual = calculate_fit_residual(level, planes, level_valid)
+            split = active & (min_child_count >= grid_spec.min_points) & (~level_valid | (residual > grid_spec.max_residual))
+        else:
+            split = np.zeros(active.shape, dtype=bool)
+
+        # Paint the leaves of this level onto the finest grid
+        scale = 2**(grid_spec.max_depth - depth)
+        leaf = expand_grid(active & ~split, scale)
+
+        gradients[leaf] = expand_grid(planes_to_gradients(planes, level_valid), scale)[leaf]
+        valid[leaf] = expand_grid(level_valid, scale)[leaf]
+        leaf_depth[leaf] = depth
+
+        active = expand_grid(split, 2)
+
+    return gradients, valid, leaf_depth
+
+
+@profiled
+def solve_gradients(moments, grid_spec):
+    #######################################
+    #
+    # Calculates the gradient grid from the moments of its grid areas
+    #
+    # Input: Cell_Moments of the grid (finest level for adaptive grids), Grid_Spec of the grid
+    # Returns: (rows, cols, 3) array of gradients, mask of grid areas with a valid fit
+    #
+    ######################################
+    if grid_spec.adaptive:
+        gradients, valid, leaf_depth = fit_quadtree(moments, grid_spec)
+
+        depths, counts = np.unique(leaf_depth, return_counts=True)
+        for depth, num_leaves in zip(depths, counts):
+            print("Quadtree depth " + str(depth) + ": " + str(num_leaves // 4**(grid_spec.max_depth - depth)) + " grid areas")
+        print()
+
+        return gradients, valid
+
+    planes, valid = fit_planes(moments)
+
+    return planes_to_gradients(planes, valid), valid
+
+
+@profiled
+def fit_gradients_ols(index, s_data, grid_spec):
+    #######################################
+    #
+    # Least squares plane of best fit of every grid area
+    #
+    # Input: Grid_Index of the grid (finest level for adaptive grids), the vertex data object,
+    #        Grid_Spec of the grid
+    # Returns: (rows, cols, 3) array of gradients, mask of grid areas with a valid fit
+    #
+    ######################################
+    return solve_gradients(calculate_cell_moments(index, s_data), grid_spec)
+
+
+def sum_grid_cells(index, values):
+    # Sum of the values of the index entries in each grid area, entries are grouped by grid area
+    counts = np.diff(index.offsets)
+    sums = np.zeros(len(counts))
+
+    filled = counts > 0
+    if filled.any():
+        sums[filled] = np.add.reduceat(values, index.offsets[:-1][filled])
+
+    return sums
+
+
+def calculate_cell_medians(index, values):
+    #######################################
+    #
+    # Median of the non negative values of the index entries in each grid area
+    #
+    # Entries are already grouped by grid area, so one sort of (grid area + scaled value) orders
+    # every grid area's values at once.
+    #
+    # Input: Grid_Index of the grid, one value per index entry
+    # Returns: (grid_size_y*grid_size_x) array of medians, zero for empty grid areas
+    #
+    ######################################
+    counts = np.diff(index.offsets)
+    largest = np.max(values) if len(values) else 0
+
+    if largest == 0:
+        return np.zeros(len(counts))
+
+    # Values scaled below 1 keep each grid area's entries together when sorted
+    scaled = np.sort(index.cells + 0.5*values/largest)
+    ordered = (scaled - index.cells)*(largest/0.5)
+
+    lower = np.minimum(index.offsets[:-1] + np.maximum(counts - 1, 0)//2, len(ordered) - 1)
+    upper = np.minimum(index.offsets[:-1] + counts//2, len(ordered) - 1)
+
+    return np.where(counts > 0, (ordered[lower] + ordered[upper])/2, 0)
+
+
+def fit_robust_planes(index, s_data, iterations=ROBUST_ITERATIONS):
+    #######################################
+    #
+    # Huber plane of best fit of every grid area by iteratively reweighted least squares
+    #
+    # Every pass fits all grid areas at once: the residual of each vertex from its grid area's
+    # plane gives it a Huber weight, and the weighted moment sums are solved in one stacked
+    # solve. The robust standard deviation of each grid area is re estimated from the median
+    # absolute residual every pass. Flagsticks, people and other verticies far off the green
+    # surface end up with little weight.
+    #
+    # Input: Grid_Index of the grid, the vertex data object, number of reweighting passes
+    # Returns: (grid_size_y, grid_size_x, 3) array of (A, B, C), mask of grid areas with a valid
+    #          fit, Fit_Quality of the grid
+    #
+    ######################################
+    shape = (index.grid_size_y, index.grid_size_x)
+    counts = np.diff(index.offsets)
+
+    # Coordinates of every index entry relative to the moments origin, in float64
+    origin = (index.x_edges[0], index.y_edges[0], s_data.mean_z())
+    dx, dy, dz = s_data.coordinates(index.points, origin)
+
+    # Terms of the moment sums, only the weights change between passes
+    terms = ((MOMENT_X, dx), (MOMENT_Y, dy), (MOMENT_Z, dz),
+             (MOMENT_XX, dx*dx), (MOMENT_XY, dx*dy), (MOMENT_YY, dy*dy),
+             (MOMENT_XZ, dx*dz), (MOMENT_YZ, dy*dz), (MOMENT_ZZ, dz*dz))
+
+    moments = Cell_Moments(index.grid_size_x, index.grid_size_y, origin, index.x_edges, index.y_edges)
+
+    def weighted_planes(weights):
+        # Plane of best fit of every grid area with each vertex counted weights[i] times
+        moments.sums[..., MOMENT_N] = (sum_grid_cells(index, weights) if weights is not None else counts).reshape(shape)
+        for moment, values in terms:
+            moments.sums[..., moment] = sum_grid_cells(index, values if weights is None else weights*values).reshape(shape)
+
+        return fit_planes(moments)
+
+    def entry_residuals(planes):
+        # Vertical distance of each index entry from its grid area's plane, about the origin
+        flat = planes.reshape(-1, 3)
+        intercept = flat[:, 2] + flat[:, 0]*origin[X] + flat[:, 1]*origin[Y] - origin[Z]
+        return dz - (np.repeat(flat[:, 0], counts)*dx + np.repeat(flat[:, 1], counts)*dy + np.repeat(intercept, counts))
+
+    def entry_scales(residuals):
+        # Robust standard deviation of each index entry's grid area
+        scale = np.maximum(MAD_TO_SIGMA*calculate_cell_medians(index, np.abs(residuals)), MIN_ROBUST_SCALE)
+        return np.repeat(scale, counts)
+
+    # Start from the least squares fit
+    planes, valid = weighted_planes(None)
+
+    for _ in tqdm(range(iterations), desc="Robust fit passes", leave=False):
+        residuals = entry_residuals(planes)
+        standardized = np.abs(residuals)/entry_scales(residuals)
+        weights = HUBER_THRESHOLD/np.maximum(standardized, HUBER_THRESHOLD)
+
+        # Scale the weights of each grid area to sum to its vertex count, the fit is unchanged
+        # and the vertex count checks of fit_planes still apply
+        weight_sums = sum_grid_cells(index, weights)
+        weights *= np.repeat(counts/np.where(weight_sums > 0, weight_sums, 1), counts)
+
+        new_planes, new_valid = weighted_planes(weights)
+
+        # Keep the previous plane where the weighted verticies are degenerate
+        planes = np.where((valid & new_valid)[..., np.newaxis], new_planes, planes)
+
+    # Quality of the final planes
+    residuals = entry_residuals(planes)
+    inliers = np.abs(residuals) <= INLIER_THRESHOLD*entry_scales(residuals)
+
+    inlier_counts = sum_grid_cells(index, inliers.astype(np.float64))
+    inlier_squares = sum_grid_cells(index, np.where(inliers, residuals**2, 0))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inlier_ratio = np.where(counts > 0, inlier_counts/counts, 0).reshape(shape)
+        residual = np.where(inlier_counts > 0, np.sqrt(inlier_squares/inlier_counts), 0).reshape(shape)
+
+    return planes, valid, Fit_Quality(np.where(valid, inlier_ratio, 0), np.where(valid, residual, 0))
+
+
+@profiled
+def fit_gradients_robust(index, s_data, grid_spec):
+    #######################################
+    #
+    # Huber plane of best fit of every grid area, see fit_robust_planes
     #
-    ################################
-    def __init__(self, num_verticies):
+    # Input: Grid_Index of the grid, the vertex data object, Grid_Spec of the grid
+    # Returns: (rows, cols, 3) array of gradients, mask of grid areas with a valid fit
+    #
+    ######################################
+    assert not grid_spec.adaptive, "Robust fits use a uniform grid"
 
-        # Allocate memory for vertex data
-        self.x       = np.zeros(num_verticies)
-        self.y       = np.zeros(num_verticies)
-        self.z       = np.zeros(num_verticies)
+    planes, valid, quality = fit_robust_planes(index, s_data)
 
+    if valid.any():
+        print("Robust fit inlier ratio: mean " + str(np.round(np.mean(quality.inlier_ratio[valid]), 3)) +
+              ", lowest " + str(np.round(np.min(quality.inlier_ratio[valid]), 3)) + "\n")
 
-###################################################################################################
-#
-#                                            FUNCTIONS
-#
-###################################################################################################
-def read_ply_file(ply_file):
-    ################################
-    # 
-    # Read in a ply file of a surface mesh, store that data into memory
-    # Input: Absolute File location (str)
-    # Output: Structure of ply file data
-    # 
-    ################################
-    print('Reading file: ', ply_file)
-    in_file_header = True
+    return planes_to_gradients(planes, valid), valid
+
+
+def fit_normal_planes(index, s_data):
+    #######################################
+    #
+    # Plane of every grid area from the mean of its vertex normals
+    #
+    # Normals are flipped to point up and summed per grid area in one grouped reduction, no
+    # linear system is solved. A plane Ax + By + C = z has the normal (-A, -B, 1), so the mean
+    # normal gives A and B directly, C passes through the mean vertex.
+    #
+    # Input: Grid_Index of the grid, the vertex data object with normals
+    # Returns: (grid_size_y, grid_size_x, 3) array of (A, B, C), mask of grid areas with an
+    #          upward mean normal
+    #
+    ######################################
+    assert s_data.nx is not None, "Vertex normals were not loaded, read the ply file with normals=True"
 
-    i = 0
-    properties = []
+    shape = (index.grid_size_y, index.grid_size_x)
+    counts = np.diff(index.offsets)
 
-    with open(ply_file) as plyFile:
-        # Iterate through each line of the file storing the data
-        for line in plyFile:
+    nz = np.asarray(s_data.nz, dtype=np.float64)[index.points]
+    up = np.where(nz < 0, -1.0, 1.0)
 
-            # Parse information from file header
-            if in_file_header:
-                if 'end_header' in line:
-                    in_file_header = False
-                    s_data = Surface_Data(num_verticies)
+    sum_nx = sum_grid_cells(index, up*np.asarray(s_data.nx, dtype=np.float64)[index.points])
+    sum_ny = sum_grid_cells(index, up*np.asarray(s_data.ny, dtype=np.float64)[index.points])
+    sum_nz = sum_grid_cells(index, up*nz)
 
-                elif 'element' in line and 'vertex' in line:
-                    num_verticies = int(line.split()[2])
+    valid = (counts > 0) & (sum_nz > 0)
+    sum_nz = np.where(valid, sum_nz, 1)
+    n = np.where(valid, counts, 1)
 
-                elif 'property' in line:
-                    # Determine ply property ordering
-                    property_name = line.split()[2]
-                    properties.append(property_name)
+    planes = np.zeros((len(counts), 3))
+    planes[:, 0] = -sum_nx/sum_nz
+    planes[:, 1] = -sum_ny/sum_nz
+    xs, ys, zs = s_data.coordinates(index.points)
+    planes[:, 2] = (sum_grid_cells(index, zs) - planes[:, 0]*sum_grid_cells(index, xs) - planes[:, 1]*sum_grid_cells(index, ys))/n
+    planes[~valid] = 0
 
-                continue
-            else:
-                # Parse file body for x, y, and z data values
-                if i < num_verticies:
-                    s_data.x[i] = line.split()[properties.index("x")]
-                    s_data.y[i] = line.split()[properties.index("y")]
-                    s_data.z[i] = line.split()[properties.index("z")]
+    return planes.reshape(shape + (3,)), valid.reshape(shape)
 
-                    i+=1
 
-    print('Finished reading file\n')
-    return s_data
+@profiled
+def fit_gradients_normals(index, s_data, grid_spec):
+    #######################################
+    #
+    # Slope of every grid area from its mean vertex normal, see fit_normal_planes
+    #
+    # Input: Grid_Index of the grid, the vertex data object with normals, Grid_Spec of the grid
+    # Returns: (rows, cols, 3) array of gradients, mask of grid areas with a valid fit
+    #
+    ######################################
+    assert not grid_spec.adaptive, "Normal averaging uses a uniform grid"
+
+    planes, valid = fit_normal_planes(index, s_data)
+
+    return planes_to_gradients(planes, valid), valid
+
+
+# Fit methods by name, each is called as fit(index, s_data, grid_spec) -> (gradients, valid)
+FIT_METHODS = {
+    "ols":     fit_gradients_ols,
+    "robust":  fit_gradients_robust,
+    "normals": fit_gradients_normals,
+}
+
+# Fit methods that need the vertex normals read from the ply file
+NORMAL_FIT_METHODS = ("normals",)
+
+
+def assign_grid_cells(values, edges):
+    #######################################
+    #
+    # Finds the grid area each value falls into along one axis
+    #
+    # Input: coordinate values, grid area edges (ascending)
+    # Returns: grid area of each value, mask of values inside the grid,
+    #          mask of values on an interior edge (these also belong to the preceding area)
+    #
+    ######################################
+    num_cells = len(edges) - 1
+
+    cells = np.searchsorted(edges, values, side='right') - 1
+
+    # The final edge closes the last grid area
+    cells[values == edges[-1]] = num_cells - 1
+
+    inside = (cells >= 0) & (cells < num_cells)
+    on_edge = inside & (cells > 0) & (values == edges[np.clip(cells, 0, num_cells - 1)])
+
+    return cells, inside, on_edge
+
+
+def calculate_bounds(s_data):
+    # Bounding box of the verticies as (min x, max x, min y, max y)
+    if s_data.bounds is not None:
+        return s_data.bounds
+
+    # Stored values keep the order of the coordinates, so only the extremes are decoded
+    xs, ys = s_data.stored[X], s_data.stored[Y]
+    min_x, max_x = s_data.decode(X, np.array([np.min(xs), np.max(xs)]))
+    min_y, max_y = s_data.decode(Y, np.array([np.min(ys), np.max(ys)]))
+
+    return (min_x, max_x, min_y, max_y)
+
+
+def calculate_grid_edges(s_data, grid_size_x, grid_size_y):
+    #######################################
+    #
+    # Determines the edges of a grid_size_x x grid_size_y grid spanning the data
+    #
+    # Input: the vertex data object, number of grid areas along x and y
+    # Returns: grid area edges along x, grid area edges along y
+    #
+    ######################################
+
+    # Create the grid from min & max x and y points
+    return grid_edges_from_bounds(calculate_bounds(s_data), grid_size_x, grid_size_y)
+
+
+def grid_edges_from_bounds(bounds, grid_size_x, grid_size_y):
+    #######################################
+    #
+    # Determines the edges of a grid_size_x x grid_size_y grid spanning a bounding box
+    #
+    # Input: bounding box as (min x, max x, min y, max y), number of grid areas along x and y
+    # Returns: grid area edges along x, grid area edges along y
+    #
+    ######################################
+    return Grid_Spec(grid_size_x, grid_size_y).edges(bounds)
+
+
+def create_grid_index(s_data, grid_size_x, grid_size_y):
+    #######################################
+    #
+    # Bins every vertex into a grid_size_x x grid_size_y grid spanning the data in one pass
+    #
+    # Input: the vertex data object, number of grid areas along x and y
+    # Returns: Grid_Index of the data
+    #
+    ######################################
+    x_edges, y_edges = calculate_grid_edges(s_data, grid_size_x, grid_size_y)
+
+    return bin_surface(s_data, x_edges, y_edges)
+
+
+def bin_surface(s_data, x_edges, y_edges):
+    #######################################
+    #
+    # Groups the verticies of a vertex data object by the grid area they fall into
+    #
+    # Compact coordinates are binned as stored, against the edges moved into their frame.
+    #
+    # Input: the vertex data object, grid area edges along x and y
+    # Returns: Grid_Index of the verticies
+    #
+    ######################################
+    if not s_data.compact():
+        return bin_points(s_data.x, s_data.y, x_edges, y_edges)
+
+    index = bin_points(s_data.stored[X], s_data.stored[Y], stored_edges(s_data, X, x_edges), stored_edges(s_data, Y, y_edges))
+
+    return Grid_Index(x_edges, y_edges, index.cells, index.points)
+
+
+def stored_edges(s_data, axis, edges):
+    #######################################
+    #
+    # Grid area edges along an axis moved into the frame of the stored coordinates
+    #
+    # Moving an edge rounds it, so an outer edge built from the bounds can land just past the
+    # stored extreme. Outer edges are widened to the stored extremes the grid holds in float64,
+    # so every vertex is binned as it would be in float64 storage.
+    #
+    # Input: the vertex data object, axis, grid area edges along the axis
+    # Returns: edges in stored units
+    #
+    ######################################
+    moved = (np.asarray(edges, dtype=np.float64) - s_data.origin[axis])/s_data.resolution
+
+    values = s_data.stored[axis]
+    if len(values):
+        low, high = np.min(values), np.max(values)
+        decoded_low, decoded_high = s_data.decode(axis, np.array([low, high]))
+
+        if decoded_low >= edges[0]:
+            moved[0] = min(moved[0], low)
+        if decoded_high <= edges[-1]:
+            moved[-1] = max(moved[-1], high)
+
+    return moved
+
+
+@profiled
+def bin_points(xs, ys, x_edges, y_edges):
+    #######################################
+    #
+    # Groups verticies by the grid area they fall into
+    #
+    # Input: vertex x and y values, grid area edges along x and y
+    # Returns: Grid_Index of the verticies
+    #
+    ######################################
+    grid_size_x = len(x_edges) - 1
+
+    x_cells, x_inside, x_on_edge = assign_grid_cells(xs, x_edges)
+    y_cells, y_inside, y_on_edge = assign_grid_cells(ys, y_edges)
+
+    inside = x_inside & y_inside
+    x_on_edge &= inside
+    y_on_edge &= inside
+    corner = x_on_edge & y_on_edge
+
+    # Every vertex belongs to its own grid area, and to its neighbours when it lies on their shared edge
+    points = np.concatenate((
+        np.flatnonzero(inside),
+        np.flatnonzero(x_on_edge),
+        np.flatnonzero(y_on_edge),
+        np.flatnonzero(corner),
+    ))
+    cells = np.concatenate((
+        y_cells[inside]*grid_size_x + x_cells[inside],
+        y_cells[x_on_edge]*grid_size_x + x_cells[x_on_edge] - 1,
+        (y_cells[y_on_edge] - 1)*grid_size_x + x_cells[y_on_edge],
+        (y_cells[corner] - 1)*grid_size_x + x_cells[corner] - 1,
+    ))
+
+    order = np.argsort(cells, kind='stable')
+
+    return Grid_Index(x_edges, y_edges, cells[order], points[order])
+
+
+def spatial_keys(s_data, cell_size, axes):
+    #######################################
+    #
+    # Integer key of the cube (or square) of side cell_size each vertex falls into
+    #
+    # Input: the vertex data object, side of the cubes (m), axes the cubes divide
+    # Returns: array of keys, equal for verticies in the same cube
+    #
+    ######################################
+    keys = np.zeros(len(s_data.stored[X]), dtype=np.int64)
+
+    # One axis is decoded at a time so compact data is never held in full as float64
+    for axis in axes:
+        values = s_data.decode(axis, s_data.stored[axis])
+        cells = np.floor((values - np.min(values))/cell_size).astype(np.int64)
+
+        keys = keys*(int(np.max(cells)) + 1) + cells
+
+    return keys
+
+
+def sample_groups(keys, priorities, per_group):
+    # Indices of the per_group verticies of lowest priority in each group of equal keys, in vertex order
+    order = np.lexsort((priorities, keys))
+    sorted_keys = keys[order]
+
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    ranks = np.arange(len(keys)) - np.repeat(starts, np.diff(np.r_[starts, len(keys)]))
+
+    return np.sort(order[ranks < per_group])
+
+
+@profiled
+def decimate_surface(s_data, decimation):
+    #######################################
+    #
+    # Thins a cloud to a target density, keeping original verticies
+    #
+    # Voxel decimation keeps one vertex of each cube of side 1/sqrt(density). Reservoir
+    # decimation keeps density*RESERVOIR_CELL_SIZE^2 verticies of each square. The verticies
+    # kept in a cube or square are picked by random priorities drawn from the seed, so a
+    # decimation is repeatable. The bounding box of the full cloud is kept, so the decimated
+    # cloud is binned into the same grid areas.
+    #
+    # Input: the vertex data object, Decimation_Spec
+    # Returns: vertex data object of the kept verticies, in the same storage
+    #
+    ######################################
+    num_verticies = len(s_data.stored[X])
+    priorities = np.random.default_rng([DECIMATION_STREAM, decimation.seed]).random(num_verticies)
+
+    if num_verticies == 0:
+        kept = np.zeros(0, dtype=np.int64)
+    elif decimation.method == DECIMATION_VOXEL:
+        kept = sample_groups(spatial_keys(s_data, 1/np.sqrt(decimation.density), (X, Y, Z)), priorities, 1)
+    else:
+        per_cell = max(1, int(round(decimation.density*RESERVOIR_CELL_SIZE**2)))
+        kept = sample_groups(spatial_keys(s_data, RESERVOIR_CELL_SIZE, (X, Y)), priorities, per_cell)
+
+    decimated = Surface_Data(0, storage=s_data.storage, origin=s_data.origin, resolution=s_data.resolution)
+    decimated.stored = [values[kept] for values in s_data.stored]
+
+    for name in ("nx", "ny", "nz"):
+        if getattr(s_data, name) is not None:
+            setattr(decimated, name, getattr(s_data, name)[kept])
+
+    decimated.bounds = calculate_bounds(s_data)
+
+    count("points_decimated", num_verticies - len(kept))
+    print("Decimated " + str(num_verticies) + " verticies to " + str(len(kept)) + " (" + decimation.method + ", " +
+          str(decimation.density) + " per square metre)\n")
+
+    return decimated
+
+
+def split_grid_tiles(grid_size_x, grid_size_y, num_tiles):
+    #######################################
+    #
+    # Splits the grid into roughly num_tiles rectangular blocks of grid areas
+    #
+    # Input: number of grid areas along x and y, desired number of tiles
+    # Returns: list of tiles as (row start, row end, column start, column end)
+    #
+    ######################################
+    tiles_x = min(grid_size_x, max(1, int(np.ceil(np.sqrt(num_tiles)))))
+    tiles_y = min(grid_size_y, max(1, int(np.ceil(num_tiles/tiles_x))))
+
+    col_bounds = np.linspace(0, grid_size_x, tiles_x + 1).astype(int)
+    row_bounds = np.linspace(0, grid_size_y, tiles_y + 1).astype(int)
+
+    return [(row_bounds[r], row_bounds[r + 1], col_bounds[c], col_bounds[c + 1])
+            for r in range(tiles_y) for c in range(tiles_x)]
+
+
+def calculate_tile_moments(shared_name, num_verticies, x_edges, y_edges, origin):
+    #######################################
+    #
+    # Worker process task, sums the moments of one tile of the grid
+    #
+    # Input: name of the shared memory block holding the verticies, vertex count,
+    #        edges of the tile's grid areas along x and y, origin of the moment sums
+    # Returns: moment sums of the tile's grid areas
+    #
+    ######################################
+    shared = shared_memory.SharedMemory(name=shared_name)
+
+    try:
+        verticies = np.ndarray((3, num_verticies), dtype=np.float64, buffer=shared.buf)
+
+        # Select the verticies within the tile and a small halo, so verticies on the tile edges are kept
+        halo_x = TILE_HALO*(x_edges[-1] - x_edges[0])/(len(x_edges) - 1)
+        halo_y = TILE_HALO*(y_edges[-1] - y_edges[0])/(len(y_edges) - 1)
+
+        in_tile = ((verticies[X] >= x_edges[0] - halo_x) & (verticies[X] <= x_edges[-1] + halo_x) &
+                   (verticies[Y] >= y_edges[0] - halo_y) & (verticies[Y] <= y_edges[-1] + halo_y))
+
+        tile = Surface_Data(0)
+        tile.set_coordinates(verticies[X][in_tile], verticies[Y][in_tile], verticies[Z][in_tile])
 
+        del verticies
 
-def calculate_gradient(indicies, s_data):
+    finally:
+        shared.close()
+
+    index = bin_points(tile.x, tile.y, x_edges, y_edges)
+
+    return calculate_cell_moments(index, tile, origin).sums
+
+
+def calculate_moments_tiled(s_data, x_edges, y_edges, workers):
+    #######################################
+    #
+    # Sums the moments of every grid area using a pool of worker processes
+    #
+    # The verticies are copied into shared memory once, each worker only receives the bounds
+    # of the tile it bins and returns that tile's block of the moment sums.
+    #
+    # Input: the vertex data object, grid area edges along x and y, number of worker processes
+    # Returns: Cell_Moments of the grid
+    #
+    ######################################
+    grid_size_x = len(x_edges) - 1
+    grid_size_y = len(y_edges) - 1
+    num_verticies = len(s_data.stored[X])
+
+    # Every tile sums its moments about the same origin so the result matches a single process fit
+    origin = (x_edges[0], y_edges[0], s_data.mean_z())
+    moments = Cell_Moments(grid_size_x, grid_size_y, origin, x_edges, y_edges)
+
+    shared = shared_memory.SharedMemory(create=True, size=max(1, 3*num_verticies*np.dtype(np.float64).itemsize))
+
+    try:
+        verticies = np.ndarray((3, num_verticies), dtype=np.float64, buffer=shared.buf)
+        for axis in (X, Y, Z):
+            verticies[axis] = s_data.decode(axis, s_data.stored[axis])
+        del verticies
+
+        tiles = split_grid_tiles(grid_size_x, grid_size_y, workers*TILES_PER_WORKER)
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for tile in tiles:
+                row_start, row_end, col_start, col_end = tile
+                future = executor.submit(calculate_tile_moments, shared.name, num_verticies,
+                                         x_edges[col_start:col_end + 1], y_edges[row_start:row_end + 1], origin)
+                futures[future] = tile
+
+            # Stitch each tile's block into the full grid as it finishes
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Grid tiles"):
+                row_start, row_end, col_start, col_end = futures[future]
+                moments.sums[row_start:row_end, col_start:col_end] = future.result()
+
+    finally:
+        shared.close()
+        shared.unlink()
+
+    return moments
+
+
+def calculate_moments_streaming(ply_file, grid_spec, chunk_size, cloud_cache=False):
     #######################################
     #
-    # Calculates the slope of the given indicies from the most top left corner point
+    # Sums the moments of every grid area without holding the whole cloud in memory
     #
-    # Input: list of indicies (ints), the vertex data object, grid area top left corner
-    # Returns: Vector sum (tuple as (x, y, z))
+    # The file is read twice in chunks, first to find the extent of the grid, then to bin each
+    # chunk and add it to the moment sums of its grid areas. Memory use depends on the
+    # number of grid areas and the chunk size, not the number of verticies. With cloud_cache
+    # the extent is taken from the header of the point cloud file when it is up to date.
+    #
+    # Input: Absolute File location (str), Grid_Spec of the grid, verticies per chunk, whether
+    #        to use the point cloud file header
+    # Returns: Cell_Moments of the grid
     #
     ######################################
+    print('Streaming file: ', ply_file)
+
+    header = read_cloud_header(cloud_file_for(ply_file), ply_file) if cloud_cache else None
+
+    if header is not None and header.num_verticies > 0:
+        # The chunks are read from the ply file, so use the extent from before rounding to float32
+        min_x, max_x, min_y, max_y, min_z, max_z = header.source_bounds
+        origin_z = (min_z + max_z)/2
+
+    else:
+        # First pass, find the extent of the data
+        min_x = min_y = np.inf
+        max_x = max_y = -np.inf
+        origin_z = None
+
+        for chunk in tqdm(read_ply_chunks(ply_file, chunk_size), desc="Finding grid extent", unit="chunk"):
+            if len(chunk.stored[X]) == 0:
+                continue
+
+            min_x = min(min_x, np.min(chunk.x))
+            max_x = max(max_x, np.max(chunk.x))
+            min_y = min(min_y, np.min(chunk.y))
+            max_y = max(max_y, np.max(chunk.y))
 
-    # Preallocate memory
-    xs = np.zeros(len(indicies))
-    ys = np.zeros(len(indicies))
-    zs = np.zeros(len(indicies))
+            # Any height near the data keeps the moment sums well conditioned
+            if origin_z is None:
+                origin_z = np.mean(chunk.z)
 
-    # Store the data points of interest
-    counter = 0
-    for index in indicies:
-        xs[counter] = s_data.x[index]
-        ys[counter] = s_data.y[index]
-        zs[counter] = s_data.z[index]
-        counter+=1
+        assert origin_z is not None, "Ply file has no verticies"
 
-    xs = np.transpose(np.array(xs))
-    ys = np.transpose(np.array(ys))
+    x_edges, y_edges = grid_spec.edges((min_x, max_x, min_y, max_y))
 
-    # Fit a 2D plane to the data
-    XY_data = np.zeros([len(xs), 2])
-    for i in range(len(xs)):
-        XY_data[i][0] = xs[i]
-        XY_data[i][1] = ys[i]
+    # Second pass, accumulate the moments of each grid area
+    moments = Cell_Moments(len(x_edges) - 1, len(y_edges) - 1, (min_x, min_y, origin_z), x_edges, y_edges)
 
-    Z_data = zs
+    for chunk in tqdm(read_ply_chunks(ply_file, chunk_size), desc="Accumulating grid moments", unit="chunk"):
+        index = bin_points(chunk.x, chunk.y, x_edges, y_edges)
+        moments.add_points(index.cells, chunk.x[index.points], chunk.y[index.points], chunk.z[index.points])
 
-    # Fit plane to data
-    reg = linear_model.LinearRegression().fit(XY_data, Z_data)
+    print('Finished reading file\n')
+
+    return moments
 
-    # Plane of best fit Ax + By + C = z
-    A = reg.coef_[0]
-    B = reg.coef_[1]
-    C = reg.intercept_
 
-    # Get normal to plane through cross product of two vectors in plane
-    z_of_xy_00 = A*0 + B*0 + C
-    z_of_xy_10 = A*1 + B*0 + C
-    z_of_xy_01 = A*0 + B*1 + C
+def calculate_grid_moments(ply_file, grid_spec, workers=1, chunk_size=None, cloud_cache=False, storage=STORAGE_FLOAT64):
+    #######################################
+    #
+    # Reads a ply file and sums the moments of every grid area
+    #
+    # Input: Absolute File location (str), Grid_Spec of the grid, number of worker processes,
+    #        verticies per chunk when streaming the file (optional), whether to read the ply file
+    #        through its point cloud file, coordinate storage of the loaded cloud
+    # Returns: Cell_Moments of the grid
+    #
+    ######################################
+    if chunk_size:
+        # Stream the file, the full cloud is never held in memory
+        return calculate_moments_streaming(ply_file, grid_spec, chunk_size, cloud_cache)
 
-    p00z = np.array([0, 0, z_of_xy_00])
-    p10z = np.array([1, 0, z_of_xy_10])
-    p01z = np.array([0, 1, z_of_xy_01])
+    # Read in data
+    read = read_ply_cached if cloud_cache else read_ply_file
+    data = read(ply_file, storage=storage)
 
-    v1 = p10z - p00z
-    v2 = p01z - p00z
+    return calculate_data_moments(data, grid_spec, workers)
 
-    pobf_normal_vector = np.cross(v1, v2)
 
-    # Get 2 points on pobf that are x, y of the normal vector apart
-    z_of_normal_xy =  A*pobf_normal_vector[0] + B*pobf_normal_vector[1] + C
-    pxyz = np.array([pobf_normal_vector[0], pobf_normal_vector[1], z_of_normal_xy])
+def calculate_data_moments(data, grid_spec, workers=1):
+    #######################################
+    #
+    # Sums the moments of every grid area from verticies already in memory
+    #
+    # Input: the vertex data object, Grid_Spec of the grid, number of worker processes
+    # Returns: Cell_Moments of the grid
+    #
+    ######################################
 
-    # The gradient is the vector between this pxyz and p00z
-    gradient = p00z - pxyz
+    # Now that the data is collected, create the grid from min & max x and y points
+    x_edges, y_edges = grid_spec.edges(calculate_bounds(data))
 
-    # Normalize the gradient wrt its x and y components (as long as it is not 0)
-    if not np.array_equal(gradient, np.zeros(3)):
-        gradient = gradient / np.sqrt((gradient[X])**2 + (gradient[Y])**2)
+    if workers > 1:
+        return calculate_moments_tiled(data, x_edges, y_edges, workers)
 
-    return -1 * gradient
+    return calculate_cell_moments(bin_surface(data, x_edges, y_edges), data)
 
 
-def create_gradient_grid(ply_file, store_gradients, read_gradients):
+@profiled
+def create_gradient_grid(ply_file, store_gradients, read_gradients, workers=1, chunk_size=None,
+                         cache_folder=GRADIENT_CACHE_FOLDER, grid_spec=None, fit_method=FIT_METHOD, data=None, cloud_cache=False,
+                         storage=STORAGE_FLOAT64, decimation=None):
+    #######################################
+    #
+    # Fits the gradient grid of a ply file, or reads it from the gradient cache
+    #
+    # data is the vertex data when it was already loaded from elsewhere (Eg. a Metashape project
+    # archive), ply_file then names the file the cache entry is keyed on. With cloud_cache the
+    # ply file is only parsed once, later runs memory map the point cloud file kept next to it.
+    # storage is the coordinate storage of the cloud while it is fit (STORAGE_TYPES), decimation
+    # the Decimation_Spec the cloud is thinned with before it is fit (None to fit every vertex).
+    #
+    ######################################
     # Display output
     print()
     print('#'*75 + '\n')
     print('Starting slope generation module...\n')
     print('#'*75 + '\n')
 
-    # Allocate grid vector memory
-    lst = np.zeros(GRID_SIZE_X)
-    intermediate_step = list(zip(lst, lst, lst))
-    grid_vector = []
-    for i in range(GRID_SIZE_Y):
-        grid_vector.append(copy.deepcopy(intermediate_step)) 
-    
-    # Read in data
-    data = read_ply_file(ply_file)
-
-    # Now that the data is collected, create a GRID_SIZE_X x GRID_SIZE_Y grid from min & max x and y points
-    max_x = max(data.x)
-    min_x = min(data.x)
-    max_y = max(data.y)
-    min_y = min(data.y)
+    if grid_spec is None:
+        grid_spec = Grid_Spec()
 
-    # Determine grid boxes dimensions
-    length_x = max_x - min_x
-    step_x = length_x/GRID_SIZE_X
+    cache = Gradient_Cache(cache_folder)
 
-    length_y = max_y - min_y
-    step_y = length_y/GRID_SIZE_Y
+    # Gradients of a decimated cloud are cached apart from those of the full cloud
+    grid_key = grid_spec.describe()
+    if decimation is not None:
+        grid_key["decimation"] = decimation.describe()
 
     # Determine if to read gradients from memory or to calculate them
     if read_gradients:
-        print("Reading Gradients from file: " + GRADIENT_FILE)
-        file_handle = open(GRADIENT_FILE, "r")
-        for i in range(GRID_SIZE_X):
-            for j in range(GRID_SIZE_Y):
-                grid_vector[i][j] = tuple(np.asarray(file_handle.readline()[:-1].split(',')).astype(float))
+        grid_vector = cache.load(ply_file, grid_key, fit_method)
 
-        file_handle.close()
+        if grid_vector is not None:
+            print("Reading Gradients from cache: " + str(cache_folder) + "\n")
+            return grid_vector
 
+        print("No cached gradients for this ply file and grid, calculating them\n")
+
+    # Fit every grid area, areas without enough distinct points are left as a zero gradient
+    assert data is None or not chunk_size, "Loaded vertex data cannot be streamed"
+
+    if decimation is not None:
+        assert not chunk_size, "A streamed cloud cannot be decimated"
+
+        if data is None:
+            read = read_ply_cached if cloud_cache else read_ply_file
+            data = read(ply_file, fit_method in NORMAL_FIT_METHODS, storage)
+
+        data = decimate_surface(data, decimation)
+
+    if fit_method == FIT_METHOD:
+        if data is None:
+            moments = calculate_grid_moments(ply_file, grid_spec, workers, chunk_size, cloud_cache, storage)
+        else:
+            moments = calculate_data_moments(data, grid_spec, workers)
+        grid_vector, valid = solve_gradients(moments, grid_spec)
+        count_fits(valid, moments.sums[..., MOMENT_N])
     else:
-        # Go through each grid area and find average slope
-        for i in tqdm(range(GRID_SIZE_Y), desc="Y axis (NS) calculations"):
-            for j in tqdm(range(GRID_SIZE_X), desc="X axis (EW) calculations", leave=False):
-                # Determine grid area x and y selections
-                x_start  = min_x + step_x*j
-                x_finish = min_x + step_x*(j+1)
-                y_start  = min_y + step_y*i
-                y_finish = min_y + step_y*(i+1)
-
-                # Find all points within this grid area
-                indicies = list(filter(lambda k: data.x[k] >= x_start and data.x[k] <= x_finish and data.y[k] >= y_start and data.y[k] <= y_finish, range(len(data.x))))
-
-                if len(indicies) <= 1:
-                    # No gradient can be given for a grid area that contains less than two points
-                    continue
-                else:
-                    # Find a vector that averages the slopes of the grid area points
-                    grid_vector[i][j] = calculate_gradient(indicies, data)
-
-        if store_gradients:
-            # Write the gradients to a text file
-            file_handle = open(GRADIENT_FILE, "w")
-            for i in range(GRID_SIZE_X):
-                for j in range(GRID_SIZE_Y):
-
-                    if not (i == 0 and j == 0):
-                        file_handle.write('\n')
-
-                    file_handle.write(str(grid_vector[i][j][X]) + ',')
-                    file_handle.write(str(grid_vector[i][j][Y]) + ',')
-                    file_handle.write(str(grid_vector[i][j][Z]))
-
-            file_handle.close()
+        # Other fit methods revisit the verticies, so the whole cloud is read into one process
+        assert fit_method in FIT_METHODS, "Unknown fit method: " + fit_method
+        assert not chunk_size and workers == 1, "Only the " + FIT_METHOD + " fit can be streamed or split across workers"
+
+        if data is None:
+            read = read_ply_cached if cloud_cache else read_ply_file
+            data = read(ply_file, fit_method in NORMAL_FIT_METHODS, storage)
+        elif fit_method in NORMAL_FIT_METHODS:
+            assert data.nx is not None, "The " + fit_method + " fit needs vertex normals"
+        x_edges, y_edges = grid_spec.edges(calculate_bounds(data))
+        index = bin_surface(data, x_edges, y_edges)
+        grid_vector, valid = FIT_METHODS[fit_method](index, data, grid_spec)
+        count_fits(valid, index.cell_counts())
+
+    if not valid.all():
+        print(str(np.count_nonzero(~valid)) + " grid areas have too few points to fit a slope\n")
+
+    if store_gradients:
+        cached_file = cache.store(ply_file, grid_key, fit_method, grid_vector)
+        print("Stored gradients in cache: " + str(cached_file) + "\n")
 
     return grid_vector
 
 
-def plot_green(data):
+def create_slope_pyramid(ply_file, grid_spec, num_levels, workers=1, chunk_size=None, cloud_cache=False, storage=STORAGE_FLOAT64):
+    #######################################
+    #
+    # Calculates slope maps at several resolutions from a single read of the ply file
+    #
+    # The moments are summed once at the finest resolution, each coarser level doubles the grid
+    # area size by adding 2 x 2 blocks of the level below it.
+    #
+    # Input: Absolute File location (str), Grid_Spec of the finest level, number of levels,
+    #        number of worker processes, verticies per chunk when streaming the file (optional),
+    #        whether to read the ply file through its point cloud file, coordinate storage
+    # Returns: list of (gradients, valid, x_edges, y_edges) for each level, finest first
+    #
+    ######################################
+    assert not grid_spec.adaptive, "Slope pyramids are built from a uniform grid"
+
+    moments = calculate_grid_moments(ply_file, grid_spec, workers, chunk_size, cloud_cache, storage)
+
+    pyramid = []
+    for level in range(num_levels):
+        if level > 0:
+            moments = coarsen_moments(moments)
+
+        gradients, valid = solve_gradients(moments, grid_spec)
+        pyramid.append((gradients, valid, moments.x_edges, moments.y_edges))
+
+    return pyramid
+
+
+def save_slope_pyramid(pyramid_file, pyramid):
+    #######################################
+    #
+    # Writes every level of a slope pyramid into one npz file
+    #
+    # Level k is stored as gradients_k, valid_k, x_edges_k and y_edges_k, level 0 is the finest.
+    #
+    ######################################
+    arrays = {"num_levels": np.array(len(pyramid))}
+
+    for level, (gradients, valid, x_edges, y_edges) in enumerate(pyramid):
+        arrays["gradients_" + str(level)] = gradients
+        arrays["valid_" + str(level)]     = valid
+        arrays["x_edges_" + str(level)]   = x_edges
+        arrays["y_edges_" + str(level)]   = y_edges
+
+    np.savez(pyramid_file, **arrays)
+
+    return
+
+
+def load_slope_pyramid(pyramid_file):
+    #######################################
+    #
+    # Reads a slope pyramid written by save_slope_pyramid
+    #
+    # Returns: list of (gradients, valid, x_edges, y_edges) for each level, finest first
+    #
+    ######################################
+    with np.load(pyramid_file) as arrays:
+        return [(arrays["gradients_" + str(level)], arrays["valid_" + str(level)],
+                 arrays["x_edges_" + str(level)], arrays["y_edges_" + str(level)])
+                for level in range(int(arrays["num_levels"]))]
+
+
+@profiled
+def plot_green(data, image_file=None):
     #######################################
     #
     # Plots the green slopes in a quiver plot
     #
-    # Input: 2D array of with each element defining a grid element
+    # Input: 2D array of with each element defining a grid element, image file (optional)
     # Returns: None
-    # Output: Heat map and quiver plot
+    # Output: Heat map and quiver plot, saved to image_file (.png or .svg) without a display
+    #         when given, otherwise shown in a window
     #
     ######################################
+    layers = gradient_layers(data)
 
-    # Define grid points
-    xx = []
-    yy = []
-    mag = []
-
-    # Map gradients to X and Y slopes
-    for i in range(GRID_SIZE_Y-1, -1, -1):
-        magArr = []
-        xRow = []
-        yRow = []
-        for j in range(GRID_SIZE_X):
-            magArr.append(abs(data[i][j][Z]) * 100) # Convert rise/run to degrees (Eg. 0.01 rise/1 run = 1 degree)
-            xRow.append(data[i][j][X])
-            yRow.append(-1*data[i][j][Y]) # Y positive axis is downward, flip to get arrows in correct direction
-        mag.append(magArr)
-        xx.append(xRow)
-        yy.append(yRow)
+    if image_file is not None:
+        Green_Renderer().render(layers, image_file)
+        print("Stored slope map: " + str(image_file) + "\n")
+        return
 
     # Plot
-    plt.quiver(xx, yy, scale=2, scale_units="xy", pivot="mid")
-    plt.imshow(mag, cmap="jet", interpolation="hanning")
-    plt.clim(0.0, 5.0)
-    plt.colorbar()
-
-    # Interpolcation methods = [None, 'none', 'nearest', 'bilinear', 'bicubic', 
-    # 'spline16', 'spline36', 'hanning', 'hamming', 'hermite', 'kaiser', 'quadric',
-    # 'catrom', 'gaussian', 'bessel', 'mitchell', 'sinc', 'lanczos']
+    figure, axes = plt.subplots()
+    image = draw_green(axes, layers)
+    figure.colorbar(image, ax=axes)
 
     plt.show()
 
     return
 
 
-def generate_slope_map(output_folder, store_gradients, read_gradients):
+def generate_slope_map(output_folder, store_gradients, read_gradients, workers=1, chunk_size=None, grid_spec=None,
+                       pyramid_levels=1, image_file=None, fit_method=FIT_METHOD, cloud_cache=False, storage=STORAGE_FLOAT64,
+                       decimation=None):
     #######################################
     #
     # Calls all the functions needed to create greens map 
     #
+    # With cloud_cache a .cloud file is written next to the ply file and later runs read it. It
+    # holds the coordinates as float32 offsets, so the slopes differ from a fit of the ply file
+    # by about 1e-7.
+    #
     ######################################
     ply_file = Path(output_folder, PLY_FILE)
 
-    gradient_grid = create_gradient_grid(ply_file, store_gradients, read_gradients)
+    if pyramid_levels > 1:
+        assert fit_method == FIT_METHOD, "Slope pyramids are built from " + FIT_METHOD + " moment sums"
+        assert decimation is None, "Slope pyramids are built from every vertex"
+
+        # Every resolution of the green from one read of the ply file
+        pyramid = create_slope_pyramid(ply_file, grid_spec if grid_spec else Grid_Spec(), pyramid_levels, workers, chunk_size, cloud_cache,
+                                       storage)
+
+        pyramid_file = Path(output_folder, PYRAMID_FILE)
+        save_slope_pyramid(pyramid_file, pyramid)
+        print("Stored slope pyramid: " + str(pyramid_file) + "\n")
 
-    plot_green(gradient_grid)
+        if image_file is None:
+            plot_green(pyramid[0][0])
+            return
+
+        # One image per level, <name>_level<k>.<ext>, drawn on the same figure
+        image_file = Path(image_file)
+        Green_Renderer().render_batch([(gradient_layers(gradients), image_file.with_name(image_file.stem + "_level" + str(level) + image_file.suffix))
+                                       for level, (gradients, _, _, _) in enumerate(pyramid)])
+
+        return
+
+    # Cached gradients are kept beside the output folder
+    cache_folder = Path(output_folder).parent / GRADIENT_CACHE_FOLDER
+
+    gradient_grid = create_gradient_grid(ply_file, store_gradients, read_gradients, workers, chunk_size, cache_folder, grid_spec,
+                                         fit_method, cloud_cache=cloud_cache, storage=storage, decimation=decimation)
+
+    plot_green(gradient_grid, image_file)
 
     return
 
@@ -322,9 +2009,34 @@ if __name__ == '__main__':
     # Read in arguments
     parser = argparse.ArgumentParser(description='Find slopes from a ply file')
     parser.add_argument('data_folder', metavar='file', type=str, default=Path(), help='Data folder path')
-    parser.add_argument('--store_gradients', action='store_true', help='Store calculated gradients to memory')
-    parser.add_argument('--read_gradients', action='store_true', help='Get gradients from memory')
+    parser.add_argument('--store_gradients', action='store_true', help='Store calculated gradients in the gradient cache')
+    parser.add_argument('--read_gradients', action='store_true', help='Get gradients from the gradient cache when this ply file and grid were already fit')
+    parser.add_argument('--workers', metavar='count', type=int, default=1, help='Number of worker processes used to fit the grid')
+    parser.add_argument('--chunk_size', metavar='count', type=int, default=None, help='Stream the ply file in chunks of this many verticies')
+    parser.add_argument('--grid_size', metavar='count', type=int, nargs=2, default=[GRID_SIZE_X, GRID_SIZE_Y], help='Number of grid areas along x and y')
+    parser.add_argument('--cell_size', metavar='metres', type=float, default=None, help='Grid area size in metres, overrides --grid_size')
+    parser.add_argument('--adaptive', action='store_true', help='Split grid areas into quarters where the slope changes within them')
+    parser.add_argument('--max_depth', metavar='count', type=int, default=ADAPTIVE_MAX_DEPTH, help='Times an adaptive grid area may be split')
+    parser.add_argument('--pyramid_levels', metavar='count', type=int, default=1, help='Also store this many resolutions, each double the grid area size of the last')
+    parser.add_argument('--image_file', metavar='file', type=str, default=None, help='Save the slope map to a .png or .svg instead of showing it')
+    parser.add_argument('--fit_method', type=str, choices=sorted(FIT_METHODS), default=FIT_METHOD, help='Plane of best fit method, robust rejects flagsticks and people, normals averages the ply vertex normals')
+    parser.add_argument('--profile', metavar='file', type=str, nargs='?', const=PROFILE_FILE, default=None, help='Record timing spans, counters and memory peaks to a Chrome trace file')
+    parser.add_argument('--cloud_cache', action='store_true', help='Keep a float32 point cloud file next to the ply file so later runs skip parsing it')
+    parser.add_argument('--storage', type=str, choices=STORAGE_TYPES, default=STORAGE_FLOAT64, help='Coordinate storage, float32 and int32 (1 micrometre steps) halve the memory of the cloud')
+    parser.add_argument('--density', metavar='count', type=float, default=None, help='Decimate the cloud to this many verticies per square metre before fitting')
+    parser.add_argument('--decimation', type=str, choices=DECIMATION_METHODS, default=DECIMATION_VOXEL, help='Decimation method, voxel keeps one vertex per cube, reservoir a random sample per square')
+    parser.add_argument('--seed', metavar='seed', type=int, default=DECIMATION_SEED, help='Random seed of the decimation')
 
     args = parser.parse_args()
 
-    generate_slope_map(args.data_folder, args.store_gradients, args.read_gradients)
+    grid_spec = Grid_Spec(args.grid_size[0], args.grid_size[1], args.cell_size, args.adaptive, args.max_depth)
+    decimation = Decimation_Spec(args.density, args.decimation, args.seed) if args.density else None
+
+    if args.profile:
+        enable_profiling()
+
+    generate_slope_map(args.data_folder, args.store_gradients, args.read_gradients, args.workers, args.chunk_size, grid_spec,
+                       args.pyramid_levels, args.image_file, args.fit_method, args.cloud_cache, args.storage, decimation)
+
+    if args.profile:
+        finish_profiling(args.profile)
@@ -0,0 +1,657 @@
+###################################################################################################
+#
+#                            SLOPE MODEL GENERATION MODULE BENCHMARKS
+#
+#
+# Timing and memory measurements for the slope generation module
+# Authors: Jayden Cole & Ryan Stolys
+# Creation date: 2022-06-28
+#
+# Algorithm:
+#   1. Write a synthetic ply file of a known size, or use a given ply file
+#   2. Run each implementation on the file, recording time, peak memory and how far its result
+#      is from the reference implementation
+#   3. Print the comparison
+#
+# The benchmark suite (--suite) times each pipeline stage on synthetic greens of known slope
+# at several sizes, checks the fitted slopes against the analytic slope and appends the results
+# to a JSON history. A stage slower than the recent history by more than the threshold fails.
+#
+###################################################################################################
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from slope_model_generation import read_ply_file, read_ply_header, calculate_bounds, bin_points, bin_surface, \
+                                   sum_grid_cells, decimate_surface, Surface_Data, Grid_Spec, Decimation_Spec, FIT_METHODS, FIT_METHOD, \
+                                   NORMAL_FIT_METHODS, STORAGE_TYPES, STORAGE_FLOAT64, DECIMATION_METHODS, DECIMATION_VOXEL, DECIMATION_SEED, \
+                                   X, Y, Z
+from slope_scoring import drone_slope_layer, score_layers
+from green_renderer import Green_Renderer, gradient_layers
+
+try:
+    import resource
+except ImportError:
+    resource = None # Not available on Windows, peak RSS is then not recorded
+
+
+###################################################################################################
+#
+#                                            CONSTANTS
+#
+###################################################################################################
+NUM_VERTICIES = 100000
+COMPARE_CELL_SIZE = 1.0         # Grid area size (m) of the fit method comparison
+DECIMATION_DENSITIES = [1000, 300, 100, 30, 10] # Verticies per square metre of the decimation report
+
+# Synthetic green, a plane with a gentle swell: z = a*x + b*y + c*sin(x/d)*cos(y/e)
+SYNTHETIC_SLOPE_X = 0.02
+SYNTHETIC_SLOPE_Y = -0.01
+SYNTHETIC_SWELL = 0.05
+SYNTHETIC_SWELL_X = 3.0
+SYNTHETIC_SWELL_Y = 4.0
+
+SYNTHETIC_PLY_FILE = "synthetic_green.ply"
+SYNTHETIC_SIZE = 20.0           # Width and length (m) of the synthetic greens
+SYNTHETIC_CHUNK_SIZE = 10**6    # Verticies generated and written at a time
+GEOREFERENCED_OFFSET = (487123.37, 5456789.91, 312.5) # UTM like easting, northing and height of the georeferenced storage comparison
+
+# Benchmark suite
+SUITE_SIZES = [10**4, 10**5, 10**6]
+SUITE_GREEN = "swell"
+SUITE_CELL_SIZE = 1.0
+SUITE_STAGES = ["read", "binning", "gradient", "rendering"]
+HISTORY_FILE = "benchmark_history.json"
+REGRESSION_THRESHOLD = 0.25     # Fractional slow down of a stage that fails the suite
+REGRESSION_RUNS = 5             # Recent runs the median baseline is taken over
+MIN_REGRESSION_SECONDS = 0.01   # Stages faster than this are too noisy to compare
+SLOPE_TOLERANCE = 1e-3          # Largest rise/run error from the analytic slope (0.1% grade)
+
+# Ply properties written for every synthetic vertex, matches the Metashape export layout
+PLY_PROPERTIES = [
+    ("float", "x"), ("float", "y"), ("float", "z"),
+    ("float", "nx"), ("float", "ny"), ("float", "nz"),
+    ("uchar", "diffuse_red"), ("uchar", "diffuse_green"), ("uchar", "diffuse_blue"), ("uchar", "class"),
+]
+
+
+###################################################################################################
+#
+#                                            FUNCTIONS
+#
+###################################################################################################
+def plane_green(xs, ys):
+    # A constant slope, every plane of best fit is exact
+    zs = SYNTHETIC_SLOPE_X*xs + SYNTHETIC_SLOPE_Y*ys
+
+    return zs, np.full_like(xs, SYNTHETIC_SLOPE_X), np.full_like(ys, SYNTHETIC_SLOPE_Y)
+
+
+def swell_green(xs, ys):
+    # A plane with a gentle swell, the slope changes across each grid area
+    zs = SYNTHETIC_SLOPE_X*xs + SYNTHETIC_SLOPE_Y*ys + \
+         SYNTHETIC_SWELL*np.sin(xs/SYNTHETIC_SWELL_X)*np.cos(ys/SYNTHETIC_SWELL_Y)
+
+    dz_dx = SYNTHETIC_SLOPE_X + SYNTHETIC_SWELL/SYNTHETIC_SWELL_X*np.cos(xs/SYNTHETIC_SWELL_X)*np.cos(ys/SYNTHETIC_SWELL_Y)
+    dz_dy = SYNTHETIC_SLOPE_Y - SYNTHETIC_SWELL/SYNTHETIC_SWELL_Y*np.sin(xs/SYNTHETIC_SWELL_X)*np.sin(ys/SYNTHETIC_SWELL_Y)
+
+    return zs, dz_dx, dz_dy
+
+
+# Synthetic greens, each returns the height and the analytic slope (dz/dx, dz/dy) of the verticies
+SYNTHETIC_GREENS = {
+    "plane": plane_green,
+    "swell": swell_green,
+}
+
+
+def synthetic_verticies(num_verticies, green=SUITE_GREEN, seed=0):
+    ################################
+    #
+    # Random verticies of a synthetic green
+    # Input: number of verticies, name of the green, random seed
+    # Output: x, y, z and the analytic dz/dx, dz/dy of every vertex
+    #
+    ################################
+    rng = np.random.default_rng(seed)
+
+    xs = rng.uniform(0, SYNTHETIC_SIZE, num_verticies)
+    ys = rng.uniform(0, SYNTHETIC_SIZE, num_verticies)
+    zs, dz_dx, dz_dy = SYNTHETIC_GREENS[green](xs, ys)
+
+    return xs, ys, zs, dz_dx, dz_dy
+
+
+def write_synthetic_ply(ply_file, num_verticies, offset=(0, 0, 0)):
+    ################################
+    #
+    # Writes an ascii ply file of a synthetic green with the Metashape property layout
+    # Input: File location, number of verticies, (x, y, z) added to the verticies
+    # Output: None
+    #
+    ################################
+    xs, ys, zs, dz_dx, dz_dy = synthetic_verticies(num_verticies, "swell")
+    xs, ys, zs = xs + offset[0], ys + offset[1], zs + offset[2]
+
+    # Exact surface normals (-dz/dx, -dz/dy, 1), normalized
+    length = np.sqrt(dz_dx**2 + dz_dy**2 + 1)
+
+    body = np.zeros((num_verticies, len(PLY_PROPERTIES)))
+    body[:, 0] = xs
+    body[:, 1] = ys
+    body[:, 2] = zs
+    body[:, 3] = -dz_dx/length
+    body[:, 4] = -dz_dy/length
+    body[:, 5] = 1/length
+    body[:, 7] = 255
+
+    with open(ply_file, "w") as plyFile:
+        plyFile.write("ply\n")
+        plyFile.write("format ascii 1.0\n")
+        plyFile.write("element vertex " + str(num_verticies) + "\n")
+        for prop_type, prop_name in PLY_PROPERTIES:
+            plyFile.write("property " + prop_type + " " + prop_name + "\n")
+        plyFile.write("end_header\n")
+
+        np.savetxt(plyFile, body, fmt="%.6f %.6f %.6f %.6f %.6f %.6f %d %d %d %d")
+
+    return
+
+
+def write_synthetic_binary_ply(ply_file, num_verticies, green=SUITE_GREEN):
+    ################################
+    #
+    # Writes a binary ply file of a synthetic green with the Metashape property layout
+    #
+    # Verticies are generated and written in chunks, so greens of 10^8 verticies are written
+    # without holding them in memory.
+    #
+    # Input: File location, number of verticies, name of the green
+    # Output: None
+    #
+    ################################
+    dtype = np.dtype([(prop_name, "<f4" if prop_type == "float" else "u1") for prop_type, prop_name in PLY_PROPERTIES])
+
+    with open(ply_file, "wb") as plyFile:
+        header = "ply\nformat binary_little_endian 1.0\nelement vertex " + str(num_verticies) + "\n"
+        header += "".join("property " + prop_type + " " + prop_name + "\n" for prop_type, prop_name in PLY_PROPERTIES)
+        plyFile.write((header + "end_header\n").encode("ascii"))
+
+        for seed, start in enumerate(range(0, num_verticies, SYNTHETIC_CHUNK_SIZE)):
+            count = min(SYNTHETIC_CHUNK_SIZE, num_verticies - start)
+            xs, ys, zs, dz_dx, dz_dy = synthetic_verticies(count, green, seed)
+            length = np.sqrt(dz_dx**2 + dz_dy**2 + 1)
+
+            body = np.zeros(count, dtype=dtype)
+            body["x"], body["y"], body["z"] = xs, ys, zs
+            body["nx"], body["ny"], body["nz"] = -dz_dx/length, -dz_dy/length, 1/length
+            body["class"] = 255
+
+            plyFile.write(body.tobytes())
+
+    return
+
+
+def read_ply_file_line_loop(ply_file):
+    ################################
+    #
+    # Original line by line ply reader, kept as the benchmark baseline
+    #
+    ################################
+    in_file_header = True
+
+    i = 0
+    properties = []
+
+    with open(ply_file) as plyFile:
+        for line in plyFile:
+            if in_file_header:
+                if 'end_header' in line:
+                    in_file_header = False
+                    xs, ys, zs = np.zeros(num_verticies), np.zeros(num_verticies), np.zeros(num_verticies)
+
+                elif 'element' in line and 'vertex' in line:
+                    num_verticies = int(line.split()[2])
+
+                elif 'property' in line:
+                    property_name = line.split()[2]
+                    properties.append(property_name)
+
+                continue
+            else:
+                if i < num_verticies:
+                    xs[i] = line.split()[properties.index("x")]
+                    ys[i] = line.split()[properties.index("y")]
+                    zs[i] = line.split()[properties.index("z")]
+
+                    i+=1
+
+    s_data = Surface_Data(0)
+    s_data.set_coordinates(xs, ys, zs)
+
+    return s_data
+
+
+def measure(function, *args):
+    ################################
+    #
+    # Runs a function, recording its wall time and peak traced memory
+    # Returns: (result, seconds, peak bytes)
+    #
+    ################################
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    result = function(*args)
+
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, elapsed, peak
+
+
+def benchmark_ply_readers(num_verticies):
+    ################################
+    #
+    # Compares the bulk numpy ply reader against the line by line loop
+    #
+    ################################
+    with tempfile.TemporaryDirectory() as temp_dir:
+        ply_file = Path(temp_dir, SYNTHETIC_PLY_FILE)
+        write_synthetic_ply(ply_file, num_verticies)
+
+        print("Synthetic ply file: " + str(num_verticies) + " verticies, " + str(os.path.getsize(ply_file) // 1024) + " KiB\n")
+
+        loop_data, loop_time, loop_peak = measure(read_ply_file_line_loop, ply_file)
+        bulk_data, bulk_time, bulk_peak = measure(read_ply_file, ply_file)
+
+    # Both readers must produce the same surface
+    for axis in ("x", "y", "z"):
+        assert np.array_equal(getattr(loop_data, axis), getattr(bulk_data, axis)), "Readers disagree on " + axis
+
+    print('{:<12}{:>12}{:>16}'.format("Reader", "Time (s)", "Peak mem (MiB)"))
+    print('{:<12}{:>12.3f}{:>16.2f}'.format("Line loop", loop_time, loop_peak / 2**20))
+    print('{:<12}{:>12.3f}{:>16.2f}'.format("Bulk numpy", bulk_time, bulk_peak / 2**20))
+    print()
+    print('Speedup: {:.1f}x'.format(loop_time / bulk_time))
+
+    return
+
+
+def compare_fit_methods(ply_file, cell_size=COMPARE_CELL_SIZE):
+    ################################
+    #
+    # Times every fit method on one binning of a ply file and compares its slopes to the
+    # least squares fit, showing when a faster fit is accurate enough
+    #
+    ################################
+    fit_methods = sorted(FIT_METHODS)
+    if not read_ply_header(ply_file).has_normals():
+        fit_methods = [fit_method for fit_method in fit_methods if fit_method not in NORMAL_FIT_METHODS]
+
+    data = read_ply_file(ply_file, any(fit_method in NORMAL_FIT_METHODS for fit_method in fit_methods))
+
+    grid_spec = Grid_Spec(cell_size=cell_size)
+    x_edges, y_edges = grid_spec.edges(calculate_bounds(data))
+    index = bin_points(data.x, data.y, x_edges, y_edges)
+
+    layers = {}
+    seconds = {}
+    for fit_method in fit_methods:
+        start = time.perf_counter()
+        gradients, valid = FIT_METHODS[fit_method](index, data, grid_spec)
+        seconds[fit_method] = time.perf_counter() - start
+
+        layers[fit_method] = drone_slope_layer(gradients, valid, x_edges, y_edges)
+
+    print()
+    print('{:<10}{:>10}{:>12}{:>14}{:>14}{:>14}'.format("Fit", "Time (s)", "vs " + FIT_METHOD, "Mag RMSE (%)", "Dir RMSE (deg)", "Dir p95 (deg)"))
+    for fit_method in fit_methods:
+        report, _, _, _ = score_layers(layers[fit_method], layers[FIT_METHOD])
+        magnitude = report["magnitude_error"] or {}
+        direction = report["direction_error"] or {}
+
+        print('{:<10}{:>10.3f}{:>11.1f}x{:>14.4f}{:>14.3f}{:>14.3f}'.format(
+            fit_method, seconds[fit_method], seconds[fit_method]/seconds[FIT_METHOD],
+            magnitude.get("rmse", np.nan), direction.get("rmse", np.nan), direction.get("p95", np.nan)))
+
+    return
+
+
+def peak_rss():
+    # High water mark of the resident memory (bytes) of this process, None where unavailable
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak if sys.platform == "darwin" else peak*1024 # Linux reports KiB
+
+
+def slope_errors(gradients, valid, index, s_data, green):
+    ################################
+    #
+    # Distance of the fitted slopes from the analytic slope of a synthetic green
+    #
+    # The expected slope of a grid area is the mean analytic slope over its verticies, which a
+    # plane of best fit matches to second order in the grid area size.
+    #
+    # Output: rise/run error of every valid grid area
+    #
+    ################################
+    xs = np.asarray(s_data.x, dtype=np.float64)
+    ys = np.asarray(s_data.y, dtype=np.float64)
+    _, dz_dx, dz_dy = SYNTHETIC_GREENS[green](xs, ys)
+
+    counts = np.diff(index.offsets)
+    filled = counts > 0
+    expected_x = np.zeros(len(counts))
+    expected_y = np.zeros(len(counts))
+    expected_x[filled] = sum_grid_cells(index, dz_dx[index.points])[filled]/counts[filled]
+    expected_y[filled] = sum_grid_cells(index, dz_dy[index.points])[filled]/counts[filled]
+
+    fitted_x, fitted_y = rise_over_run(gradients)
+
+    valid = valid.reshape(-1)
+
+    return np.hypot(fitted_x - expected_x, fitted_y - expected_y)[valid]
+
+
+def rise_over_run(gradients):
+    # dz/dx and dz/dy of every grid area, gradients hold the downhill unit direction and the negative rise over run
+    gradients = gradients.reshape(-1, 3)
+    rise = -gradients[:, Z]
+
+    return -gradients[:, X]*rise, -gradients[:, Y]*rise
+
+
+def compare_storage(ply_file, cell_size=COMPARE_CELL_SIZE, fit_method=FIT_METHOD):
+    ################################
+    #
+    # Reads and fits a ply file with every coordinate storage of Surface_Data, comparing the
+    # memory of the cloud and how far its slopes are from the float64 fit
+    #
+    ################################
+    grid_spec = Grid_Spec(cell_size=cell_size)
+
+    results = {}
+    for storage in STORAGE_TYPES:
+        data, read_seconds, read_peak = measure(read_ply_file, ply_file, fit_method in NORMAL_FIT_METHODS, storage)
+
+        start = time.perf_counter()
+        x_edges, y_edges = grid_spec.edges(calculate_bounds(data))
+        index = bin_surface(data, x_edges, y_edges)
+        gradients, valid = FIT_METHODS[fit_method](index, data, grid_spec)
+        fit_seconds = time.perf_counter() - start
+
+        results[storage] = (data.nbytes(), read_seconds, read_peak, fit_seconds, rise_over_run(gradients), valid.reshape(-1),
+                            len(np.unique(index.points)))
+
+    reference_x, reference_y = results[STORAGE_FLOAT64][4]
+
+    print()
+    print('{:<10}{:>14}{:>16}{:>12}{:>12}{:>12}{:>16}{:>16}'.format("Storage", "Cloud (MiB)", "Read peak (MiB)", "Read (s)", "Fit (s)",
+                                                                    "Binned", "Max slope diff", "RMS slope diff"))
+    for storage, (cloud_bytes, read_seconds, read_peak, fit_seconds, (slope_x, slope_y), valid, binned) in results.items():
+        assert np.array_equal(valid, results[STORAGE_FLOAT64][5]), storage + " storage fits different grid areas"
+        differences = np.hypot(slope_x - reference_x, slope_y - reference_y)[valid]
+
+        print('{:<10}{:>14.2f}{:>16.2f}{:>12.3f}{:>12.3f}{:>12}{:>16.2e}{:>16.2e}'.format(
+            storage, cloud_bytes/2**20, read_peak/2**20, read_seconds, fit_seconds, binned,
+            np.max(differences, initial=0), np.sqrt(np.mean(differences**2)) if len(differences) else 0))
+
+    return
+
+
+def benchmark_size(ply_file, num_verticies, green, cell_size, image_file):
+    ################################
+    #
+    # Times each pipeline stage on one synthetic green, run in its own process so the peak RSS
+    # belongs to this green alone
+    #
+    # Output: dictionary of the seconds, throughput (verticies/s) and peak RSS after each stage,
+    #         and the slope errors
+    #
+    ################################
+    stages = {}
+
+    def timed(stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start
+
+        rss = peak_rss()
+        stages[stage] = {"seconds": seconds, "throughput": num_verticies/seconds if seconds > 0 else None,
+                         "peak_rss_mb": rss/2**20 if rss is not None else None}
+        return result
+
+    grid_spec = Grid_Spec(cell_size=cell_size)
+
+    data = timed("read", read_ply_file, ply_file)
+    x_edges, y_edges = grid_spec.edges(calculate_bounds(data))
+    index = timed("binning", bin_points, data.x, data.y, x_edges, y_edges)
+    gradients, valid = timed("gradient", FIT_METHODS[FIT_METHOD], index, data, grid_spec)
+    timed("rendering", Green_Renderer().render, gradient_layers(gradients), image_file)
+
+    errors = slope_errors(gradients, valid, index, data, green)
+
+    return {"stages": stages,
+            "slope_error": {"max": float(errors.max()) if len(errors) else None,
+                            "rmse": float(np.sqrt(np.mean(errors**2))) if len(errors) else None,
+                            "grid_areas": int(len(errors))}}
+
+
+def read_history(history_file):
+    if not Path(history_file).exists():
+        return []
+
+    with open(history_file, "r") as file_handle:
+        return json.load(file_handle)
+
+
+def find_regressions(history, run, threshold=REGRESSION_THRESHOLD):
+    ################################
+    #
+    # Stages of a run slower than their recent history by more than the threshold
+    #
+    # The baseline of a stage is the median of its last REGRESSION_RUNS runs at the same size
+    # and green.
+    #
+    # Output: list of (size, stage, seconds, baseline seconds)
+    #
+    ################################
+    regressions = []
+    for size, result in run["results"].items():
+        for stage, measurement in result["stages"].items():
+            previous = [old["results"][size]["stages"][stage]["seconds"] for old in history
+                        if old["green"] == run["green"] and size in old["results"] and stage in old["results"][size]["stages"]]
+            previous = previous[-REGRESSION_RUNS:]
+
+            if not previous:
+                continue
+
+            baseline = float(np.median(previous))
+            if baseline >= MIN_REGRESSION_SECONDS and measurement["seconds"] > baseline*(1 + threshold):
+                regressions.append((size, stage, measurement["seconds"], baseline))
+
+    return regressions
+
+
+def run_benchmark_suite(sizes=SUITE_SIZES, green=SUITE_GREEN, cell_size=SUITE_CELL_SIZE, history_file=HISTORY_FILE,
+                        threshold=REGRESSION_THRESHOLD):
+    ################################
+    #
+    # Benchmarks every pipeline stage on synthetic greens of each size
+    #
+    # Input: numbers of verticies, name of the synthetic green, grid area size, JSON history
+    #        file, fractional slow down that fails a stage
+    # Output: True when no stage regressed and every slope was within SLOPE_TOLERANCE
+    #
+    ################################
+    run = {"created": time.strftime("%Y-%m-%d %H:%M:%S"), "green": green, "cell_size": cell_size,
+           "python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(), "results": {}}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for num_verticies in sizes:
+            ply_file = Path(temp_dir, SYNTHETIC_PLY_FILE)
+            write_synthetic_binary_ply(ply_file, num_verticies, green)
+
+            # A new process for each size, the peak RSS of a smaller green is not carried over
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(benchmark_size, ply_file, num_verticies, green, cell_size,
+                                         Path(temp_dir, "slope_map.png")).result()
+
+            run["results"][str(num_verticies)] = result
+            ply_file.unlink()
+
+    history = read_history(history_file)
+    regressions = find_regressions(history, run, threshold)
+
+    print()
+    print('{:<12}{:<12}{:>10}{:>16}{:>16}'.format("Verticies", "Stage", "Time (s)", "Verticies/s", "Peak RSS (MiB)"))
+    for size, result in run["results"].items():
+        for stage in SUITE_STAGES:
+            measurement = result["stages"][stage]
+            print('{:<12}{:<12}{:>10.3f}{:>16}{:>16}'.format(size, stage, measurement["seconds"],
+                  '{:.3g}'.format(measurement["throughput"]) if measurement["throughput"] else "-",
+                  '{:.1f}'.format(measurement["peak_rss_mb"]) if measurement["peak_rss_mb"] is not None else "-"))
+
+    print()
+    passed = True
+    for size, result in run["results"].items():
+        error = result["slope_error"]
+        if error["max"] is None or error["max"] > SLOPE_TOLERANCE:
+            passed = False
+            print("FAIL " + size + " verticies: slope error " + str(error["max"]) + " above " + str(SLOPE_TOLERANCE))
+        else:
+            print('{} verticies: slope error max {:.2e}, rmse {:.2e} over {} grid areas'.format(size, error["max"], error["rmse"], error["grid_areas"]))
+
+    for size, stage, seconds, baseline in regressions:
+        passed = False
+        print('FAIL {} verticies: {} took {:.3f} s, {:.0f}% slower than the baseline {:.3f} s'.format(
+              size, stage, seconds, (seconds/baseline - 1)*100, baseline))
+
+    run["passed"] = passed
+    history.append(run)
+    with open(history_file, "w") as file_handle:
+        json.dump(history, file_handle, indent=4)
+
+    print("\nStored benchmark run in: " + str(history_file))
+
+    return passed
+
+
+def report_decimation(ply_file, cell_size=COMPARE_CELL_SIZE, densities=DECIMATION_DENSITIES, method=DECIMATION_VOXEL,
+                      seed=DECIMATION_SEED, fit_method=FIT_METHOD):
+    ################################
+    #
+    # Fits a ply file decimated to each density and compares its slopes to the fit of every
+    # vertex, showing how much accuracy a faster fit costs
+    #
+    ################################
+    data = read_ply_file(ply_file, fit_method in NORMAL_FIT_METHODS)
+
+    grid_spec = Grid_Spec(cell_size=cell_size)
+    x_edges, y_edges = grid_spec.edges(calculate_bounds(data))
+    area = (x_edges[-1] - x_edges[0])*(y_edges[-1] - y_edges[0])
+
+    def fit(s_data):
+        return FIT_METHODS[fit_method](bin_surface(s_data, x_edges, y_edges), s_data, grid_spec)
+
+    start = time.perf_counter()
+    reference_gradients, reference_valid = fit(data)
+    reference_seconds = time.perf_counter() - start
+
+    reference_x, reference_y = rise_over_run(reference_gradients)
+    reference_valid = reference_valid.reshape(-1)
+
+    print()
+    print("Full cloud: " + str(len(data.stored[X])) + " verticies, " + '{:.0f}'.format(len(data.stored[X])/area) + " per square metre, fit in " +
+          '{:.3f}'.format(reference_seconds) + " s\n")
+    print('{:>10}{:>12}{:>14}{:>12}{:>10}{:>12}{:>16}{:>16}{:>16}'.format("Density", "Verticies", "Decimate (s)", "Fit (s)", "Speedup",
+                                                                      "Grid areas", "Max slope diff", "RMS slope diff", "p95 slope diff"))
+
+    for density in densities:
+        start = time.perf_counter()
+        decimated = decimate_surface(data, Decimation_Spec(density, method, seed))
+        decimate_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        gradients, valid = fit(decimated)
+        fit_seconds = time.perf_counter() - start
+
+        # Compare the grid areas both fits could fit, grid areas left too sparse are counted apart
+        valid = valid.reshape(-1) & reference_valid
+        slope_x, slope_y = rise_over_run(gradients)
+        differences = np.hypot(slope_x - reference_x, slope_y - reference_y)[valid]
+
+        print('{:>10}{:>12}{:>14.3f}{:>12.3f}{:>9.1f}x{:>12}{:>16.2e}{:>16.2e}{:>16.2e}'.format(
+            density, len(decimated.stored[X]), decimate_seconds, fit_seconds, reference_seconds/fit_seconds,
+            str(np.count_nonzero(valid)) + "/" + str(np.count_nonzero(reference_valid)),
+            np.max(differences, initial=0), np.sqrt(np.mean(differences**2)) if len(differences) else np.nan,
+            np.percentile(differences, 95) if len(differences) else np.nan))
+
+    return
+
+
+# Insertion point
+if __name__ == '__main__':
+    # Read in arguments
+    parser = argparse.ArgumentParser(description='Benchmark the slope model generation module')
+    parser.add_argument('--num_verticies', metavar='count', type=int, default=NUM_VERTICIES, help='Number of verticies in the synthetic ply file')
+    parser.add_argument('--compare_fits', metavar='file', type=str, nargs='?', const='', default=None, help='Compare the fit methods on a ply file (a synthetic green when no file is given)')
+    parser.add_argument('--compare_storage', metavar='file', type=str, nargs='?', const='', default=None, help='Compare the coordinate storage of the cloud on a ply file (a synthetic green when no file is given)')
+    parser.add_argument('--decimation_report', metavar='file', type=str, nargs='?', const='', default=None, help='Report slope accuracy against decimation density on a ply file (a synthetic green when no file is given)')
+    parser.add_argument('--densities', metavar='count', type=float, nargs='+', default=DECIMATION_DENSITIES, help='Verticies per square metre of the decimation report')
+    parser.add_argument('--decimation', type=str, choices=DECIMATION_METHODS, default=DECIMATION_VOXEL, help='Decimation method of the decimation report')
+    parser.add_argument('--seed', metavar='seed', type=int, default=DECIMATION_SEED, help='Random seed of the decimation report')
+    parser.add_argument('--cell_size', metavar='metres', type=float, default=COMPARE_CELL_SIZE, help='Grid area size of the fit method comparison and benchmark suite')
+    parser.add_argument('--suite', action='store_true', help='Run the benchmark suite over synthetic greens of known slope')
+    parser.add_argument('--sizes', metavar='count', type=int, nargs='+', default=SUITE_SIZES, help='Numbers of verticies of the benchmark suite greens (up to 10^8)')
+    parser.add_argument('--green', type=str, choices=sorted(SYNTHETIC_GREENS), default=SUITE_GREEN, help='Synthetic green of the benchmark suite')
+    parser.add_argument('--history_file', metavar='file', type=str, default=HISTORY_FILE, help='JSON history of benchmark suite runs')
+    parser.add_argument('--threshold', metavar='fraction', type=float, default=REGRESSION_THRESHOLD, help='Slow down of a stage, against its recent history, that fails the suite')
+
+    args = parser.parse_args()
+
+    if args.suite:
+        if not run_benchmark_suite(args.sizes, args.green, args.cell_size, args.history_file, args.threshold):
+            sys.exit(1)
+    elif args.decimation_report is not None:
+        if args.decimation_report:
+            report_decimation(args.decimation_report, args.cell_size, args.densities, args.decimation, args.seed)
+        else:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                ply_file = Path(temp_dir, SYNTHETIC_PLY_FILE)
+                write_synthetic_ply(ply_file, args.num_verticies)
+                report_decimation(ply_file, args.cell_size, args.densities, args.decimation, args.seed)
+    elif args.compare_storage is not None:
+        if args.compare_storage:
+            compare_storage(args.compare_storage, args.cell_size)
+        else:
+            # The same green at the origin and georeferenced, far from the origin
+            with tempfile.TemporaryDirectory() as temp_dir:
+                ply_file = Path(temp_dir, SYNTHETIC_PLY_FILE)
+                for offset in ((0, 0, 0), GEOREFERENCED_OFFSET):
+                    write_synthetic_ply(ply_file, args.num_verticies, offset)
+
+                    print("\nSynthetic green offset by " + str(offset))
+                    compare_storage(ply_file, args.cell_size)
+    elif args.compare_fits is None:
+        benchmark_ply_readers(args.num_verticies)
+    elif args.compare_fits:
+        compare_fit_methods(args.compare_fits, args.cell_size)
+    else:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ply_file = Path(temp_dir, SYNTHETIC_PLY_FILE)
+            write_synthetic_ply(ply_file, args.num_verticies)
+            compare_fit_methods(ply_file, args.cell_size)
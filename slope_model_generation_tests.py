@@ -17,7 +17,7 @@ import numpy as np
 
 from tqdm import tqdm
 from pathlib import Path
-from slope_model_generation import read_ply_file, create_gradient_grid
+from slope_model_generation import read_ply_file, create_grid_index, fit_cell_planes, GRID_SIZE_X, GRID_SIZE_Y
 
 
 ###################################################################################################
@@ -27,100 +27,41 @@ from slope_model_generation import read_ply_file, create_gradient_grid
 ###################################################################################################
 PLY_FILE_PATH = Path('Data', 'westwood_plateua_practise_green','WWP_1_highest_quality.ply')
 
-from slope_model_generation import GRID_SIZE_X, GRID_SIZE_Y
-
 X_VIEWING_DENSITY = 20
 Y_VIEWING_DENSITY = 20
 
 SLOPES_FILE = "slope_visulaizations.csv"
 
 
-###################################################################################################
-#
-#                                            CLASSES
-#
-###################################################################################################
-from slope_model_generation import Surface_Data
-
 ###################################################################################################
 #
 #                                            FUNCTIONS
 #
 ###################################################################################################
-def calculate_plane_of_best_fit(indicies, s_data):
-    # Preallocate memory
-    xs = np.zeros(len(indicies))
-    ys = np.zeros(len(indicies))
-    zs = np.zeros(len(indicies))
-
-    # Store the data points of interest
-    counter = 0
-    for index in indicies:
-        xs[counter] = s_data.x[index]
-        ys[counter] = s_data.y[index]
-        zs[counter] = s_data.z[index]
-        counter+=1
-
-    # Fit a 2D plane to the data
-    tmp_A = []
-    tmp_b = []
-    for i in range(len(indicies)):
-        tmp_A.append([xs[i], ys[i], 1])
-        tmp_b.append(zs[i])
-    b = np.matrix(tmp_b).T
-    A = np.matrix(tmp_A)
-    try:
-        fit = (A.T * A).I * A.T * b
-    except Exception as e:
-        # TODO: sometimes there are multiples of the same point in the ply file,
-        # for now, return a null gradient - Preferably ply file creation would check for no double
-        # points
-        print("Cannot compute a gradient in a grid section due to multiples of the same point")
-
-        return None
-    
-    return fit
-
-
 def store_new_ply_points(ply_file):
     # Read in data
     data = read_ply_file(ply_file)
 
-    # Now that the data is collected, create a GRID_SIZE_X x GRID_SIZE_Y grid from min & max x and y points
-    max_x = max(data.x)
-    min_x = min(data.x)
-    max_y = max(data.y)
-    min_y = min(data.y)
+    # Now that the data is collected, bin it into a GRID_SIZE_X x GRID_SIZE_Y grid from min & max x and y points
+    index = create_grid_index(data, GRID_SIZE_X, GRID_SIZE_Y)
 
-    # Determine grid boxes dimensions
-    length_x = max_x - min_x
-    step_x = length_x/GRID_SIZE_X
-
-    length_y = max_y - min_y
-    step_y = length_y/GRID_SIZE_Y
+    # Calculate planes of best fit to the data, grid areas with too few distinct points are flagged as not valid
+    planes_of_best_fit, valid_fits = fit_cell_planes(index, data)
 
     # Write the gradients to a text file
     temp_ply_file = open(SLOPES_FILE, "w")
 
-    # Calculate planes of best fit to the data
+    # Visualize the planes of best fit
     for i in tqdm(range(GRID_SIZE_Y), desc="Y axis (NS) calculations"):
         for j in tqdm(range(GRID_SIZE_X), desc="X axis (EW) calculations", leave=False):
             # Determine grid area x and y selections
-            x_start  = min_x + step_x*j
-            x_finish = min_x + step_x*(j+1)
-            y_start  = min_y + step_y*i
-            y_finish = min_y + step_y*(i+1)
-
-            # Find all points within this grid area
-            indicies = list(filter(lambda k: data.x[k] >= x_start and data.x[k] <= x_finish and data.y[k] >= y_start and data.y[k] <= y_finish, range(len(data.x))))
-
-            fit = True
-            if len(indicies) <= 1:
-                # No gradient can be given for a grid area that contains less than two points
-                fit = False
-            else:
-                # Find a vector that averages the slopes of the grid area points
-                plane_of_best_fit = calculate_plane_of_best_fit(indicies, data)
+            x_start  = index.x_edges[j]
+            x_finish = index.x_edges[j+1]
+            y_start  = index.y_edges[i]
+            y_finish = index.y_edges[i+1]
+
+            fit = valid_fits[i][j]
+            plane_of_best_fit = planes_of_best_fit[i][j]
 
             # Add visualization of the plane of best fit here
             x_vals = np.linspace(x_start, x_finish, X_VIEWING_DENSITY)
@@ -173,8 +114,9 @@ def create_new_ply_file(data):
     # Then transfer points from both source files to the new file
 
     # Transfer data from old file, pts will be green
-    for i in range(len(data.x)):
-        visualization_file.write(str(data.x[i]) + " " + str(data.y[i]) + " " + str(data.z[i]) + " 0 0 0 0 255 0 0\n")
+    xs, ys, zs = data.x, data.y, data.z
+    for i in range(len(xs)):
+        visualization_file.write(str(xs[i]) + " " + str(ys[i]) + " " + str(zs[i]) + " 0 0 0 0 255 0 0\n")
 
     # Transfer data from visualization file
     with open(SLOPES_FILE, 'r') as slope_file:
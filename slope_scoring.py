@@ -0,0 +1,303 @@
+###################################################################################################
+#
+#                                       SLOPE SCORING MODULE
+#
+#
+# Scores a slope map calculated from the drone point cloud against the ground truth of the green
+# Authors: Jayden Cole & Ryan Stolys
+# Creation date: 2022-07-06
+#
+# Algorithm:
+#   1. Calculate the drone slope map and load the ground truth green
+#   2. Place both on the point cloud coordinates and resample them onto one common grid
+#   3. Compare slope magnitude and direction in every grid area measured by both
+#   4. Output a JSON report and a heat map of the differences
+#
+###################################################################################################
+import json
+import argparse
+import numpy as np
+
+from pathlib import Path
+from ground_truth import Green_Layout, read_csv_file, create_green_grid
+from green_renderer import Green_Renderer, Green_Layers
+from slope_model_generation import Grid_Spec, calculate_grid_moments, solve_gradients, load_slope_pyramid, \
+                                   GRID_SIZE_X, GRID_SIZE_Y, PLY_FILE, X, Y, Z
+
+###################################################################################################
+#
+#                                            CONSTANTS
+#
+###################################################################################################
+REPORT_FILE = "slope_score.json"
+DIFFERENCE_IMAGE_FILE = "slope_difference.png"
+
+PERCENT = 100                   # Slope magnitudes are scored as percent grade
+ERROR_PERCENTILES = (50, 90, 95)
+MIN_DIRECTION_SLOPE = 0.1       # Percent grade below which a slope has no meaningful direction
+
+DIFFERENCE_QUIVER = {"scale": 2, "scale_units": "xy", "pivot": "mid"}
+
+###################################################################################################
+#
+#                                            CLASSES
+#
+###################################################################################################
+class Slope_Layer(object):
+    ################################
+    #
+    # Slope map of a green on the point cloud coordinates, indexed [y, x] with y increasing north
+    #
+    # east and north are the downhill slope vector in percent grade, mag is its length. valid
+    # marks the grid areas with a slope.
+    #
+    ################################
+    def __init__(self, x_edges, y_edges, east, north, valid):
+
+        self.x_edges = np.asarray(x_edges, dtype=float)
+        self.y_edges = np.asarray(y_edges, dtype=float)
+        self.east    = np.where(valid, east, 0.0)
+        self.north   = np.where(valid, north, 0.0)
+        self.mag     = np.hypot(self.east, self.north)
+        self.valid   = np.asarray(valid, dtype=bool)
+
+
+###################################################################################################
+#
+#                                            FUNCTIONS
+#
+###################################################################################################
+def drone_slope_layer(gradients, valid, x_edges, y_edges):
+    #######################################
+    #
+    # Slope layer of a calculated gradient grid
+    #
+    # Input: gradient grid (GRID_SIZE_Y, GRID_SIZE_X, 3) with unit X, Y downhill direction and Z
+    #        as -rise/run, valid fit mask, grid area edges along x and y
+    # Returns: Slope_Layer
+    #
+    ######################################
+    gradients = np.asarray(gradients, dtype=float)
+    grade = np.abs(gradients[:, :, Z]) * PERCENT
+
+    return Slope_Layer(x_edges, y_edges, gradients[:, :, X]*grade, gradients[:, :, Y]*grade, valid)
+
+
+def ground_truth_slope_layer(green, layout, bounds):
+    #######################################
+    #
+    # Slope layer of a ground truth green
+    #
+    # The green grid is placed with the origin and cell size of its layout. A layout without them
+    # is stretched over bounds, the (min x, max x, min y, max y) of the drone slope map.
+    #
+    # Input: Green_Grid, Green_Layout, bounds
+    # Returns: Slope_Layer
+    #
+    ######################################
+    if layout.origin is not None and layout.cell_size is not None:
+        min_x = layout.origin[0]
+        max_y = layout.origin[1]
+        x_edges = min_x + layout.cell_size*np.arange(green.grid_size_x + 1)
+        y_edges = max_y - layout.cell_size*np.arange(green.grid_size_y, -1, -1)
+    else:
+        x_edges = np.linspace(bounds[0], bounds[1], green.grid_size_x + 1)
+        y_edges = np.linspace(bounds[2], bounds[3], green.grid_size_y + 1)
+
+    # Ground truth rows run north to south and its slope vectors are west and south positive
+    east  = -green.EW_vect[::-1]
+    north = -green.NS_vect[::-1]
+
+    return Slope_Layer(x_edges, y_edges, east, north, green.valid[::-1])
+
+
+def load_ground_truth_layer(csv_file, layout_file, bounds):
+    #######################################
+    #
+    # Reads a ground truth CSV file into a slope layer
+    #
+    # Input: ground truth csv and layout files, bounds used when the layout has no origin
+    # Returns: Slope_Layer
+    #
+    ######################################
+    layout = Green_Layout(layout_file)
+    green = create_green_grid(read_csv_file(csv_file, layout), layout)
+
+    return ground_truth_slope_layer(green, layout, bounds)
+
+
+def resample_layer(layer, x_edges, y_edges):
+    #######################################
+    #
+    # Resamples a slope layer onto another grid
+    #
+    # Each grid area takes the slope of the source grid area under its centre. Grid areas whose
+    # centre is outside the source grid are not valid.
+    #
+    # Input: Slope_Layer, grid area edges along x and y of the new grid
+    # Returns: Slope_Layer on the new grid
+    #
+    ######################################
+    x_centres = (x_edges[:-1] + x_edges[1:]) / 2
+    y_centres = (y_edges[:-1] + y_edges[1:]) / 2
+
+    columns = np.searchsorted(layer.x_edges, x_centres, side='right') - 1
+    rows    = np.searchsorted(layer.y_edges, y_centres, side='right') - 1
+
+    inside_x = (columns >= 0) & (columns < len(layer.x_edges) - 1)
+    inside_y = (rows >= 0) & (rows < len(layer.y_edges) - 1)
+
+    rows    = np.clip(rows, 0, len(layer.y_edges) - 2)[:, np.newaxis]
+    columns = np.clip(columns, 0, len(layer.x_edges) - 2)[np.newaxis, :]
+
+    valid = layer.valid[rows, columns] & inside_y[:, np.newaxis] & inside_x[np.newaxis, :]
+
+    return Slope_Layer(x_edges, y_edges, layer.east[rows, columns], layer.north[rows, columns], valid)
+
+
+def error_statistics(errors):
+    # Mean, RMSE, maximum and percentiles of the absolute errors
+    if errors.size == 0:
+        return None
+
+    absolute = np.abs(errors)
+    statistics = {
+        "mean":  float(np.mean(absolute)),
+        "rmse":  float(np.sqrt(np.mean(errors**2))),
+        "max":   float(np.max(absolute)),
+    }
+    for percentile, value in zip(ERROR_PERCENTILES, np.percentile(absolute, ERROR_PERCENTILES)):
+        statistics["p" + str(percentile)] = float(value)
+
+    return statistics
+
+
+def score_layers(drone, truth):
+    #######################################
+    #
+    # Compares two slope layers on the same grid
+    #
+    # Direction is only scored where both slopes are steeper than MIN_DIRECTION_SLOPE.
+    #
+    # Input: drone Slope_Layer, ground truth Slope_Layer
+    # Returns: report dictionary, magnitude error grid, direction error grid (degrees), mask of
+    #          grid areas scored
+    #
+    ######################################
+    assert drone.east.shape == truth.east.shape, "Slope layers must be resampled onto the same grid"
+
+    scored = drone.valid & truth.valid
+    directed = scored & (drone.mag > MIN_DIRECTION_SLOPE) & (truth.mag > MIN_DIRECTION_SLOPE)
+
+    magnitude_error = np.where(scored, drone.mag - truth.mag, 0.0)
+
+    # Signed angle from the ground truth direction to the drone direction, wrapped to (-180, 180]
+    direction_error = np.degrees(np.arctan2(truth.east*drone.north - truth.north*drone.east,
+                                            truth.east*drone.east + truth.north*drone.north))
+    direction_error = np.where(directed, direction_error, 0.0)
+
+    # Error of the whole slope vector, magnitude and direction together
+    vector_error = np.hypot(drone.east - truth.east, drone.north - truth.north)
+
+    report = {
+        "grid_size":            [int(drone.east.shape[1]), int(drone.east.shape[0])],
+        "grid_areas_scored":    int(np.count_nonzero(scored)),
+        "directions_scored":    int(np.count_nonzero(directed)),
+        "drone_only":           int(np.count_nonzero(drone.valid & ~truth.valid)),
+        "ground_truth_only":    int(np.count_nonzero(truth.valid & ~drone.valid)),
+        "magnitude_bias":       float(np.mean(magnitude_error[scored])) if scored.any() else None,
+        "magnitude_error":      error_statistics(magnitude_error[scored]),
+        "direction_error":      error_statistics(direction_error[directed]),
+        "vector_error":         error_statistics(vector_error[scored]),
+    }
+
+    return report, magnitude_error, direction_error, scored
+
+
+def difference_layers(drone, truth, scored):
+    #######################################
+    #
+    # Heat map of the absolute magnitude error with arrows of the slope vector error
+    #
+    # Returns: Green_Layers, rows flipped so north is at the top of the image
+    #
+    ######################################
+    mag = np.where(scored, np.abs(drone.mag - truth.mag), 0.0)[::-1]
+    u   = np.where(scored, drone.east - truth.east, 0.0)[::-1]
+    v   = -np.where(scored, drone.north - truth.north, 0.0)[::-1] # Y positive axis is downward
+
+    return Green_Layers(mag, u, v, quiver=DIFFERENCE_QUIVER)
+
+
+def score_slope_map(gradients, valid, x_edges, y_edges, csv_file, layout_file, report_file=None, image_file=None):
+    #######################################
+    #
+    # Scores a drone slope map against ground truth on the ground truth grid
+    #
+    # Input: gradient grid, valid fit mask, grid area edges along x and y, ground truth csv and
+    #        layout files, report and difference image files (optional)
+    # Returns: report dictionary
+    #
+    ######################################
+    drone = drone_slope_layer(gradients, valid, x_edges, y_edges)
+    truth = load_ground_truth_layer(csv_file, layout_file, (x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]))
+
+    # The ground truth grid is the common grid
+    drone = resample_layer(drone, truth.x_edges, truth.y_edges)
+
+    report, _, _, scored = score_layers(drone, truth)
+    report["ground_truth"] = str(csv_file)
+    report["layout"] = str(layout_file)
+
+    if report_file is not None:
+        with open(report_file, "w") as file_handle:
+            json.dump(report, file_handle, indent=4)
+        print("Stored score report: " + str(report_file) + "\n")
+
+    if image_file is not None:
+        Green_Renderer().render(difference_layers(drone, truth, scored), image_file)
+        print("Stored difference map: " + str(image_file) + "\n")
+
+    return report
+
+
+def print_report(report):
+    # Prints the headline errors of a score report
+    print('{:<24}{:>10}'.format("Grid areas scored", report["grid_areas_scored"]))
+    for name in ("magnitude_error", "direction_error", "vector_error"):
+        statistics = report[name]
+        if statistics is None:
+            print('{:<24}{:>10}'.format(name, "-"))
+            continue
+        print('{:<24}{:>10.3f}{:>10.3f}{:>10.3f}'.format(name + " (rmse/p50/p95)", statistics["rmse"], statistics["p50"], statistics["p95"]))
+
+    return
+
+
+# Insertion point
+if __name__ == '__main__':
+    # Read in arguments
+    parser = argparse.ArgumentParser(description='Score a drone slope map against ground truth')
+    parser.add_argument('data_folder', metavar='folder', type=str, help='Folder of the ply file')
+    parser.add_argument('csv_file', metavar='file', type=str, help='Ground truth csv file')
+    parser.add_argument('layout_file', metavar='layout', type=str, help='Layout file of the ground truth green')
+    parser.add_argument('--grid_size', metavar='count', type=int, nargs=2, default=[GRID_SIZE_X, GRID_SIZE_Y], help='Number of grid areas along x and y')
+    parser.add_argument('--cell_size', metavar='metres', type=float, default=None, help='Grid area size in metres, overrides --grid_size')
+    parser.add_argument('--chunk_size', metavar='count', type=int, default=None, help='Stream the ply file in chunks of this many verticies')
+    parser.add_argument('--pyramid_file', metavar='file', type=str, default=None, help='Score the finest level of a stored slope pyramid instead of fitting the ply file')
+    parser.add_argument('--report_file', metavar='file', type=str, default=REPORT_FILE, help='JSON score report')
+    parser.add_argument('--image_file', metavar='file', type=str, default=DIFFERENCE_IMAGE_FILE, help='Difference heat map (.png or .svg)')
+
+    args = parser.parse_args()
+
+    if args.pyramid_file:
+        gradients, valid, x_edges, y_edges = load_slope_pyramid(args.pyramid_file)[0]
+    else:
+        grid_spec = Grid_Spec(args.grid_size[0], args.grid_size[1], args.cell_size)
+        moments = calculate_grid_moments(Path(args.data_folder, PLY_FILE), grid_spec, chunk_size=args.chunk_size)
+        gradients, valid = solve_gradients(moments, grid_spec)
+        x_edges, y_edges = moments.x_edges, moments.y_edges
+
+    report = score_slope_map(gradients, valid, x_edges, y_edges, args.csv_file, args.layout_file, args.report_file, args.image_file)
+
+    print_report(report)
@@ -0,0 +1,285 @@
+###################################################################################################
+#
+#                                       SLOPE PARAMETER SWEEP
+#
+#
+# Scores many grid resolutions and fit methods of one ply file against its ground truth
+# Authors: Jayden Cole & Ryan Stolys
+# Creation date: 2022-07-07
+#
+# Algorithm:
+#   1. Read the ply file once into shared memory
+#   2. Give each worker process one grid, the worker bins the verticies into it once and fits
+#      every fit method from that binning
+#   3. Score every fit against the ground truth
+#   4. Output a table of accuracy against runtime
+#
+###################################################################################################
+import csv
+import time
+import argparse
+import numpy as np
+
+from tqdm import tqdm
+from pathlib import Path
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from slope_model_generation import Grid_Spec, Surface_Data, read_ply_file, read_ply_header, calculate_bounds, bin_points, FIT_METHODS, \
+                                   NORMAL_FIT_METHODS, PLY_FILE, X, Y, Z
+from slope_scoring import drone_slope_layer, load_ground_truth_layer, resample_layer, score_layers
+
+###################################################################################################
+#
+#                                            CONSTANTS
+#
+###################################################################################################
+SWEEP_GRID_SIZES = [4, 8, 12, 16]
+SWEEP_TABLE_FILE = "slope_sweep.csv"
+
+# Rows of the shared vertex block, the normals rows are only shared when a fit method needs them
+NX = 3
+NY = 4
+NZ = 5
+
+SWEEP_COLUMNS = ["grid", "fit_method", "bin_seconds", "fit_seconds", "grid_areas_scored",
+                 "magnitude_rmse", "magnitude_bias", "direction_rmse", "direction_p90", "vector_rmse"]
+
+###################################################################################################
+#
+#                                            CLASSES
+#
+###################################################################################################
+class Sweep_Result(object):
+    ################################
+    #
+    # One fit method on one grid, as returned by a sweep worker
+    #
+    ################################
+    def __init__(self, grid_spec, fit_method, gradients, valid, x_edges, y_edges, bin_seconds, fit_seconds):
+
+        self.grid_spec   = grid_spec
+        self.fit_method  = fit_method
+        self.gradients   = gradients
+        self.valid       = valid
+        self.x_edges     = x_edges
+        self.y_edges     = y_edges
+        self.bin_seconds = bin_seconds # Shared by every fit method of the grid
+        self.fit_seconds = fit_seconds
+
+
+###################################################################################################
+#
+#                                            FUNCTIONS
+#
+###################################################################################################
+def grid_label(grid_spec):
+    # Short name of a grid for the sweep table
+    if grid_spec.cell_size:
+        return str(grid_spec.cell_size) + "m"
+
+    return str(grid_spec.grid_size_x) + "x" + str(grid_spec.grid_size_y)
+
+
+def sweep_grid(shared_name, num_rows, num_verticies, bounds, grid_spec, fit_methods):
+    #######################################
+    #
+    # Worker process task, fits every fit method on one grid
+    #
+    # The verticies are binned into the grid once and the binning is shared by the fit methods.
+    #
+    # Input: name of the shared memory block holding the verticies, rows in the block, vertex
+    #        count, bounds of the verticies, Grid_Spec of the grid, names of the fit methods
+    # Returns: list of Sweep_Result
+    #
+    ######################################
+    shared = shared_memory.SharedMemory(name=shared_name)
+
+    try:
+        verticies = np.ndarray((num_rows, num_verticies), dtype=np.float64, buffer=shared.buf)
+
+        s_data = Surface_Data(0)
+        s_data.set_coordinates(verticies[X], verticies[Y], verticies[Z])
+
+        if num_rows > NX:
+            s_data.nx = verticies[NX]
+            s_data.ny = verticies[NY]
+            s_data.nz = verticies[NZ]
+
+        start = time.perf_counter()
+        x_edges, y_edges = grid_spec.edges(bounds)
+        index = bin_points(s_data.x, s_data.y, x_edges, y_edges)
+        bin_seconds = time.perf_counter() - start
+
+        results = []
+        for fit_method in fit_methods:
+            start = time.perf_counter()
+            gradients, valid = FIT_METHODS[fit_method](index, s_data, grid_spec)
+            fit_seconds = time.perf_counter() - start
+
+            results.append(Sweep_Result(grid_spec, fit_method, gradients, valid, x_edges, y_edges, bin_seconds, fit_seconds))
+
+        del s_data, verticies
+
+    finally:
+        shared.close()
+
+    return results
+
+
+def run_sweep(s_data, grid_specs, fit_methods, workers=1):
+    #######################################
+    #
+    # Fits every fit method on every grid using a pool of worker processes
+    #
+    # The verticies are copied into shared memory once, each worker only receives the grid it
+    # bins and fits.
+    #
+    # Input: the vertex data object, list of Grid_Spec, names of the fit methods, number of
+    #        worker processes
+    # Returns: list of Sweep_Result
+    #
+    ######################################
+    for fit_method in fit_methods:
+        assert fit_method in FIT_METHODS, "Unknown fit method: " + fit_method
+
+    num_verticies = len(s_data.stored[X])
+    num_rows = NZ + 1 if s_data.nx is not None else NX
+    bounds = calculate_bounds(s_data)
+
+    shared = shared_memory.SharedMemory(create=True, size=max(1, num_rows*num_verticies*np.dtype(np.float64).itemsize))
+
+    try:
+        verticies = np.ndarray((num_rows, num_verticies), dtype=np.float64, buffer=shared.buf)
+        verticies[X] = s_data.x
+        verticies[Y] = s_data.y
+        verticies[Z] = s_data.z
+
+        if s_data.nx is not None:
+            verticies[NX] = s_data.nx
+            verticies[NY] = s_data.ny
+            verticies[NZ] = s_data.nz
+        del verticies
+
+        grid_results = [None]*len(grid_specs)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(sweep_grid, shared.name, num_rows, num_verticies, bounds, grid_spec, fit_methods): i
+                       for i, grid_spec in enumerate(grid_specs)}
+
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Sweep grids"):
+                grid_results[futures[future]] = future.result()
+
+    finally:
+        shared.close()
+        shared.unlink()
+
+    # Keep the order the grids were given in
+    results = [result for results in grid_results for result in results]
+
+    return results
+
+
+def score_sweep(results, csv_file, layout_file, bounds):
+    #######################################
+    #
+    # Scores every sweep result against the ground truth
+    #
+    # Input: list of Sweep_Result, ground truth csv and layout files, bounds of the verticies
+    # Returns: list of table rows (dictionaries keyed by SWEEP_COLUMNS)
+    #
+    ######################################
+    truth = load_ground_truth_layer(csv_file, layout_file, bounds)
+
+    rows = []
+    for result in results:
+        drone = drone_slope_layer(result.gradients, result.valid, result.x_edges, result.y_edges)
+        report, _, _, _ = score_layers(resample_layer(drone, truth.x_edges, truth.y_edges), truth)
+
+        magnitude = report["magnitude_error"] or {}
+        direction = report["direction_error"] or {}
+        vector    = report["vector_error"] or {}
+
+        rows.append({
+            "grid":              grid_label(result.grid_spec),
+            "fit_method":        result.fit_method,
+            "bin_seconds":       result.bin_seconds,
+            "fit_seconds":       result.fit_seconds,
+            "grid_areas_scored": report["grid_areas_scored"],
+            "magnitude_rmse":    magnitude.get("rmse"),
+            "magnitude_bias":    report["magnitude_bias"],
+            "direction_rmse":    direction.get("rmse"),
+            "direction_p90":     direction.get("p90"),
+            "vector_rmse":       vector.get("rmse"),
+        })
+
+    return rows
+
+
+def print_sweep_table(rows):
+    # Prints the sweep rows as a table of accuracy against runtime
+    print('{:<10}{:<12}{:>10}{:>10}{:>8}{:>10}{:>10}{:>10}{:>10}'.format(
+        "Grid", "Fit", "Bin (s)", "Fit (s)", "Areas", "Mag RMSE", "Mag bias", "Dir RMSE", "Vec RMSE"))
+
+    for row in rows:
+        values = [row["magnitude_rmse"], row["magnitude_bias"], row["direction_rmse"], row["vector_rmse"]]
+        print('{:<10}{:<12}{:>10.3f}{:>10.3f}{:>8}'.format(row["grid"], row["fit_method"], row["bin_seconds"], row["fit_seconds"], row["grid_areas_scored"]) +
+              "".join('{:>10.3f}'.format(value) if value is not None else '{:>10}'.format("-") for value in values))
+
+    return
+
+
+def write_sweep_table(rows, table_file):
+    # Writes the sweep rows to a csv file
+    with open(table_file, "w", newline='') as file_handle:
+        writer = csv.DictWriter(file_handle, fieldnames=SWEEP_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    return
+
+
+def sweep_slope_map(ply_file, csv_file, layout_file, grid_specs, fit_methods, workers=1, table_file=None):
+    #######################################
+    #
+    # Calls all the functions needed to sweep the grid and fit method of a green
+    #
+    ######################################
+    if not read_ply_header(ply_file).has_normals():
+        skipped = [fit_method for fit_method in fit_methods if fit_method in NORMAL_FIT_METHODS]
+        if skipped:
+            print("Ply file has no vertex normals, skipping: " + ", ".join(skipped) + "\n")
+        fit_methods = [fit_method for fit_method in fit_methods if fit_method not in NORMAL_FIT_METHODS]
+
+    data = read_ply_file(ply_file, any(fit_method in NORMAL_FIT_METHODS for fit_method in fit_methods))
+
+    results = run_sweep(data, grid_specs, fit_methods, workers)
+    rows = score_sweep(results, csv_file, layout_file, calculate_bounds(data))
+
+    print()
+    print_sweep_table(rows)
+
+    if table_file is not None:
+        write_sweep_table(rows, table_file)
+        print("\nStored sweep table: " + str(table_file))
+
+    return rows
+
+
+# Insertion point
+if __name__ == '__main__':
+    # Read in arguments
+    parser = argparse.ArgumentParser(description='Sweep grid resolutions and fit methods against ground truth')
+    parser.add_argument('data_folder', metavar='folder', type=str, help='Folder of the ply file')
+    parser.add_argument('csv_file', metavar='file', type=str, help='Ground truth csv file')
+    parser.add_argument('layout_file', metavar='layout', type=str, help='Layout file of the ground truth green')
+    parser.add_argument('--grid_sizes', metavar='count', type=int, nargs='*', default=SWEEP_GRID_SIZES, help='Square grid sizes to fit')
+    parser.add_argument('--cell_sizes', metavar='metres', type=float, nargs='*', default=[], help='Grid area sizes to fit')
+    parser.add_argument('--fit_methods', type=str, nargs='+', choices=sorted(FIT_METHODS), default=sorted(FIT_METHODS), help='Fit methods to compare')
+    parser.add_argument('--workers', metavar='count', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--table_file', metavar='file', type=str, default=SWEEP_TABLE_FILE, help='Csv file of the sweep table')
+
+    args = parser.parse_args()
+
+    grid_specs = [Grid_Spec(size, size) for size in args.grid_sizes] + [Grid_Spec(cell_size=size) for size in args.cell_sizes]
+
+    sweep_slope_map(Path(args.data_folder, PLY_FILE), args.csv_file, args.layout_file, grid_specs, args.fit_methods,
+                    args.workers, args.table_file)